@@ -0,0 +1,230 @@
+"""End to end benchmark of the sensor pipeline
+
+    python -m benchmarks.bench_e2e [--sensors N] [--every INTERVAL]
+        [--duration SECONDS] [--encoding json|msgpack] [--batch N]
+        [--output FILE] [--baseline FILE] [--tolerance FRACTION]
+
+Runs `main.run` with `counter` sensors publishing through the iotcore
+client to an in-process fake broker over TLS, see `fake_broker`. Reports
+the throughput of readings, the latency from a device being read to the
+broker receiving the reading, and the CPU time and peak RSS of the process,
+which includes the broker's thread.
+
+Results are written to `--output` as JSON. With `--baseline` they are
+compared with an earlier run and the benchmark fails if throughput, latency
+or CPU time regressed by more than `--tolerance`.
+"""
+import argparse
+import asyncio
+import datetime
+import json
+import platform
+import resource
+import sys
+import tempfile
+import threading
+import time
+
+import bobnet_sensors
+# counter sensors do not need the hardware libraries
+bobnet_sensors.TESTING = True
+
+from bobnet_sensors.aggregation import percentile  # noqa: E402
+from bobnet_sensors.async_helper import Looper  # noqa: E402
+from bobnet_sensors.cli import set_up_logging  # noqa: E402
+from bobnet_sensors.config import parse_time  # noqa: E402
+from bobnet_sensors.encoding import decode  # noqa: E402
+from bobnet_sensors.iotcore import load_iotcore  # noqa: E402
+from bobnet_sensors.main import run  # noqa: E402
+from bobnet_sensors.sensors import load_sensors  # noqa: E402
+
+from .fake_broker import (  # noqa: E402
+    FakeBroker, generate_private_key, make_certificate, private_key_pem
+)
+
+# (result path, whether higher is better) checked against a baseline
+CHECKS = [
+    (('throughput',), True),
+    (('latency_ms', 'p95'), False),
+    (('cpu_seconds',), False),
+]
+
+
+def make_config(args, port, ca_certs_path, private_key):
+    iot = {
+        'region': 'bench',
+        'project_id': 'bench-project',
+        'registry_id': 'bench-registry',
+        'device_id': 'bench01',
+        'private_key': private_key,
+        'ca_certs_path': ca_certs_path,
+        'host': 'localhost',
+        'port': port,
+        'encoding': args.encoding,
+    }
+    if args.batch:
+        iot['batch'] = {'max_messages': args.batch, 'linger': '0.1s'}
+    return {
+        'sensors': {
+            f'counter{i}': {
+                'device': 'counter', 'every': args.every, 'timestamp': True,
+            }
+            for i in range(args.sensors)
+        },
+        'iotcore': iot,
+    }
+
+
+def readings(received):
+    """(time read, time received) of each reading the broker received"""
+    for received_at, topic, payload in received:
+        subfolder = topic.split('/events')[-1].lstrip('/') or None
+        message = decode(payload, subfolder)
+        messages = message.get('messages', [message]) \
+            if message.get('type') == 'batch' else [message]
+        for m in messages:
+            value = m.get('value')
+            if isinstance(value, dict) and 'time' in value:
+                yield value['time'], received_at
+
+
+def run_pipeline(config, duration):
+    looper = Looper.from_config(asyncio.new_event_loop(), config)
+    iotcore = load_iotcore(looper, config)
+    sensors = load_sensors(config)
+    timer = threading.Timer(
+        duration, looper.loop.call_soon_threadsafe, [looper.stop]
+    )
+
+    before = resource.getrusage(resource.RUSAGE_SELF)
+    start = time.perf_counter()
+    timer.start()
+    run(looper, iotcore, sensors)
+    elapsed = time.perf_counter() - start
+    after = resource.getrusage(resource.RUSAGE_SELF)
+
+    cpu = (after.ru_utime - before.ru_utime) + \
+        (after.ru_stime - before.ru_stime)
+    return elapsed, cpu, after.ru_maxrss
+
+
+def measure(args):
+    with tempfile.TemporaryDirectory() as directory:
+        cert_path, key_path = make_certificate(directory)
+        broker = FakeBroker(cert_path, key_path)
+        broker.start()
+        try:
+            config = make_config(
+                args, broker.port, cert_path,
+                private_key_pem(generate_private_key())
+            )
+            elapsed, cpu, max_rss = run_pipeline(config, args.duration)
+            # let acknowledgements for the last publishes land
+            time.sleep(0.1)
+        finally:
+            broker.stop()
+
+    latencies = sorted(
+        received_at - read_at
+        for read_at, received_at in readings(broker.received)
+    )
+    expected = args.sensors * args.duration / parse_time(args.every)
+    return {
+        'benchmark': 'e2e',
+        'timestamp': datetime.datetime.utcnow().isoformat() + 'Z',
+        'python': platform.python_version(),
+        'config': {
+            'sensors': args.sensors,
+            'every': args.every,
+            'duration': args.duration,
+            'encoding': args.encoding,
+            'batch': args.batch,
+        },
+        'elapsed': elapsed,
+        'messages': len(broker.received),
+        'readings': len(latencies),
+        'expected_readings': expected,
+        'throughput': len(latencies) / elapsed,
+        'latency_ms': {
+            f'p{p}': percentile(latencies, p) * 1000 if latencies else None
+            for p in (50, 95, 99, 100)
+        },
+        'cpu_seconds': cpu,
+        'cpu_percent': 100 * cpu / elapsed,
+        # kilobytes on Linux
+        'max_rss_mb': max_rss / 1024,
+    }
+
+
+def lookup(result, path):
+    for key in path:
+        result = result[key]
+    return result
+
+
+def compare(result, baseline, tolerance):
+    """Print the change from the baseline, returning the regressions"""
+    regressions = []
+    for path, higher_is_better in CHECKS:
+        name = '.'.join(path)
+        new, old = lookup(result, path), lookup(baseline, path)
+        if new is None or not old:
+            continue
+        change = (new - old) / old
+        print(f'{name:<20} {old:12.3f} -> {new:12.3f} {change:+8.1%}')
+        if (-change if higher_is_better else change) > tolerance:
+            regressions.append(name)
+    return regressions
+
+
+def report(result):
+    latency = result['latency_ms']
+    print(f'{result["readings"]:,} of {result["expected_readings"]:,.0f} '
+          f'readings in {result["messages"]:,} messages over '
+          f'{result["elapsed"]:.1f}s')
+    print(f'throughput {result["throughput"]:12,.1f} readings/s')
+    if result['readings']:
+        print(f'latency    p50 {latency["p50"]:.2f}ms '
+              f'p95 {latency["p95"]:.2f}ms p99 {latency["p99"]:.2f}ms '
+              f'max {latency["p100"]:.2f}ms')
+    print(f'cpu        {result["cpu_seconds"]:.2f}s '
+          f'({result["cpu_percent"]:.1f}%)')
+    print(f'max rss    {result["max_rss_mb"]:.1f}MB')
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(
+        description='Benchmark the pipeline against a fake broker')
+    parser.add_argument('--sensors', type=int, default=200)
+    parser.add_argument('--every', default='1s')
+    parser.add_argument('--duration', type=float, default=10.0)
+    parser.add_argument('--encoding', choices=['json', 'msgpack'],
+                        default='json')
+    parser.add_argument('--batch', type=int, default=0,
+                        help='Batch up to this many messages')
+    parser.add_argument('--output', default='bench_e2e.json')
+    parser.add_argument('--baseline',
+                        help='Results of an earlier run to compare with')
+    parser.add_argument('--tolerance', type=float, default=0.2)
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+    set_up_logging('WARNING')
+
+    result = measure(args)
+    report(result)
+    with open(args.output, 'w') as f:
+        json.dump(result, f, indent=2)
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            regressions = compare(result, json.load(f), args.tolerance)
+        if regressions:
+            print(f'Regressed: {", ".join(regressions)}')
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,124 @@
+"""Microbenchmark for the Looper queues
+
+    python -m benchmarks.bench_queue [-n ITEMS]
+
+Reports the per item cost of moving items through a queue with a single
+consumer, as used by `send_queue` and `config_queue`. If janus is installed
+the previous janus backed queue is measured for comparison.
+"""
+import argparse
+import asyncio
+import threading
+import time
+
+from bobnet_sensors.async_helper import StopEvent, Queue
+
+try:
+    import janus
+except ImportError:
+    janus = None
+
+
+class JanusQueue:
+    """The janus backed queue that Looper used before Queue"""
+    def __init__(self, loop, stop_event):
+        self.loop = loop
+        self.queue = janus.Queue(loop=loop)
+        self.stop_event = stop_event
+
+    def sync_put(self, item):
+        if not self.stop_event.stopping:
+            self.queue.sync_q.put(item)
+
+    async def put(self, item):
+        if not self.stop_event.stopping:
+            return await self.queue.async_q.put(item)
+
+    async def get(self):
+        if not self.stop_event.stopping:
+            get_task = self.loop.create_task(self.queue.async_q.get())
+            stop_task = self.loop.create_task(self.stop_event.wait_async())
+            complete, pending = await asyncio.wait(
+                [get_task, stop_task],
+                loop=self.loop, return_when=asyncio.FIRST_COMPLETED
+            )
+            task = complete.pop()
+            if task == get_task:
+                stop_task.cancel()
+                return get_task.result()
+            else:
+                get_task.cancel()
+
+
+async def async_producer(queue, n):
+    for i in range(n):
+        await queue.put(i)
+        if i % 100 == 0:
+            # let the consumer run as a sensor would between readings
+            await asyncio.sleep(0)
+
+
+def thread_producer(queue, n):
+    for i in range(n):
+        queue.sync_put(i)
+
+
+async def consume(queue, n):
+    for _ in range(n):
+        await queue.get()
+
+
+async def consume_many(queue, n, max_n=100):
+    received = 0
+    while received < n:
+        received += len(await queue.get_many(max_n))
+
+
+def measure(queue_class, n, producer, consumer):
+    loop = asyncio.new_event_loop()
+    queue = queue_class(loop, StopEvent(loop))
+    start = time.perf_counter()
+    if producer == 'async':
+        loop.run_until_complete(asyncio.gather(
+            async_producer(queue, n), consumer(queue, n), loop=loop
+        ))
+    else:
+        thread = threading.Thread(target=thread_producer, args=(queue, n))
+        thread.start()
+        loop.run_until_complete(consumer(queue, n))
+        thread.join()
+    elapsed = time.perf_counter() - start
+    loop.close()
+    return elapsed
+
+
+def report(name, n, elapsed):
+    print(f'{name:<28} {elapsed / n * 1e6:8.2f} us/item '
+          f'{n / elapsed:12,.0f} items/s')
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='Benchmark Looper queues')
+    parser.add_argument('-n', '--items', type=int, default=100000)
+    return parser.parse_args()
+
+
+def main():
+    n = parse_args().items
+    cases = [
+        ('Queue async get', Queue, 'async', consume),
+        ('Queue async get_many', Queue, 'async', consume_many),
+        ('Queue thread get', Queue, 'thread', consume),
+        ('Queue thread get_many', Queue, 'thread', consume_many),
+    ]
+    if janus is not None:
+        cases += [
+            ('janus async get', JanusQueue, 'async', consume),
+            ('janus thread get', JanusQueue, 'thread', consume),
+        ]
+    for name, queue_class, producer, consumer in cases:
+        report(name, n, measure(queue_class, n, producer, consumer))
+
+
+if __name__ == '__main__':
+    main()
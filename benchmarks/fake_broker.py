@@ -0,0 +1,203 @@
+"""An in-process stand-in for the IoT Core MQTT bridge
+
+Speaks enough MQTT 3.1.1 over TLS for the device client: CONNECT,
+SUBSCRIBE, PUBLISH at QoS 0 and 1, PINGREQ and DISCONNECT. The broker runs
+its own event loop in a thread and records when each PUBLISH arrives so a
+benchmark can measure the pipeline without a network or the real bridge.
+"""
+import asyncio
+import datetime
+import ipaddress
+import os
+import ssl
+import struct
+import threading
+import time
+
+from cryptography import x509
+from cryptography.hazmat.backends import default_backend
+from cryptography.hazmat.primitives import hashes, serialization
+from cryptography.hazmat.primitives.asymmetric import rsa
+from cryptography.x509.oid import NameOID
+
+CONNECT = 1
+PUBLISH = 3
+SUBSCRIBE = 8
+PINGREQ = 12
+DISCONNECT = 14
+
+
+def generate_private_key():
+    return rsa.generate_private_key(
+        public_exponent=65537, key_size=2048, backend=default_backend()
+    )
+
+
+def private_key_pem(key):
+    return key.private_bytes(
+        encoding=serialization.Encoding.PEM,
+        format=serialization.PrivateFormat.PKCS8,
+        encryption_algorithm=serialization.NoEncryption(),
+    ).decode('ascii')
+
+
+def make_certificate(directory):
+    """Write a self-signed certificate for localhost
+
+    Returns the paths of the certificate, which clients also use as their
+    CA certificate, and of its key.
+    """
+    key = generate_private_key()
+    name = x509.Name([x509.NameAttribute(NameOID.COMMON_NAME, 'localhost')])
+    now = datetime.datetime.utcnow()
+    certificate = x509.CertificateBuilder().subject_name(
+        name
+    ).issuer_name(
+        name
+    ).public_key(
+        key.public_key()
+    ).serial_number(
+        x509.random_serial_number()
+    ).not_valid_before(
+        now - datetime.timedelta(minutes=5)
+    ).not_valid_after(
+        now + datetime.timedelta(days=1)
+    ).add_extension(
+        x509.SubjectAlternativeName([
+            x509.DNSName('localhost'),
+            x509.IPAddress(ipaddress.ip_address('127.0.0.1')),
+        ]),
+        critical=False,
+    ).add_extension(
+        x509.BasicConstraints(ca=True, path_length=None), critical=True,
+    ).sign(key, hashes.SHA256(), default_backend())
+
+    cert_path = os.path.join(directory, 'broker-cert.pem')
+    key_path = os.path.join(directory, 'broker-key.pem')
+    with open(cert_path, 'wb') as f:
+        f.write(certificate.public_bytes(serialization.Encoding.PEM))
+    with open(key_path, 'w') as f:
+        f.write(private_key_pem(key))
+    return cert_path, key_path
+
+
+async def read_packet(reader):
+    header = await reader.readexactly(1)
+    length = 0
+    multiplier = 1
+    while True:
+        byte = (await reader.readexactly(1))[0]
+        length += (byte & 0x7f) * multiplier
+        if not byte & 0x80:
+            break
+        multiplier *= 128
+    body = await reader.readexactly(length) if length else b''
+    return header[0] >> 4, header[0] & 0x0f, body
+
+
+class FakeBroker:
+    """Accepts connections on `host` and acknowledges what it is sent
+
+    `received` holds a (time, topic, payload) tuple for each PUBLISH, in
+    the order they arrived.
+    """
+    def __init__(self, certfile, keyfile, host='localhost', port=0):
+        self.host = host
+        self.port = port
+        self.received = []
+        self.connections = 0
+        self._context = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+        self._context.load_cert_chain(certfile, keyfile)
+        self._loop = asyncio.new_event_loop()
+        self._started = threading.Event()
+        self._thread = None
+        self._server = None
+        self._handlers = set()
+
+    def start(self):
+        self._thread = threading.Thread(
+            target=self._run, name='fake-broker', daemon=True
+        )
+        self._thread.start()
+        self._started.wait()
+
+    def stop(self):
+        asyncio.run_coroutine_threadsafe(
+            self._shutdown(), self._loop
+        ).result()
+        self._loop.call_soon_threadsafe(self._loop.stop)
+        self._thread.join()
+
+    async def _shutdown(self):
+        self._server.close()
+        for handler in self._handlers:
+            handler.cancel()
+        await asyncio.gather(
+            *self._handlers, loop=self._loop, return_exceptions=True
+        )
+        await self._server.wait_closed()
+        # let the transports finish closing
+        await asyncio.sleep(0.01, loop=self._loop)
+
+    def _run(self):
+        asyncio.set_event_loop(self._loop)
+        self._server = self._loop.run_until_complete(asyncio.start_server(
+            self.handle, self.host, self.port, ssl=self._context,
+            loop=self._loop
+        ))
+        self.port = self._server.sockets[0].getsockname()[1]
+        self._started.set()
+        try:
+            self._loop.run_forever()
+        finally:
+            self._loop.close()
+
+    async def handle(self, reader, writer):
+        self.connections += 1
+        handler = asyncio.Task.current_task(loop=self._loop)
+        self._handlers.add(handler)
+        try:
+            while True:
+                packet_type, flags, body = await read_packet(reader)
+                if packet_type == CONNECT:
+                    writer.write(b'\x20\x02\x00\x00')
+                elif packet_type == PUBLISH:
+                    self._publish(flags, body, writer)
+                elif packet_type == SUBSCRIBE:
+                    writer.write(self._suback(body))
+                elif packet_type == PINGREQ:
+                    writer.write(b'\xd0\x00')
+                elif packet_type == DISCONNECT:
+                    break
+        except (asyncio.IncompleteReadError, ConnectionError,
+                asyncio.CancelledError):
+            pass
+        finally:
+            self._handlers.discard(handler)
+            writer.close()
+
+    def _publish(self, flags, body, writer):
+        now = time.time()
+        qos = (flags >> 1) & 0x03
+        topic_length, = struct.unpack_from('>H', body)
+        topic = body[2:2 + topic_length].decode('utf8')
+        offset = 2 + topic_length
+        if qos:
+            packet_id = body[offset:offset + 2]
+            offset += 2
+            writer.write(b'\x40\x02' + packet_id)
+        self.received.append((now, topic, body[offset:]))
+
+    def _suback(self, body):
+        packet_id = body[:2]
+        granted = bytearray()
+        offset = 2
+        while offset < len(body):
+            topic_length, = struct.unpack_from('>H', body, offset)
+            offset += 2 + topic_length
+            granted.append(min(body[offset], 1))
+            offset += 1
+        return bytes([0x90, 2 + len(granted)]) + packet_id + bytes(granted)
+
+    def __repr__(self):
+        return f'<FakeBroker {self.host}:{self.port}>'
@@ -0,0 +1,131 @@
+import math
+
+from .config import parse_time
+from .filters import is_number
+
+
+def percentile(ordered, p):
+    """Linearly interpolated percentile of sorted samples"""
+    position = (len(ordered) - 1) * p / 100
+    lower = math.floor(position)
+    upper = math.ceil(position)
+    if lower == upper:
+        return ordered[lower]
+    fraction = position - lower
+    return ordered[lower] + (ordered[upper] - ordered[lower]) * fraction
+
+
+class Summary:
+    """Running statistics for the samples of one value in a window
+
+    The mean and variance are updated with Welford's method so no samples
+    are kept unless percentiles are wanted. Values that are not numbers,
+    like RGB tuples, are only counted and the last one kept.
+    """
+    def __init__(self, percentiles=()):
+        self.percentiles = percentiles
+        self.count = 0
+        self.last = None
+        self._numeric = 0
+        self._min = None
+        self._max = None
+        self._mean = 0.0
+        self._m2 = 0.0
+        self._samples = [] if percentiles else None
+
+    def add(self, value):
+        self.count += 1
+        self.last = value
+        if not is_number(value):
+            return
+        self._numeric += 1
+        if self._min is None or value < self._min:
+            self._min = value
+        if self._max is None or value > self._max:
+            self._max = value
+        delta = value - self._mean
+        self._mean += delta / self._numeric
+        self._m2 += delta * (value - self._mean)
+        if self._samples is not None:
+            self._samples.append(value)
+
+    def as_dict(self):
+        result = {'count': self.count, 'last': self.last}
+        if self._numeric:
+            result.update({
+                'min': self._min,
+                'max': self._max,
+                'mean': self._mean,
+                'stddev': math.sqrt(self._m2 / self._numeric),
+            })
+            if self._samples:
+                ordered = sorted(self._samples)
+                for p in self.percentiles:
+                    result[f'p{p:g}'] = percentile(ordered, p)
+        return result
+
+
+class Aggregator:
+    """Summarise the readings of a sensor over fixed windows
+
+    Readings are added as they are sampled and a summary is returned by
+    `add` once a reading arrives after the end of the current window.
+    Windows follow each other at fixed boundaries unless sampling stalls for
+    longer than a window, when the next one starts from the late reading.
+    Multi-channel readings are summarised label by label.
+    """
+    @staticmethod
+    def from_config(config):
+        percentiles = config.get('percentiles', [])
+        for p in percentiles:
+            if not 0 <= p <= 100:
+                raise ValueError(f'Invalid percentile {p}')
+        window = parse_time(config['window'])
+        if window <= 0:
+            raise ValueError(f'Invalid window {config["window"]}')
+        return Aggregator(window, tuple(percentiles))
+
+    def __init__(self, window, percentiles=()):
+        self.window = window
+        self.percentiles = percentiles
+        self._end = None
+        self._summary = None
+
+    def add(self, value, now):
+        """Add a reading, returning the summary of a finished window"""
+        result = None
+        if self._end is None:
+            self._end = now + self.window
+        elif now >= self._end:
+            result = self.flush()
+            self._end += self.window
+            if now >= self._end:
+                self._end = now + self.window
+
+        if isinstance(value, dict):
+            if not isinstance(self._summary, dict):
+                self._summary = {}
+            for label, v in value.items():
+                if label not in self._summary:
+                    self._summary[label] = Summary(self.percentiles)
+                self._summary[label].add(v)
+        else:
+            if not isinstance(self._summary, Summary):
+                self._summary = Summary(self.percentiles)
+            self._summary.add(value)
+        return result
+
+    def flush(self):
+        """Summary of the readings added since the last flush"""
+        summary, self._summary = self._summary, None
+        if isinstance(summary, dict):
+            return {
+                label: label_summary.as_dict()
+                for label, label_summary in summary.items()
+            }
+        elif summary is not None:
+            return summary.as_dict()
+
+    def __repr__(self):
+        return (f'<Aggregator window={self.window} '
+                f'percentiles={self.percentiles}>')
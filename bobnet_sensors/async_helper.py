@@ -1,21 +1,43 @@
 import asyncio
+import collections
+from concurrent.futures import ThreadPoolExecutor
+import selectors
 import threading
 
-import janus
+from . import clock
+from .metrics import Registry
+
+
+BLOCK = 'block'
+DROP_OLDEST = 'drop_oldest'
+CONFLATE = 'conflate'
+POLICIES = (BLOCK, DROP_OLDEST, CONFLATE)
+
+
+def reading_sensor(item):
+    """Name of the sensor for a reading, None for other messages"""
+    if isinstance(item, dict):
+        return item.get('sensor')
 
 
 class StopEvent:
     def __init__(self, loop: asyncio.AbstractEventLoop):
         self.async_event = asyncio.Event(loop=loop)
         self.sync_event = threading.Event()
+        self._callbacks = []
 
     @property
     def stopping(self):
         return self.sync_event.is_set()
 
+    def add_callback(self, callback):
+        self._callbacks.append(callback)
+
     def stop(self):
         self.sync_event.set()
         self.async_event.set()
+        for callback in self._callbacks:
+            callback()
 
     def wait_async(self):
         return self.async_event.wait()
@@ -24,6 +46,70 @@ class StopEvent:
         return self.sync_event.wait(timeout)
 
 
+class VirtualSelector(selectors.BaseSelector):
+    """A selector that advances a virtual clock instead of sleeping
+
+    While calls are running on the executor it waits for real, as their
+    results arrive through the loop's self-pipe.
+    """
+    def __init__(self, clock):
+        self.clock = clock
+        self.busy = 0
+        self._selector = selectors.DefaultSelector()
+
+    def register(self, fileobj, events, data=None):
+        return self._selector.register(fileobj, events, data)
+
+    def unregister(self, fileobj):
+        return self._selector.unregister(fileobj)
+
+    def modify(self, fileobj, events, data=None):
+        return self._selector.modify(fileobj, events, data)
+
+    def select(self, timeout=None):
+        if timeout is not None and timeout <= 0:
+            return self._selector.select(0)
+        if timeout is None or self.busy:
+            return self._selector.select(None)
+        events = self._selector.select(0)
+        if not events:
+            self.clock.advance(timeout)
+        return events
+
+    def close(self):
+        self._selector.close()
+
+    def get_map(self):
+        return self._selector.get_map()
+
+
+class VirtualEventLoop(asyncio.SelectorEventLoop):
+    """An event loop on a `VirtualClock` where timers fire without waiting
+
+    When nothing is ready to run the clock jumps to the next timer, so
+    sleeps, timeouts and schedules take no real time. Calls on an executor
+    take no virtual time: the loop waits for them for real before moving
+    the clock on. A `Looper` on this loop makes its clock the clock of the
+    `clock` module until it is closed.
+    """
+    def __init__(self, start=None):
+        self.clock = clock.VirtualClock(start)
+        self._virtual_selector = VirtualSelector(self.clock)
+        super().__init__(self._virtual_selector)
+
+    def time(self):
+        return self.clock.monotonic()
+
+    def run_in_executor(self, executor, func, *args):
+        future = super().run_in_executor(executor, func, *args)
+        self._virtual_selector.busy += 1
+        future.add_done_callback(self._executor_done)
+        return future
+
+    def _executor_done(self, future):
+        self._virtual_selector.busy -= 1
+
+
 class Looper:
     """Async helper class
 
@@ -32,16 +118,61 @@ class Looper:
     """
     loop: asyncio.AbstractEventLoop
 
-    config_queue: janus.Queue
-    send_queue: janus.Queue
+    config_queue: 'Queue'
+    send_queue: 'Queue'
 
     stop_event: StopEvent
 
-    def __init__(self, loop: asyncio.AbstractEventLoop):
+    executor: ThreadPoolExecutor
+
+    metrics: Registry
+
+    @staticmethod
+    def virtual(config=None, start=None):
+        """A looper on a `VirtualEventLoop` starting at `start`"""
+        return Looper.from_config(VirtualEventLoop(start), config or {})
+
+    @staticmethod
+    def from_config(loop, config):
+        queue_config = config.get('send_queue', {})
+        return Looper(
+            loop,
+            send_queue_size=queue_config.get('capacity', 0),
+            send_queue_policy=queue_config.get('policy', BLOCK),
+            read_threads=config.get('read_threads'),
+        )
+
+    def __init__(self, loop: asyncio.AbstractEventLoop,
+                 send_queue_size=0, send_queue_policy=BLOCK,
+                 read_threads=None):
         self.loop = loop
         self.stop_event = StopEvent(loop=loop)
         self.config_queue = Queue(loop, self.stop_event)
-        self.send_queue = Queue(loop, self.stop_event)
+        self.send_queue = Queue(
+            loop, self.stop_event,
+            maxsize=send_queue_size, policy=send_queue_policy
+        )
+        # None leaves the pool size to ThreadPoolExecutor
+        self.executor = ThreadPoolExecutor(
+            max_workers=read_threads, thread_name_prefix='bobnet-read'
+        )
+        self._real_clock = None
+        if isinstance(loop, VirtualEventLoop):
+            self._real_clock = clock.set_clock(loop.clock)
+
+        self.metrics = Registry()
+        depth = self.metrics.gauge(
+            'bobnet_queue_depth', 'Items waiting in a queue', ['queue']
+        )
+        dropped = self.metrics.counter(
+            'bobnet_queue_dropped_total', 'Items dropped from a full queue',
+            ['queue']
+        )
+        for name, queue in [('send', self.send_queue),
+                            ('config', self.config_queue)]:
+            depth.set_function(queue.qsize, queue=name)
+            dropped.set_function(lambda queue=queue: queue.dropped,
+                                 queue=name)
 
     @property
     def stopping(self):
@@ -50,6 +181,20 @@ class Looper:
     def stop(self):
         self.stop_event.stop()
 
+    def close(self):
+        self.executor.shutdown(wait=False)
+        if self._real_clock is not None:
+            clock.set_clock(self._real_clock)
+            self._real_clock = None
+
+    def run_blocking(self, func, *args):
+        """Run a blocking call on the executor
+
+        Returns an asyncio future for the result. Cancelling the future does
+        not interrupt a call that has already started.
+        """
+        return self.loop.run_in_executor(self.executor, func, *args)
+
     async def wait_for(self, timeout):
         try:
             await asyncio.wait_for(
@@ -62,37 +207,180 @@ class Looper:
 
 
 class Queue:
+    """Stop aware queue for the event loop
+
+    Items can be put from coroutines on the loop or, with `sync_put`, from
+    other threads which hand them over to the loop. A consumer waiting on an
+    empty queue parks a single future that is resolved by the next put, by
+    its timeout or when the stop event is set.
+
+    With a `maxsize` the policy decides what happens when the queue is full:
+
+    block
+      producers wait for space
+    drop_oldest
+      the oldest item is dropped
+    conflate
+      the queued reading from the same sensor is replaced, or failing that
+      the oldest reading is dropped. Other messages are never dropped.
+    """
     def __init__(self,
                  loop: asyncio.AbstractEventLoop,
-                 stop_event: StopEvent):
+                 stop_event: StopEvent,
+                 maxsize=0, policy=BLOCK):
+        if policy not in POLICIES:
+            raise ValueError(f'Invalid queue policy {policy}')
         self.loop = loop
-        self.queue = janus.Queue(loop=loop)
         self.stop_event = stop_event
+        self.maxsize = maxsize
+        self.policy = policy
+        self.dropped = 0
+        self._items = collections.deque()
+        self._getters = collections.deque()
+        self._putters = collections.deque()
+        stop_event.add_callback(self._on_stop)
+
+    def qsize(self):
+        return len(self._items)
+
+    def empty(self):
+        return not self._items
+
+    def full(self):
+        return 0 < self.maxsize <= len(self._items)
 
     def sync_put(self, item):
-        if not self.stop_event.stopping:
-            self.queue.sync_q.put(item)
+        if self.stop_event.stopping:
+            return
+        if self.maxsize and self.policy == BLOCK:
+            asyncio.run_coroutine_threadsafe(
+                self.put(item), self.loop
+            ).result()
+        else:
+            self.loop.call_soon_threadsafe(self.put_nowait, item)
 
     async def put(self, item):
-        if not self.stop_event.stopping:
-            return await self.queue.async_q.put(item)
+        if self.policy == BLOCK:
+            while self.full() and not self.stop_event.stopping:
+                waiter = self.loop.create_future()
+                self._putters.append(waiter)
+                try:
+                    await waiter
+                except asyncio.CancelledError:
+                    self._discard(self._putters, waiter, not self.full())
+                    raise
+        self.put_nowait(item)
 
-    async def get(self):
-        if not self.stop_event.stopping:
-            get_task = self.loop.create_task(
-                self.queue.async_q.get()
-            )
-            stop_task = self.loop.create_task(
-                self.stop_event.wait_async()
-            )
-            complete, pending = await asyncio.wait(
-                [get_task, stop_task],
-                loop=self.loop, return_when=asyncio.FIRST_COMPLETED
-            )
-            task = complete.pop()
-
-            if task == get_task:
-                stop_task.cancel()
-                return get_task.result()
+    def put_nowait(self, item):
+        if self.stop_event.stopping:
+            return
+        if self.full():
+            if self.policy == BLOCK:
+                raise asyncio.QueueFull
+            elif self.policy == DROP_OLDEST:
+                self._items.popleft()
+                self.dropped += 1
             else:
-                get_task.cancel()
+                self._conflate(item)
+        self._items.append(item)
+        self._wakeup_next(self._getters)
+
+    def _conflate(self, item):
+        sensor = reading_sensor(item)
+        oldest = None
+        for i, queued in enumerate(self._items):
+            queued_sensor = reading_sensor(queued)
+            if queued_sensor is None:
+                continue
+            if sensor is not None and queued_sensor == sensor:
+                oldest = i
+                break
+            if oldest is None:
+                oldest = i
+        if oldest is not None:
+            del self._items[oldest]
+            self.dropped += 1
+
+    def get_nowait(self):
+        if not self._items:
+            raise asyncio.QueueEmpty
+        return self._pop()
+
+    async def get(self, timeout=None):
+        if await self._wait_for_items(timeout):
+            return self._pop()
+
+    async def get_many(self, max_n, timeout=None):
+        """Get at least one and at most `max_n` items
+
+        Returns an empty list if the queue is stopped or the timeout expires
+        before an item arrives.
+        """
+        items = []
+        if await self._wait_for_items(timeout):
+            while self._items and len(items) < max_n:
+                items.append(self._items.popleft())
+            for _ in items:
+                self._wakeup_next(self._putters)
+        return items
+
+    def _pop(self):
+        item = self._items.popleft()
+        self._wakeup_next(self._putters)
+        return item
+
+    async def _wait_for_items(self, timeout):
+        deadline = None
+        if timeout is not None:
+            deadline = self.loop.time() + timeout
+
+        while not self.stop_event.stopping:
+            if self._items:
+                return True
+
+            waiter = self.loop.create_future()
+            self._getters.append(waiter)
+            timer = None
+            if deadline is not None:
+                timer = self.loop.call_at(deadline, self._expire, waiter)
+            try:
+                expired = await waiter
+            except asyncio.CancelledError:
+                self._discard(self._getters, waiter, self._items)
+                raise
+            finally:
+                if timer is not None:
+                    timer.cancel()
+            if expired:
+                return False
+        return False
+
+    def _expire(self, waiter):
+        if not waiter.done():
+            self._getters.remove(waiter)
+            waiter.set_result(True)
+
+    def _discard(self, waiters, waiter, pass_on):
+        try:
+            waiters.remove(waiter)
+        except ValueError:
+            # already woken, pass the wake up on to the next waiter
+            if pass_on:
+                self._wakeup_next(waiters)
+
+    def _wakeup_next(self, waiters):
+        while waiters:
+            waiter = waiters.popleft()
+            if not waiter.done():
+                waiter.set_result(False)
+                break
+
+    def _wake_all(self):
+        for waiters in (self._getters, self._putters):
+            while waiters:
+                waiter = waiters.popleft()
+                if not waiter.done():
+                    waiter.set_result(False)
+
+    def _on_stop(self):
+        self.loop.call_soon_threadsafe(self._wake_all)
@@ -0,0 +1,306 @@
+import logging
+import os
+import re
+import struct
+import threading
+import zlib
+
+
+logger = logging.getLogger(__name__)
+
+# record length and crc32 of the record data
+RECORD_HEADER = struct.Struct('>II')
+SEGMENT_PATTERN = re.compile(r'^(\d{20})\.seg$')
+POSITION_FILE = 'position'
+
+
+class Segment:
+    def __init__(self, number, path, size=0, count=0):
+        self.number = number
+        self.path = path
+        self.size = size
+        self.count = count
+
+    def __repr__(self):
+        return f'<Segment number={self.number} count={self.count}>'
+
+
+def segment_name(number):
+    return f'{number:020d}.seg'
+
+
+def scan_records(f):
+    """Yield the end offset of each valid record in a segment file
+
+    Scanning stops at the first torn or corrupt record.
+    """
+    offset = 0
+    while True:
+        header = f.read(RECORD_HEADER.size)
+        if len(header) < RECORD_HEADER.size:
+            return
+        length, crc = RECORD_HEADER.unpack(header)
+        data = f.read(length)
+        if len(data) < length or zlib.crc32(data) != crc:
+            return
+        offset += RECORD_HEADER.size + length
+        yield offset
+
+
+class DiskBuffer:
+    """Append-only buffer of records kept in segment files
+
+    Records are appended to the newest segment until it reaches
+    `segment_bytes`, when a new segment is started. Once the segments take
+    up more than `max_bytes` the oldest segment is deleted, read or not.
+    The read position is saved on `commit` so records that have not been
+    forwarded survive a restart. `commit_to` can leave saving to a later
+    `save_position`, which may run on another thread.
+    """
+    @staticmethod
+    def from_config(config):
+        return DiskBuffer(
+            config['path'],
+            max_bytes=config.get('max_bytes', 64 * 1024 * 1024),
+            segment_bytes=config.get('segment_bytes', 1024 * 1024),
+            sync=config.get('sync', False),
+        )
+
+    def __init__(self, path, max_bytes=64 * 1024 * 1024,
+                 segment_bytes=1024 * 1024, sync=False):
+        if segment_bytes > max_bytes:
+            raise ValueError('segment_bytes must not exceed max_bytes')
+        self.path = path
+        self.max_bytes = max_bytes
+        self.segment_bytes = segment_bytes
+        self.sync = sync
+
+        os.makedirs(path, exist_ok=True)
+        self._save_lock = threading.Lock()
+        self._segments = self._load_segments()
+        self._load_position()
+        self._peeked = []
+        self._reader = None
+        self._writer = open(self._segments[-1].path, 'ab')
+
+    def _load_segments(self):
+        numbers = sorted(
+            int(match.group(1)) for match in
+            map(SEGMENT_PATTERN.match, os.listdir(self.path)) if match
+        )
+        segments = []
+        for number in numbers:
+            path = os.path.join(self.path, segment_name(number))
+            with open(path, 'r+b') as f:
+                offsets = list(scan_records(f))
+                size = offsets[-1] if offsets else 0
+                if size < os.path.getsize(path):
+                    logger.warning(f'Truncating damaged segment {path}')
+                    f.truncate(size)
+            segments.append(Segment(number, path, size, len(offsets)))
+
+        if not segments:
+            path = os.path.join(self.path, segment_name(0))
+            open(path, 'ab').close()
+            segments.append(Segment(0, path))
+        return segments
+
+    def _load_position(self):
+        number, offset = self._segments[0].number, 0
+        try:
+            with open(os.path.join(self.path, POSITION_FILE)) as f:
+                number, offset = map(int, f.read().split())
+        except (OSError, ValueError):
+            pass
+
+        segment = self._segment(number)
+        if segment is None:
+            segment, offset = self._segments[0], 0
+
+        read, read_offset = 0, 0
+        with open(segment.path, 'rb') as f:
+            for end in scan_records(f):
+                if end > offset:
+                    break
+                read, read_offset = read + 1, end
+        self._read_number = segment.number
+        self._read_offset = read_offset
+        self._read_count = read
+
+    @property
+    def position(self):
+        """The read position, in the form returned by `read`"""
+        return self._read_number, self._read_offset, self._read_count
+
+    def save_position(self, position=None):
+        """Write the read position, or an earlier `position`, to disk
+
+        Safe to call from another thread with a position taken on the thread
+        that commits.
+        """
+        number, offset, _ = position or self.position
+        path = os.path.join(self.path, POSITION_FILE)
+        with self._save_lock:
+            with open(path + '.tmp', 'w') as f:
+                f.write(f'{number} {offset}\n')
+                if self.sync:
+                    f.flush()
+                    os.fsync(f.fileno())
+            os.replace(path + '.tmp', path)
+
+    def _segment(self, number):
+        for segment in self._segments:
+            if segment.number == number:
+                return segment
+
+    def __len__(self):
+        unread = 0
+        for segment in self._segments:
+            if segment.number == self._read_number:
+                unread += segment.count - self._read_count
+            elif segment.number > self._read_number:
+                unread += segment.count
+        return unread
+
+    @property
+    def size(self):
+        return sum(segment.size for segment in self._segments)
+
+    def append(self, data):
+        record_size = RECORD_HEADER.size + len(data)
+        segment = self._segments[-1]
+        if segment.size and segment.size + record_size > self.segment_bytes:
+            self._roll()
+            segment = self._segments[-1]
+
+        self._writer.write(RECORD_HEADER.pack(len(data), zlib.crc32(data)))
+        self._writer.write(data)
+        self._writer.flush()
+        if self.sync:
+            os.fsync(self._writer.fileno())
+        segment.size += record_size
+        segment.count += 1
+
+        while self.size > self.max_bytes and len(self._segments) > 1:
+            self._evict()
+
+    def _roll(self):
+        self._writer.close()
+        number = self._segments[-1].number + 1
+        path = os.path.join(self.path, segment_name(number))
+        self._segments.append(Segment(number, path))
+        self._writer = open(path, 'ab')
+
+    def _evict(self):
+        segment = self._segments.pop(0)
+        if segment.number >= self._read_number:
+            dropped = segment.count
+            if segment.number == self._read_number:
+                dropped -= self._read_count
+            logger.warning(
+                f'Buffer full, dropped {dropped} unsent records'
+            )
+            self._move_to(self._segments[0].number)
+        self._remove(segment)
+
+    def _move_to(self, number):
+        self._close_reader()
+        self._read_number = number
+        self._read_offset = 0
+        self._read_count = 0
+        self._peeked = []
+        self.save_position()
+
+    def _remove(self, segment):
+        if self._reader and self._reader_number == segment.number:
+            self._close_reader()
+        try:
+            os.remove(segment.path)
+        except FileNotFoundError:
+            pass
+
+    def _close_reader(self):
+        if self._reader:
+            self._reader.close()
+            self._reader = None
+
+    def peek(self, max_n):
+        """Read up to `max_n` records from the read position
+
+        The records stay in the buffer until they are committed.
+        """
+        entries = self.read(max_n)
+        self._peeked = [position for _, position in entries]
+        return [record for record, _ in entries]
+
+    def read(self, max_n, after=None):
+        """Read up to `max_n` records with the position after each
+
+        Reading starts from the position `after`, as returned by an earlier
+        read, or from the read position if `after` has been committed or
+        evicted since.
+        """
+        entries = []
+        number = self._read_number
+        offset, count = self._read_offset, self._read_count
+        if after is not None and not self._behind(after):
+            number, offset, count = after
+        for segment in self._segments:
+            if segment.number < number:
+                continue
+            if segment.number > number:
+                number, offset, count = segment.number, 0, 0
+            f = self._open_reader(segment)
+            f.seek(offset)
+            while offset < segment.size and len(entries) < max_n:
+                length, _ = RECORD_HEADER.unpack(f.read(RECORD_HEADER.size))
+                record = f.read(length)
+                offset += RECORD_HEADER.size + length
+                count += 1
+                entries.append((record, (number, offset, count)))
+            if len(entries) >= max_n:
+                break
+        return entries
+
+    def _behind(self, position):
+        number, offset, _ = position
+        return (number, offset) <= (self._read_number, self._read_offset)
+
+    def _open_reader(self, segment):
+        if not self._reader or self._reader_number != segment.number:
+            self._close_reader()
+            self._reader = open(segment.path, 'rb')
+            self._reader_number = segment.number
+        return self._reader
+
+    def commit(self, n):
+        """Mark the first `n` records from the last peek as forwarded"""
+        if not n or not self._peeked:
+            # nothing sent or the peeked records were evicted since
+            return
+        position = self._peeked[min(n, len(self._peeked)) - 1]
+        del self._peeked[:n]
+        self.commit_to(position)
+
+    def commit_to(self, position, save=True):
+        """Mark the records up to `position`, from `read`, as forwarded
+
+        Positions that have been committed or evicted are ignored. Without
+        `save` the new position is lost on a restart until `save_position`
+        is called.
+        """
+        if self._behind(position):
+            return
+        self._read_number, self._read_offset, self._read_count = position
+
+        while self._segments[0].number < self._read_number:
+            self._remove(self._segments.pop(0))
+        if save:
+            self.save_position()
+
+    def close(self):
+        self._close_reader()
+        self._writer.close()
+
+    def __repr__(self):
+        return f'<DiskBuffer path={self.path} records={len(self)}>'
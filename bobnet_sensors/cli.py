@@ -4,6 +4,7 @@ import logging
 
 from .config import load_config
 from .iotcore import load_iotcore
+from .metrics import load_metrics
 from .sensors import load_sensors
 from .main import run
 from .async_helper import Looper
@@ -36,8 +37,9 @@ def main():
 
     set_up_logging(args.log_level)
 
-    looper = Looper(asyncio.new_event_loop())
+    looper = Looper.from_config(asyncio.new_event_loop(), c)
     iotcore = load_iotcore(looper, c)
     sensors = load_sensors(c)
+    exporter = load_metrics(c)
 
-    run(looper, iotcore, sensors)
+    run(looper, iotcore, sensors, exporter)
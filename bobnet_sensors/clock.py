@@ -0,0 +1,78 @@
+"""The clock for timestamps, token expiry and command acknowledgements
+
+Code that needs the time asks this module rather than `time` or
+`datetime`, so that a `VirtualClock` can stand in for the real one. The
+virtual clock only moves when it is advanced, which a `VirtualEventLoop`
+does whenever it would otherwise sleep until its next timer, so a day of
+sensor readings can be simulated in seconds.
+"""
+import datetime
+import time as _time
+
+
+class RealClock:
+    def time(self):
+        return _time.time()
+
+    def monotonic(self):
+        return _time.monotonic()
+
+    def utcnow(self):
+        return datetime.datetime.utcnow()
+
+    def __repr__(self):
+        return '<RealClock>'
+
+
+class VirtualClock:
+    """A clock that starts at `start` seconds since the epoch and stands
+    still until it is advanced
+
+    Its monotonic time is the number of seconds it has been advanced.
+    """
+    def __init__(self, start=None):
+        self.start = _time.time() if start is None else start
+        self.elapsed = 0.0
+
+    def advance(self, seconds):
+        if seconds < 0:
+            raise ValueError(f'Cannot go back {-seconds} seconds')
+        self.elapsed += seconds
+
+    def time(self):
+        return self.start + self.elapsed
+
+    def monotonic(self):
+        return self.elapsed
+
+    def utcnow(self):
+        return datetime.datetime.utcfromtimestamp(self.time())
+
+    def __repr__(self):
+        return f'<VirtualClock elapsed={self.elapsed}>'
+
+
+_clock = RealClock()
+
+
+def get_clock():
+    return _clock
+
+
+def set_clock(clock):
+    """Use `clock` for the time, returning the clock it replaces"""
+    global _clock
+    previous, _clock = _clock, clock
+    return previous
+
+
+def time():
+    return _clock.time()
+
+
+def monotonic():
+    return _clock.monotonic()
+
+
+def utcnow():
+    return _clock.utcnow()
@@ -1,6 +1,21 @@
+import re
+
 import yaml
 
 
 def load_config(path):
     with open(path) as f:
         return yaml.load(f)
+
+
+def parse_time(t):
+    match = re.match(r'^(\d+(?:\.\d+)?)(s|m|h)$', t)
+    if not match:
+        raise ValueError(f'Invalid time format {t}')
+    multipliers = {
+        's': 1,
+        'm': 60,
+        'h': 60 * 60,
+    }
+
+    return float(match.group(1)) * multipliers[match.group(2)]
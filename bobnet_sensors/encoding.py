@@ -0,0 +1,246 @@
+"""Wire formats for messages published to IoT Core
+
+JSON messages are published to the device's events topic. Other encodings
+are published to an events subfolder named after the encoding so that the
+ingestion side can pick the decoder from the subfolder, e.g.
+
+    from bobnet_sensors import encoding
+    message = encoding.decode(payload, attributes.get('subFolder'))
+"""
+import datetime
+import json
+import struct
+
+from .models import BaseMessage
+
+
+TIMESTAMP_FORMAT = '%Y-%m-%dT%H:%M:%S.%fZ'
+
+
+def encode_default(obj):
+    if isinstance(obj, BaseMessage):
+        return obj.as_json()
+    elif isinstance(obj, datetime.datetime):
+        return obj.strftime(TIMESTAMP_FORMAT)
+    raise TypeError(f'{obj!r} is not serializable')
+
+
+class Encoded(bytes):
+    """A payload that has already been encoded, it is published as it is"""
+
+
+class JSONEncoding:
+    name = 'json'
+    subfolder = None
+
+    def encode(self, message):
+        if isinstance(message, Encoded):
+            return message
+        return json.dumps(message, default=encode_default).encode('utf8')
+
+    def encode_batch(self, payloads):
+        """Encode a `BatchMessage` of messages this encoding encoded"""
+        return Encoded(
+            b'{"type": "batch", "messages": [' + b', '.join(payloads) + b']}'
+        )
+
+    def decode(self, payload):
+        return json.loads(payload.decode('utf8'))
+
+
+_FLOAT64 = struct.Struct('>Bd')
+
+
+class MessagePackEncoding:
+    """MessagePack encoding of messages
+
+    Supports the types that appear in messages: None, booleans, integers,
+    floats, strings, bytes, lists, tuples and dicts. Messages and datetimes
+    are converted in the same way as for JSON.
+    """
+    name = 'msgpack'
+    subfolder = 'msgpack'
+
+    def encode(self, message):
+        if isinstance(message, Encoded):
+            return message
+        out = bytearray()
+        self._pack(message, out)
+        return bytes(out)
+
+    def encode_batch(self, payloads):
+        """Encode a `BatchMessage` of messages this encoding encoded"""
+        out = bytearray()
+        self._pack({'type': 'batch', 'messages': []}, out)
+        # replace the empty array with one holding the payloads
+        del out[-1]
+        self._pack_header(len(payloads), out, 0x90, 16, None, 0xdc, 0xdd)
+        for payload in payloads:
+            out += payload
+        return Encoded(out)
+
+    def _pack(self, obj, out):
+        if obj is None:
+            out.append(0xc0)
+        elif obj is True:
+            out.append(0xc3)
+        elif obj is False:
+            out.append(0xc2)
+        elif isinstance(obj, int):
+            self._pack_int(obj, out)
+        elif isinstance(obj, float):
+            out += _FLOAT64.pack(0xcb, obj)
+        elif isinstance(obj, str):
+            data = obj.encode('utf8')
+            self._pack_header(len(data), out, 0xa0, 32, 0xd9, 0xda, 0xdb)
+            out += data
+        elif isinstance(obj, (bytes, bytearray)):
+            self._pack_header(len(obj), out, None, 0, 0xc4, 0xc5, 0xc6)
+            out += obj
+        elif isinstance(obj, (list, tuple)):
+            self._pack_header(len(obj), out, 0x90, 16, None, 0xdc, 0xdd)
+            for item in obj:
+                self._pack(item, out)
+        elif isinstance(obj, dict):
+            self._pack_header(len(obj), out, 0x80, 16, None, 0xde, 0xdf)
+            for key, value in obj.items():
+                self._pack(key, out)
+                self._pack(value, out)
+        else:
+            self._pack(encode_default(obj), out)
+
+    @staticmethod
+    def _pack_int(obj, out):
+        if 0 <= obj < 0x80 or -32 <= obj < 0:
+            out += struct.pack('>b' if obj < 0 else '>B', obj)
+        elif obj >= 0:
+            for code, fmt, limit in ((0xcc, '>BB', 1 << 8),
+                                     (0xcd, '>BH', 1 << 16),
+                                     (0xce, '>BI', 1 << 32),
+                                     (0xcf, '>BQ', 1 << 64)):
+                if obj < limit:
+                    out += struct.pack(fmt, code, obj)
+                    return
+            raise OverflowError(f'{obj} is too large to encode')
+        else:
+            for code, fmt, limit in ((0xd0, '>Bb', 1 << 7),
+                                     (0xd1, '>Bh', 1 << 15),
+                                     (0xd2, '>Bi', 1 << 31),
+                                     (0xd3, '>Bq', 1 << 63)):
+                if obj >= -limit:
+                    out += struct.pack(fmt, code, obj)
+                    return
+            raise OverflowError(f'{obj} is too small to encode')
+
+    @staticmethod
+    def _pack_header(length, out, fix, fix_limit, code8, code16, code32):
+        if length < fix_limit:
+            out.append(fix | length)
+        elif code8 is not None and length < 1 << 8:
+            out += struct.pack('>BB', code8, length)
+        elif length < 1 << 16:
+            out += struct.pack('>BH', code16, length)
+        else:
+            out += struct.pack('>BI', code32, length)
+
+    def decode(self, payload):
+        obj, offset = self._unpack(payload, 0)
+        if offset != len(payload):
+            raise ValueError('Trailing data after message')
+        return obj
+
+    def _unpack(self, data, offset):
+        code = data[offset]
+        offset += 1
+        if code <= 0x7f:
+            return code, offset
+        elif code >= 0xe0:
+            return code - 0x100, offset
+        elif 0x80 <= code <= 0x8f:
+            return self._unpack_map(data, offset, code & 0x0f)
+        elif 0x90 <= code <= 0x9f:
+            return self._unpack_array(data, offset, code & 0x0f)
+        elif 0xa0 <= code <= 0xbf:
+            return self._unpack_str(data, offset, code & 0x1f)
+        elif code == 0xc0:
+            return None, offset
+        elif code == 0xc2:
+            return False, offset
+        elif code == 0xc3:
+            return True, offset
+        elif code in _LENGTHS:
+            kind, fmt = _LENGTHS[code]
+            (length,) = struct.unpack_from(fmt, data, offset)
+            offset += struct.calcsize(fmt)
+            if kind == 'str':
+                return self._unpack_str(data, offset, length)
+            elif kind == 'bin':
+                return bytes(data[offset:offset + length]), offset + length
+            elif kind == 'array':
+                return self._unpack_array(data, offset, length)
+            else:
+                return self._unpack_map(data, offset, length)
+        elif code in _SCALARS:
+            fmt = _SCALARS[code]
+            (value,) = struct.unpack_from(fmt, data, offset)
+            return value, offset + struct.calcsize(fmt)
+        raise ValueError(f'Unsupported MessagePack type 0x{code:02x}')
+
+    @staticmethod
+    def _unpack_str(data, offset, length):
+        end = offset + length
+        return bytes(data[offset:end]).decode('utf8'), end
+
+    def _unpack_array(self, data, offset, length):
+        items = []
+        for _ in range(length):
+            item, offset = self._unpack(data, offset)
+            items.append(item)
+        return items, offset
+
+    def _unpack_map(self, data, offset, length):
+        items = {}
+        for _ in range(length):
+            key, offset = self._unpack(data, offset)
+            items[key], offset = self._unpack(data, offset)
+        return items, offset
+
+
+_LENGTHS = {
+    0xc4: ('bin', '>B'), 0xc5: ('bin', '>H'), 0xc6: ('bin', '>I'),
+    0xd9: ('str', '>B'), 0xda: ('str', '>H'), 0xdb: ('str', '>I'),
+    0xdc: ('array', '>H'), 0xdd: ('array', '>I'),
+    0xde: ('map', '>H'), 0xdf: ('map', '>I'),
+}
+_SCALARS = {
+    0xca: '>f', 0xcb: '>d',
+    0xcc: '>B', 0xcd: '>H', 0xce: '>I', 0xcf: '>Q',
+    0xd0: '>b', 0xd1: '>h', 0xd2: '>i', 0xd3: '>q',
+}
+
+JSON = JSONEncoding()
+MSGPACK = MessagePackEncoding()
+
+ENCODINGS = {
+    JSON.name: JSON,
+    MSGPACK.name: MSGPACK,
+}
+
+
+def get_encoding(name):
+    try:
+        return ENCODINGS[name]
+    except KeyError:
+        raise ValueError(f'Unknown encoding {name}')
+
+
+def for_subfolder(subfolder):
+    """Find the encoding for messages published to an events subfolder"""
+    for encoding in ENCODINGS.values():
+        if encoding.subfolder == subfolder:
+            return encoding
+    raise ValueError(f'No encoding for subfolder {subfolder}')
+
+
+def decode(payload, subfolder=None):
+    return for_subfolder(subfolder).decode(payload)
@@ -0,0 +1,98 @@
+"""Features of bursts of samples, like AC current or vibration
+
+Samples are NumPy arrays when NumPy is installed and the features are
+calculated with vectorised operations. Without NumPy any sequence of
+numbers works, but the spectral features are not available.
+"""
+import math
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+
+def require_numpy(feature):
+    if numpy is None:
+        raise ValueError(f'{feature} requires NumPy')
+
+
+def as_samples(samples):
+    if numpy is not None:
+        return numpy.asarray(samples, dtype=numpy.float64)
+    return [float(sample) for sample in samples]
+
+
+def remove_dc(samples):
+    """Samples centred on their mean, like an AC signal with a bias"""
+    if numpy is not None:
+        return samples - samples.mean()
+    mean = sum(samples) / len(samples)
+    return [sample - mean for sample in samples]
+
+
+def rms(samples):
+    if numpy is not None:
+        return float(numpy.sqrt(numpy.mean(numpy.square(samples))))
+    return math.sqrt(sum(sample * sample for sample in samples) / len(samples))
+
+
+def peak(samples):
+    if numpy is not None:
+        return float(numpy.max(numpy.abs(samples)))
+    return max(abs(sample) for sample in samples)
+
+
+def peak_to_peak(samples):
+    if numpy is not None:
+        return float(numpy.ptp(samples))
+    return max(samples) - min(samples)
+
+
+def crest_factor(samples):
+    value = rms(samples)
+    return peak(samples) / value if value else 0.0
+
+
+def spectrum(samples, rate):
+    """Frequencies and power of the samples without their DC component"""
+    power = numpy.abs(numpy.fft.rfft(samples - samples.mean())) ** 2
+    frequencies = numpy.fft.rfftfreq(len(samples), 1 / rate)
+    return frequencies, power
+
+
+def dominant_frequency(samples, rate):
+    frequencies, power = spectrum(samples, rate)
+    if len(power) < 2:
+        return 0.0
+    return float(frequencies[numpy.argmax(power[1:]) + 1])
+
+
+def band_energies(samples, rate, bands):
+    """Share of the signal's power in each (low, high) frequency band"""
+    frequencies, power = spectrum(samples, rate)
+    total = power.sum()
+    return [
+        float(power[(frequencies >= low) & (frequencies < high)].sum() /
+              total) if total else 0.0
+        for low, high in bands
+    ]
+
+
+def burst_features(samples, rate=None, frequency=False, ac=True):
+    """RMS, peak and crest factor, and the dominant frequency if wanted
+
+    With `ac` the mean is removed first so the features describe the
+    alternating part of the signal.
+    """
+    samples = as_samples(samples)
+    if ac:
+        samples = remove_dc(samples)
+    features = {
+        'rms': rms(samples),
+        'peak': peak(samples),
+        'crest': crest_factor(samples),
+    }
+    if frequency:
+        features['frequency'] = dominant_frequency(samples, rate)
+    return features
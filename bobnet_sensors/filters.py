@@ -0,0 +1,98 @@
+import numbers
+
+from .config import parse_time
+
+
+def is_number(value):
+    return isinstance(value, numbers.Real) and not isinstance(value, bool)
+
+
+class Band:
+    """Absolute and relative thresholds for a single value
+
+    A change is significant if it is larger than either threshold. With no
+    thresholds any change is significant.
+    """
+    @staticmethod
+    def from_config(config, default=None):
+        default = default or Band()
+        return Band(
+            absolute=config.get('absolute', default.absolute),
+            relative=config.get('relative', default.relative),
+        )
+
+    def __init__(self, absolute=None, relative=None):
+        self.absolute = absolute
+        self.relative = relative
+
+    def exceeded(self, value, last):
+        if is_number(value) and is_number(last):
+            change = abs(value - last)
+            if self.absolute is None and self.relative is None:
+                return change > 0
+            return (
+                (self.absolute is not None and change > self.absolute) or
+                (self.relative is not None and
+                 change > self.relative * abs(last))
+            )
+        elif isinstance(value, (list, tuple)) and \
+                isinstance(last, (list, tuple)) and len(value) == len(last):
+            return any(map(self.exceeded, value, last))
+        return value != last
+
+    def __repr__(self):
+        return f'<Band absolute={self.absolute} relative={self.relative}>'
+
+
+class Deadband:
+    """Report a sensor value only when it changes significantly
+
+    Values are compared with the last value that was sent. Multi-channel
+    values are compared label by label, each against the band for its
+    label, and the whole value is sent if any label changed significantly.
+    A value is always sent once `heartbeat` seconds have passed since the
+    last one so that consumers see bounded staleness.
+    """
+    @staticmethod
+    def from_config(config):
+        default = Band.from_config(config)
+        labels = {
+            label: Band.from_config(label_config, default)
+            for label, label_config in config.get('labels', {}).items()
+        }
+        heartbeat = config.get('heartbeat')
+        return Deadband(
+            default, labels,
+            parse_time(heartbeat) if heartbeat else None
+        )
+
+    def __init__(self, band=None, labels=None, heartbeat=None):
+        self.band = band or Band()
+        self.labels = labels or {}
+        self.heartbeat = heartbeat
+        self._last_value = None
+        self._last_sent = None
+
+    def should_send(self, value, now):
+        if self._last_sent is None or self._changed(value) or (
+            self.heartbeat is not None and
+            now - self._last_sent >= self.heartbeat
+        ):
+            self._last_value = value
+            self._last_sent = now
+            return True
+        return False
+
+    def _changed(self, value):
+        last = self._last_value
+        if isinstance(value, dict) and isinstance(last, dict):
+            if value.keys() != last.keys():
+                return True
+            return any(
+                self.labels.get(label, self.band).exceeded(v, last[label])
+                for label, v in value.items()
+            )
+        return self.band.exceeded(value, last)
+
+    def __repr__(self):
+        return f'<Deadband band={self.band} heartbeat={self.heartbeat}>'
@@ -0,0 +1,174 @@
+"""Recent sensor readings kept in preallocated ring buffers
+
+A sensor configured with `history` keeps a `History` with one int64 column
+of timestamps, in milliseconds since the epoch, and one float64 column per
+label. Columns are allocated up front so appending never allocates, and a
+history of `capacity` rows takes `capacity * 8 * (labels + 1)` bytes: an
+hour at 1Hz for 24 labels is about 700KB.
+
+Columns are `array.array`s, or NumPy arrays when NumPy is installed, and
+windows of rows are returned as columns of the same type so they can be
+used in vectorised calculations.
+"""
+import array
+import bisect
+import math
+
+from .filters import is_number
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+
+DEFAULT_LABEL = 'value'
+
+
+class ArrayBackend:
+    name = 'array'
+
+    @staticmethod
+    def timestamps(capacity):
+        return array.array('q', bytes(8 * capacity))
+
+    @staticmethod
+    def values(capacity):
+        return array.array('d', [math.nan]) * capacity
+
+    @staticmethod
+    def concat(first, second):
+        return first + second
+
+
+class NumpyBackend:
+    name = 'numpy'
+
+    @staticmethod
+    def timestamps(capacity):
+        return numpy.zeros(capacity, dtype=numpy.int64)
+
+    @staticmethod
+    def values(capacity):
+        return numpy.full(capacity, numpy.nan, dtype=numpy.float64)
+
+    @staticmethod
+    def concat(first, second):
+        return numpy.concatenate((first, second))
+
+
+def get_backend(name='auto'):
+    if name == 'auto':
+        name = 'numpy' if numpy is not None else 'array'
+    if name == 'array':
+        return ArrayBackend
+    elif name == 'numpy':
+        if numpy is None:
+            raise ValueError('NumPy is not installed')
+        return NumpyBackend
+    raise ValueError(f'Unknown history backend {name}')
+
+
+class _Timestamps:
+    """Sequence view of the timestamps in order for bisect"""
+    def __init__(self, history):
+        self.history = history
+
+    def __len__(self):
+        return len(self.history)
+
+    def __getitem__(self, i):
+        return self.history._timestamps[self.history._index(i)]
+
+
+class History:
+    """Ring buffer of the most recent `capacity` readings of a sensor
+
+    Numeric values are stored under their label, or under `value` for
+    devices that return a single value. Other values, like RGB tuples, are
+    not stored. A label missing from a reading is stored as NaN.
+    """
+    @staticmethod
+    def from_config(config):
+        return History(
+            capacity=config.get('capacity', 3600),
+            backend=config.get('backend', 'auto'),
+        )
+
+    def __init__(self, capacity=3600, backend='auto'):
+        if capacity <= 0:
+            raise ValueError(f'Invalid history capacity {capacity}')
+        self.capacity = capacity
+        self.backend = get_backend(backend)
+        self._timestamps = self.backend.timestamps(capacity)
+        self._columns = {}
+        self._next = 0
+        self._size = 0
+
+    def __len__(self):
+        return self._size
+
+    @property
+    def labels(self):
+        return list(self._columns)
+
+    @property
+    def nbytes(self):
+        return self.capacity * 8 * (len(self._columns) + 1)
+
+    def _index(self, i):
+        return (self._next - self._size + i) % self.capacity
+
+    def append(self, timestamp, value):
+        if not isinstance(value, dict):
+            value = {DEFAULT_LABEL: value}
+
+        i = self._next
+        self._timestamps[i] = timestamp
+        for label, column in self._columns.items():
+            v = value.get(label)
+            column[i] = v if is_number(v) else math.nan
+        for label, v in value.items():
+            if label not in self._columns and is_number(v):
+                self._columns[label] = self.backend.values(self.capacity)
+                self._columns[label][i] = v
+
+        self._next = (i + 1) % self.capacity
+        self._size = min(self._size + 1, self.capacity)
+
+    def window(self, since=None, labels=None):
+        """Rows with a timestamp of at least `since`, oldest first
+
+        Returns the timestamps and a dict of the values for each label.
+        When the rows do not wrap around the end of the ring the NumPy
+        columns are views of the buffer rather than copies.
+        """
+        start = 0
+        if since is not None:
+            start = bisect.bisect_left(_Timestamps(self), since)
+        return self._window_from(start, labels)
+
+    def last(self, n, labels=None):
+        """The most recent `n` rows, oldest first"""
+        return self._window_from(max(self._size - n, 0), labels)
+
+    def _window_from(self, start, labels):
+        labels = self.labels if labels is None else labels
+        return (
+            self._slice(self._timestamps, start),
+            {label: self._slice(self._columns[label], start)
+             for label in labels},
+        )
+
+    def _slice(self, column, start):
+        first = self._index(start)
+        count = self._size - start
+        if first + count <= self.capacity:
+            return column[first:first + count]
+        return self.backend.concat(
+            column[first:], column[:first + count - self.capacity]
+        )
+
+    def __repr__(self):
+        return (f'<History backend={self.backend.name} '
+                f'rows={len(self)}/{self.capacity}>')
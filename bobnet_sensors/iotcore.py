@@ -1,14 +1,21 @@
+import asyncio
+import collections
 import datetime
 import json
 import logging
 import os
+import random
 import threading
 import urllib.request
 
 import paho.mqtt.client as mqtt
 import jwt
 
+from . import clock
+from .buffer import DiskBuffer
+from .encoding import JSON, get_encoding
 from .models import ConfigMessage, CommandMessage
+from .config import parse_time
 
 
 logger = logging.getLogger(__name__)
@@ -40,15 +47,52 @@ def load_ca_certs(ca_certs_path):
     return ca_certs_path
 
 
-def create_jwt(project_id, private_key):
+def create_jwt(project_id, private_key, lifetime=60 * 60):
+    now = clock.utcnow()
     token = {
-        'iat': datetime.datetime.utcnow(),
-        'exp': datetime.datetime.utcnow() + datetime.timedelta(minutes=60),
+        'iat': now,
+        'exp': now + datetime.timedelta(seconds=lifetime),
         'aud': project_id,
     }
     return jwt.encode(token, private_key, algorithm='RS256')
 
 
+# connection states
+DISCONNECTED = 'disconnected'
+WAITING = 'waiting'
+CONNECTING = 'connecting'
+CONNECTED = 'connected'
+
+
+class Backoff:
+    """Capped exponential backoff with full jitter
+
+    The delay before reconnect attempt `n` is drawn uniformly between zero
+    and `initial * 2 ** n`, capped at `maximum`, so nodes that lose their
+    connection together do not retry together.
+    """
+    @staticmethod
+    def from_config(config):
+        return Backoff(
+            initial=parse_time(config.get('initial', '1s')),
+            maximum=parse_time(config.get('max', '5m')),
+        )
+
+    def __init__(self, initial=1.0, maximum=300.0):
+        if initial <= 0 or maximum < initial:
+            raise ValueError('Invalid reconnect backoff')
+        self.initial = initial
+        self.maximum = maximum
+
+    def delay(self, attempt):
+        return random.uniform(
+            0, min(self.maximum, self.initial * 2 ** min(attempt, 32))
+        )
+
+    def __repr__(self):
+        return f'<Backoff initial={self.initial} max={self.maximum}>'
+
+
 class Connection:
     @staticmethod
     def from_config(looper, config):
@@ -59,10 +103,27 @@ class Connection:
             iot['region'], iot['project_id'],
             iot['registry_id'], iot['device_id'],
             load_private_key(iot),
-            load_ca_certs(iot['ca_certs_path']))
+            load_ca_certs(iot['ca_certs_path']),
+            encoding=get_encoding(iot.get('encoding', JSON.name)),
+            token_lifetime=parse_time(iot.get('token_lifetime', '60m')),
+            token_refresh=parse_time(iot.get('token_refresh', '5m')),
+            backoff=Backoff.from_config(iot.get('reconnect', {})),
+            connect_timeout=parse_time(iot.get('connect_timeout', '30s')),
+            offline_messages=iot.get('offline_messages', 1000),
+            max_inflight=iot.get('max_inflight', 20),
+            host=iot.get('host', GOOGLE_MQTT_BRIDGE_HOST),
+            port=iot.get('port', GOOGLE_MQTT_BRIDGE_PORT))
 
     def __init__(self, looper, region, project_id, registry_id, device_id,
-                 private_key, ca_certs_path):
+                 private_key, ca_certs_path, encoding=JSON,
+                 token_lifetime=60 * 60, token_refresh=5 * 60,
+                 backoff=None, connect_timeout=30.0, offline_messages=1000,
+                 max_inflight=20, host=GOOGLE_MQTT_BRIDGE_HOST,
+                 port=GOOGLE_MQTT_BRIDGE_PORT):
+        if token_refresh >= token_lifetime:
+            raise ValueError('token_refresh must be less than token_lifetime')
+        if max_inflight < 1:
+            raise ValueError('max_inflight must be at least 1')
         self.looper = looper
         self.region = region
         self.project_id = project_id
@@ -70,11 +131,93 @@ class Connection:
         self.device_id = device_id
         self.private_key = private_key
         self.ca_certs_path = ca_certs_path
-
-        self.connected = False
+        self.encoding = encoding
+        self.host = host
+        self.port = port
+        self.token_lifetime = token_lifetime
+        self.token_refresh = token_refresh
+        self.token_expires = None
+        self.backoff = backoff or Backoff()
+        self.connect_timeout = connect_timeout
+        self.offline_messages = offline_messages
+        self.max_inflight = max_inflight
+
+        self.state = DISCONNECTED
         self.connect_event = threading.Event()
+        self._state_callbacks = []
+        self._state_changed = asyncio.Event(loop=looper.loop)
+        self._window_changed = asyncio.Event(loop=looper.loop)
+        # set while connected, for the token refresh to wait on
+        self._connected = asyncio.Event(loop=looper.loop)
+        self._rotating = False
+        # (payload, ack) waiting for a connection or room in the window
+        self._pending = collections.deque()
+        # ack, payload and time sent by message id, awaiting PUBACK
+        self._inflight = collections.OrderedDict()
+
+        metrics = looper.metrics
+        metrics.gauge(
+            'bobnet_connected', 'Whether the bridge is connected'
+        ).set_function(lambda: int(self.connected))
+        metrics.gauge(
+            'bobnet_publish_pending', 'Messages held for the bridge'
+        ).set_function(lambda: len(self._pending))
+        metrics.gauge(
+            'bobnet_publish_inflight', 'Messages awaiting PUBACK'
+        ).set_function(lambda: len(self._inflight))
+        self._reconnects = metrics.counter(
+            'bobnet_reconnects_total', 'Attempts to reconnect to the bridge'
+        )
+        self._publish_dropped = metrics.counter(
+            'bobnet_publish_dropped_total',
+            'Messages dropped while held for the bridge'
+        )
+        self._publish_latency = metrics.histogram(
+            'bobnet_publish_ack_seconds', 'Time from publish to PUBACK'
+        )
+
+    @property
+    def connected(self):
+        return self.state == CONNECTED
+
+    def add_state_callback(self, callback):
+        """Call `callback(state)` on every change of connection state
+
+        Callbacks may be called from paho's network thread.
+        """
+        self._state_callbacks.append(callback)
+
+    def _set_state(self, state):
+        if state == CONNECTED:
+            self.connect_event.set()
+        else:
+            self.connect_event.clear()
+        if state == self.state:
+            return
+        logger.info(f'connection {self.state} -> {state}')
+        self.state = state
+        self.looper.loop.call_soon_threadsafe(self._state_changed.set)
+        self.looper.loop.call_soon_threadsafe(self._window_changed.set)
+        self.looper.loop.call_soon_threadsafe(self._update_connected)
+        for callback in self._state_callbacks:
+            callback(state)
+
+    def _update_connected(self):
+        if self.connected:
+            self._connected.set()
+        else:
+            self._connected.clear()
+
+    def sign_token(self):
+        """Sign a new JWT, returning it with the time it expires"""
+        expires = clock.time() + self.token_lifetime
+        token = create_jwt(
+            self.project_id, self.private_key, self.token_lifetime
+        )
+        return token, expires
 
     def connect(self):
+        self._set_state(CONNECTING)
         self._client = mqtt.Client(client_id=self.client_id)
         self._client.tls_set(ca_certs=self.ca_certs_path)
 
@@ -82,11 +225,16 @@ class Connection:
         self._client.on_disconnect = self.on_disconnect
         self._client.on_subscribe = self.on_subscribe
         self._client.on_message = self.on_message
-
-        self._client.username_pw_set(
-            username='unused',
-            password=create_jwt(self.project_id, self.private_key))
-        self._client.connect(GOOGLE_MQTT_BRIDGE_HOST, GOOGLE_MQTT_BRIDGE_PORT)
+        self._client.on_publish = self.on_publish
+        self._client.max_inflight_messages_set(self.max_inflight)
+
+        token, self.token_expires = self.sign_token()
+        self._client.username_pw_set(username='unused', password=token)
+        try:
+            self._client.connect(self.host, self.port)
+        except Exception:
+            self._set_state(DISCONNECTED)
+            raise
         self._client.loop_start()
 
     @property
@@ -95,7 +243,10 @@ class Connection:
 
     @property
     def events_topic(self):
-        return f'/devices/{self.device_id}/events'
+        topic = f'/devices/{self.device_id}/events'
+        if self.encoding.subfolder:
+            topic += f'/{self.encoding.subfolder}'
+        return topic
 
     @property
     def client_id(self):
@@ -103,17 +254,136 @@ class Connection:
             f'/registries/{self.registry_id}/devices/{self.device_id}'
 
     def on_connect(self, _client, _userdata, _flags, rc):
+        if rc:
+            logger.error(f'Connection refused {rc}')
+            return
         self._client.subscribe(self.config_topic, qos=1)
-        self.connected = True
-        self.connect_event.set()
-        logger.info('connected')
+        self._set_state(CONNECTED)
+        self.looper.loop.call_soon_threadsafe(self._send_pending)
+
+    def rotate_token(self, token, expires):
+        """Reconnect with a new token before the current one expires
+
+        The same client is reconnected so messages it has queued are sent
+        once the new session is up. Its network thread is stopped first,
+        otherwise it sees the old socket close and reconnects by itself.
+        Runs on the executor as stopping the thread joins it.
+        """
+        logger.info('rotating credentials')
+        self._rotating = True
+        try:
+            self._set_state(CONNECTING)
+            self._client.loop_stop()
+            self._client.username_pw_set(username='unused', password=token)
+            self.token_expires = expires
+            self._client.reconnect()
+            self._client.loop_start()
+        except Exception:
+            self._set_state(DISCONNECTED)
+            # the supervisor connects a new client, resend on that
+            self.looper.loop.call_soon_threadsafe(self._requeue_inflight)
+            raise
+        finally:
+            self._rotating = False
+
+    async def run(self, looper):
+        await asyncio.gather(
+            self.run_token_refresh(looper),
+            self.run_reconnect(looper),
+            loop=looper.loop
+        )
+
+    async def run_token_refresh(self, looper):
+        """Rotate to a new token `token_refresh` seconds before expiry
+
+        Tokens are signed on the looper's executor so the RS256 signature
+        does not hold up the event loop.
+        """
+        while not looper.stopping:
+            await looper.wait_for(max(
+                self.token_expires - self.token_refresh - clock.time(), 0
+            ))
+            if looper.stopping:
+                break
+            if not self.connected:
+                # the reconnect signs a new token, sleep until it is made
+                self._connected.clear()
+                await self._wait_event(looper, self._connected)
+                continue
+            try:
+                token, expires = await looper.run_blocking(self.sign_token)
+                await looper.run_blocking(self.rotate_token, token, expires)
+            except Exception as e:
+                logger.warning(f'Failed to rotate credentials: {e}')
+                await looper.wait_for(self.token_refresh / 10)
+
+    async def run_reconnect(self, looper):
+        """Reconnect whenever the connection is lost
+
+        Attempts are spaced by the backoff, which starts again once a
+        connection is made. An attempt that has not connected after
+        `connect_timeout` seconds is abandoned.
+        """
+        attempt = 0
+        while not looper.stopping:
+            self._state_changed.clear()
+            if self.state == CONNECTED:
+                attempt = 0
+                await self._wait_state_change(looper)
+            elif self.state == CONNECTING:
+                if not await self._wait_state_change(
+                    looper, self.connect_timeout
+                ):
+                    logger.warning('Timed out connecting')
+                    await self._abandon(looper)
+            else:
+                self._set_state(WAITING)
+                await looper.wait_for(self.backoff.delay(attempt))
+                attempt += 1
+                if looper.stopping:
+                    break
+                self._reconnects.inc()
+                try:
+                    await looper.run_blocking(self.connect)
+                except Exception as e:
+                    logger.warning(f'Failed to connect: {e}')
+
+    def _wait_state_change(self, looper, timeout=None):
+        return self._wait_event(looper, self._state_changed, timeout)
+
+    async def _wait_event(self, looper, event, timeout=None):
+        """Wait for the event to be set or the looper to stop
+
+        Returns False on timeout.
+        """
+        changed = asyncio.ensure_future(event.wait(), loop=looper.loop)
+        stopped = asyncio.ensure_future(
+            looper.stop_event.wait_async(), loop=looper.loop
+        )
+        done, pending = await asyncio.wait(
+            [changed, stopped], timeout=timeout,
+            loop=looper.loop, return_when=asyncio.FIRST_COMPLETED
+        )
+        for future in pending:
+            future.cancel()
+        return bool(done)
+
+    async def _abandon(self, looper):
+        # stopping the network thread joins it, which may be stuck connecting
+        await looper.run_blocking(self._client.loop_stop)
+        self._set_state(DISCONNECTED)
+        self._requeue_inflight()
 
     def on_disconnect(self, _client, _userdata, rc):
-        logger.info('reconnecting')
-        self.connected = False
-        self.connect_event.clear()
+        if self._rotating:
+            return
+        logger.info(f'disconnected {error_str(rc)}')
+        # the supervisor reconnects with backoff rather than paho's loop.
+        # This runs on the network thread, which loop_stop only signals
         self._client.loop_stop()
-        self.connect()
+        self._set_state(DISCONNECTED)
+        # unacked messages die with this client, resend them on the next
+        self.looper.loop.call_soon_threadsafe(self._requeue_inflight)
 
     def on_subscribe(self, _client, _userdata, _mid, granted_qos):
         if granted_qos[0] == 128:
@@ -135,37 +405,385 @@ class Connection:
         for device, command in message.get('commands', {}).items():
             yield CommandMessage.from_dict(device, command)
 
-    def publish(self, message):
-        self.wait_for_connection()
-        return self._client.publish(
-            self.events_topic, json.dumps(message), qos=1
+    async def publish(self, message):
+        """Publish a message once there is room in the inflight window
+
+        Returns a future resolved with the delivery latency in seconds when
+        the message is acknowledged.
+        """
+        await self.wait_for_window()
+        return self.publish_payload(self.encoding.encode(message))
+
+    def publish_payload(self, payload):
+        """Publish a payload without waiting, returning a future for its ack
+
+        Payloads are sent while connected and there are fewer than
+        `max_inflight` unacknowledged, otherwise they are held. Up to
+        `offline_messages` payloads are held, the oldest are dropped and
+        their futures cancelled after that.
+        """
+        ack = self.looper.loop.create_future()
+        if len(self._pending) >= self.offline_messages:
+            logger.warning('Offline queue full, dropping oldest')
+            self._pending.popleft()[1].cancel()
+            self._publish_dropped.inc()
+        self._pending.append((payload, ack))
+        self._send_pending()
+        return ack
+
+    @property
+    def window(self):
+        """How many more messages can be published without being held"""
+        return max(
+            self.max_inflight - len(self._inflight) - len(self._pending), 0
         )
 
+    async def wait_until_connected(self):
+        """Wait until connected or the looper stops"""
+        while not self.connected and not self.looper.stopping:
+            self._connected.clear()
+            await self._wait_event(self.looper, self._connected)
+
+    async def wait_for_window(self):
+        """Wait while connected with a full inflight window
+
+        While disconnected messages are held rather than waited for.
+        """
+        while self.connected and not self.window and \
+                not self.looper.stopping:
+            self._window_changed.clear()
+            await self._wait_event(self.looper, self._window_changed)
+
+    def _send_pending(self):
+        if self._pending and self.connect_event.is_set():
+            while self._pending and len(self._inflight) < self.max_inflight:
+                payload, ack = self._pending.popleft()
+                if ack.done():
+                    continue
+                info = self._client.publish(self.events_topic, payload, qos=1)
+                self._inflight[info.mid] = (
+                    ack, payload, self.looper.loop.time()
+                )
+
+    def _requeue_inflight(self):
+        if self._inflight:
+            logger.info(f'Requeueing {len(self._inflight)} unacked messages')
+            self._pending.extendleft(
+                (payload, ack) for ack, payload, _sent in
+                reversed(self._inflight.values())
+            )
+            self._inflight.clear()
+            self._send_pending()
+
+    def on_publish(self, _client, _userdata, mid):
+        self.looper.loop.call_soon_threadsafe(self._acked, mid)
+
+    def _acked(self, mid):
+        entry = self._inflight.pop(mid, None)
+        if entry is not None:
+            ack, _payload, sent = entry
+            latency = self.looper.loop.time() - sent
+            self._publish_latency.observe(latency)
+            if not ack.done():
+                ack.set_result(latency)
+        self._send_pending()
+        self._window_changed.set()
+
+    @property
+    def pending(self):
+        return len(self._pending)
+
+    @property
+    def inflight(self):
+        return len(self._inflight)
+
     def wait_for_connection(self):
         result = self.connect_event.wait(5.0)
         if not result:
             raise RuntimeError('Could not connect to MQTT bridge')
 
 
+class Batcher:
+    """Collect messages from the send queue into batches
+
+    A batch is flushed when it holds `max_messages` messages, when adding
+    another message would take it over `max_bytes` of serialized payload or
+    when `linger` seconds have passed since its first message arrived.
+    Messages are encoded once, as they are taken from the queue, and the
+    batch payload is assembled from those encodings.
+    """
+    @staticmethod
+    def from_config(config, encoding=JSON):
+        return Batcher(
+            max_messages=config.get('max_messages', 100),
+            max_bytes=config.get('max_bytes', 64 * 1024),
+            linger=parse_time(config.get('linger', '5s')),
+            encoding=encoding,
+        )
+
+    def __init__(self, max_messages=100, max_bytes=64 * 1024, linger=5.0,
+                 encoding=JSON):
+        if max_messages < 1:
+            raise ValueError('max_messages must be at least 1')
+        self.max_messages = max_messages
+        self.max_bytes = max_bytes
+        self.linger = linger
+        self.encoding = encoding
+        self._pending = collections.deque()
+
+    def message_size(self, message):
+        return self._payload_size(self.encoding.encode(message))
+
+    @staticmethod
+    def _payload_size(payload):
+        # Account for the separator between messages in the envelope
+        return len(payload) + 2
+
+    def _extend(self, messages):
+        self._pending.extend(
+            (message, self.encoding.encode(message)) for message in messages
+        )
+
+    async def collect(self, looper):
+        """Collect the next batch of messages"""
+        return [message for message, _ in await self._collect(looper)]
+
+    async def collect_payload(self, looper):
+        """Collect the next batch, returning its messages and the payload
+        of their `BatchMessage`
+        """
+        batch = await self._collect(looper)
+        if not batch:
+            return [], None
+        messages, payloads = zip(*batch)
+        return list(messages), self.encoding.encode_batch(payloads)
+
+    async def _collect(self, looper):
+        queue = looper.send_queue
+        if not self._pending:
+            self._extend(await queue.get_many(self.max_messages))
+
+        batch = []
+        size = 0
+        deadline = looper.loop.time() + self.linger
+        while self._pending:
+            while self._pending and len(batch) < self.max_messages:
+                message_size = self._payload_size(self._pending[0][1])
+                if batch and size + message_size > self.max_bytes:
+                    return batch
+                batch.append(self._pending.popleft())
+                size += message_size
+
+            timeout = deadline - looper.loop.time()
+            if len(batch) >= self.max_messages or timeout <= 0:
+                break
+            self._extend(await queue.get_many(
+                self.max_messages - len(batch), timeout=timeout
+            ))
+
+        return batch
+
+    def __repr__(self):
+        return f'<Batcher max_messages={self.max_messages} ' + \
+            f'max_bytes={self.max_bytes} linger={self.linger}>'
+
+
 class IOTCoreClient:
-    def __init__(self, client):
+    def __init__(self, client, batcher=None, buffer=None, retry_interval=5.0,
+                 commit_every=100, commit_interval=1.0):
         self._client = client
+        self._batcher = batcher
+        self._buffer = buffer
+        self.retry_interval = retry_interval
+        self.commit_every = commit_every
+        self.commit_interval = commit_interval
+        # (ack, buffer position) of forwarded records awaiting PUBACK
+        self._forwarded = collections.deque()
+        self._forwarded_to = None
+        self._stored = None
+        self._commit_due = None
+        self._unsaved = 0
+        self._saved = None
+        self._saving = False
 
     def start(self):
-        self._client.connect()
-        self._client.wait_for_connection()
+        try:
+            self._client.connect()
+            self._client.wait_for_connection()
+        except (OSError, RuntimeError):
+            if self._buffer is None:
+                raise
+            logger.warning('Not connected, buffering messages')
+
+    async def send(self, message):
+        return await self._client.publish(message)
+
+    @property
+    def state(self):
+        return self._client.state
 
-    def send(self, message):
-        return self._client.publish(message)
+    async def run_connection(self, looper):
+        await self._client.run(looper)
+
+    async def next_message(self, looper):
+        if self._batcher:
+            batch, payload = await self._batcher.collect_payload(looper)
+            if batch:
+                logger.debug(f'Collected batch of {len(batch)} messages')
+                return payload
+        else:
+            return await looper.send_queue.get()
 
     async def run_send(self, looper):
+        if self._buffer is not None:
+            await self.run_store_and_forward(looper)
+        else:
+            while not looper.stopping:
+                # leave messages in the send queue while disconnected so its
+                # capacity and policy apply, not just offline_messages
+                await self._client.wait_until_connected()
+                message = await self.next_message(looper)
+                if message:
+                    # acks are not awaited so publishes are pipelined up
+                    # to the inflight window
+                    await self.send(message)
+
+    async def run_store_and_forward(self, looper):
+        self._stored = asyncio.Event(loop=looper.loop)
+        self._commit_due = asyncio.Event(loop=looper.loop)
+        for event in (self._stored, self._commit_due):
+            looper.stop_event.add_callback(
+                lambda event=event: looper.loop.call_soon_threadsafe(event.set)
+            )
+        try:
+            await asyncio.gather(
+                self.run_store(looper),
+                self.run_forward(looper),
+                self.run_commit(looper),
+                loop=looper.loop
+            )
+        finally:
+            self._buffer.save_position()
+            self._buffer.close()
+
+    async def run_store(self, looper):
+        while not looper.stopping:
+            message = await self.next_message(looper)
+            if message:
+                self._buffer.append(self._client.encoding.encode(message))
+                self._stored.set()
+
+    async def run_forward(self, looper):
         while not looper.stopping:
-            value = await looper.send_queue.get()
-            if value:
-                self.send(value)
+            self._stored.clear()
+            await self._client.wait_for_window()
+            if self.forward():
+                # give the rest of the loop a turn between chunks
+                await asyncio.sleep(0, loop=looper.loop)
+                continue
+
+            timeout = self.retry_interval if len(self._buffer) else None
+            try:
+                await asyncio.wait_for(
+                    self._stored.wait(), timeout, loop=looper.loop
+                )
+            except asyncio.TimeoutError:
+                pass
+
+    async def run_commit(self, looper):
+        """Save the forwarded position every `commit_every` PUBACKs or
+        `commit_interval` seconds, whichever comes first
+        """
+        while not looper.stopping:
+            self._commit_due.clear()
+            try:
+                await asyncio.wait_for(
+                    self._commit_due.wait(), self.commit_interval,
+                    loop=looper.loop
+                )
+            except asyncio.TimeoutError:
+                pass
+            await self.save_position(looper)
+
+    async def save_position(self, looper):
+        """Write the committed position to disk on the looper's executor"""
+        position = self._buffer.position
+        if self._saving or position == self._saved:
+            return
+        self._saving = True
+        self._unsaved = 0
+        try:
+            await looper.run_blocking(self._buffer.save_position, position)
+            self._saved = position
+        finally:
+            self._saving = False
+
+    def forward(self, max_n=100):
+        """Publish the oldest buffered messages not yet forwarded
+
+        Records are committed as their PUBACKs arrive, so those still in
+        flight are forwarded again after a restart. Returns True if any
+        messages were published.
+        """
+        if not self._client.connected:
+            return False
+        entries = self._buffer.read(
+            min(max_n, self._client.window), self._forwarded_to
+        )
+        for payload, position in entries:
+            ack = self._client.publish_payload(payload)
+            self._forwarded.append((ack, position))
+            ack.add_done_callback(self._forward_acked)
+        if entries:
+            self._forwarded_to = entries[-1][1]
+        return len(entries) > 0
+
+    def _forward_acked(self, _ack):
+        # commit in order, up to the oldest record still awaiting PUBACK
+        position = None
+        while self._forwarded and self._forwarded[0][0].done():
+            ack, next_position = self._forwarded.popleft()
+            if ack.cancelled() or ack.exception() is not None:
+                self._rewind()
+                break
+            position = next_position
+            self._unsaved += 1
+        if position is not None:
+            # saved by run_commit, off the event loop
+            self._buffer.commit_to(position, save=False)
+        if self._unsaved >= self.commit_every and self._commit_due:
+            self._commit_due.set()
+
+    def _rewind(self):
+        """Forward again from the oldest record that was not delivered
+
+        The connection drops held messages beyond `offline_messages`, the
+        records after the dropped one are sent again to keep them in order.
+        """
+        logger.warning('Forwarded messages were dropped, resending')
+        self._forwarded.clear()
+        self._forwarded_to = None
+        if self._stored is not None:
+            self._stored.set()
 
 
 def load_iotcore(looper, config):
     conn = Connection.from_config(looper, config)
-
-    return IOTCoreClient(conn)
+    iot = config.get('iotcore', {})
+
+    batcher = None
+    if iot.get('batch') is not None:
+        batcher = Batcher.from_config(iot['batch'], conn.encoding)
+
+    buffer_config = iot.get('buffer')
+    if buffer_config is None:
+        return IOTCoreClient(conn, batcher)
+
+    return IOTCoreClient(
+        conn, batcher, DiskBuffer.from_config(buffer_config),
+        retry_interval=parse_time(buffer_config.get('retry_interval', '5s')),
+        commit_every=buffer_config.get('commit_every', 100),
+        commit_interval=parse_time(
+            buffer_config.get('commit_interval', '1s')
+        ),
+    )
@@ -1,23 +1,29 @@
 import asyncio
 
 
-def run(looper, iotcore, sensors):
+def run(looper, iotcore, sensors, exporter=None):
     iotcore.start()
 
     sensor_tasks = [
-        sensor.run(looper) for sensor in sensors
+        sensors.run(looper)
     ]
     sensor_config_tasks = [
         sensors.run_update_config(looper)
     ]
     iotcore_tasks = [
         iotcore.run_send(looper),
+        iotcore.run_connection(looper),
     ]
     all_tasks = sensor_tasks + sensor_config_tasks + iotcore_tasks
+    if exporter is not None:
+        all_tasks.append(exporter.run(looper))
 
-    looper.loop.run_until_complete(
-        asyncio.gather(
-            *all_tasks,
-            loop=looper.loop
+    try:
+        looper.loop.run_until_complete(
+            asyncio.gather(
+                *all_tasks,
+                loop=looper.loop
+            )
         )
-    )
+    finally:
+        looper.close()
@@ -0,0 +1,307 @@
+"""Counters, gauges and latency histograms for the pipeline
+
+Metrics live in the looper's `Registry` and are updated from the event loop.
+They can be scraped in the Prometheus text format from a local HTTP
+endpoint, and a compact snapshot can be published as a MetricsMessage.
+"""
+import asyncio
+import bisect
+import logging
+
+from .config import parse_time
+from .models import MetricsMessage
+
+logger = logging.getLogger(__name__)
+
+# seconds, from fast I2C reads to slow publishes over a mobile link
+LATENCY_BUCKETS = (
+    0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0,
+    10.0,
+)
+
+
+def format_value(value):
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value))
+
+
+def format_labels(names, values):
+    if not names:
+        return ''
+    pairs = ','.join(
+        f'{name}="{value}"' for name, value in zip(names, values)
+    )
+    return '{' + pairs + '}'
+
+
+class Metric:
+    type = None
+
+    def __init__(self, name, help, labels=()):
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+        self._values = {}
+
+    def _key(self, labels):
+        if set(labels) != set(self.labels):
+            raise ValueError(f'{self.name} is labelled by {self.labels}')
+        return tuple(str(labels[name]) for name in self.labels)
+
+    def samples(self):
+        """(suffix, label names, label values, value) to expose"""
+        for key, value in self._values.items():
+            yield '', self.labels, key, value() if callable(value) else value
+
+    def render(self):
+        lines = [
+            f'# HELP {self.name} {self.help}',
+            f'# TYPE {self.name} {self.type}',
+        ]
+        for suffix, names, values, value in self.samples():
+            lines.append(
+                f'{self.name}{suffix}{format_labels(names, values)} '
+                f'{format_value(value)}'
+            )
+        return lines
+
+    def snapshot(self):
+        """Values by their labels joined with commas
+
+        An unlabelled metric is just its value.
+        """
+        values = {
+            ','.join(key): self._summarise(value)
+            for key, value in self._values.items()
+        }
+        return values if self.labels else values.get('')
+
+    def _summarise(self, value):
+        return value() if callable(value) else value
+
+
+class Counter(Metric):
+    type = 'counter'
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        self._values[key] = self._values.get(key, 0) + amount
+
+    def set_function(self, function, **labels):
+        """Read the count from `function`, for counts kept elsewhere"""
+        self._values[self._key(labels)] = function
+
+
+class Gauge(Metric):
+    type = 'gauge'
+
+    def set(self, value, **labels):
+        self._values[self._key(labels)] = value
+
+    def set_function(self, function, **labels):
+        self._values[self._key(labels)] = function
+
+
+class HistogramValue:
+    __slots__ = ('counts', 'sum', 'count')
+
+    def __init__(self, buckets):
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+
+class Histogram(Metric):
+    """Observations counted in fixed buckets
+
+    Bucket `i` counts observations up to `buckets[i]`, the last bucket
+    those above every bound. Quantiles are estimated by interpolating
+    within the bucket they fall in.
+    """
+    type = 'histogram'
+
+    def __init__(self, name, help, labels=(), buckets=LATENCY_BUCKETS):
+        super().__init__(name, help, labels)
+        self.buckets = tuple(sorted(buckets))
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        histogram = self._values.get(key)
+        if histogram is None:
+            histogram = self._values[key] = HistogramValue(self.buckets)
+        histogram.counts[bisect.bisect_left(self.buckets, value)] += 1
+        histogram.sum += value
+        histogram.count += 1
+
+    def samples(self):
+        names = self.labels + ('le',)
+        for key, histogram in self._values.items():
+            total = 0
+            for bound, count in zip(
+                self.buckets + (float('inf'),), histogram.counts
+            ):
+                total += count
+                yield '_bucket', names, key + (format_value(bound),), total
+            yield '_sum', self.labels, key, histogram.sum
+            yield '_count', self.labels, key, histogram.count
+
+    def quantile(self, q, **labels):
+        histogram = self._values.get(self._key(labels))
+        if histogram is None:
+            return None
+        return self._quantile(histogram, q)
+
+    def _quantile(self, histogram, q):
+        rank = q * histogram.count
+        total = 0
+        for i, count in enumerate(histogram.counts):
+            if count and total + count >= rank:
+                if i == len(self.buckets):
+                    return self.buckets[-1]
+                lower = self.buckets[i - 1] if i else 0.0
+                upper = self.buckets[i]
+                return lower + (upper - lower) * (rank - total) / count
+            total += count
+        return None
+
+    def _summarise(self, histogram):
+        return {
+            'count': histogram.count,
+            'sum': histogram.sum,
+            'p50': self._quantile(histogram, 0.5),
+            'p95': self._quantile(histogram, 0.95),
+        }
+
+
+class Registry:
+    """The metrics of one process by name
+
+    Metrics are created on first use, so components get the same metric by
+    asking for it by name.
+    """
+    def __init__(self):
+        self._metrics = {}
+
+    def _get(self, cls, name, *args, **kwargs):
+        metric = self._metrics.get(name)
+        if metric is None:
+            metric = self._metrics[name] = cls(name, *args, **kwargs)
+        elif not isinstance(metric, cls):
+            raise ValueError(f'{name} is a {metric.type}')
+        return metric
+
+    def counter(self, name, help, labels=()):
+        return self._get(Counter, name, help, labels)
+
+    def gauge(self, name, help, labels=()):
+        return self._get(Gauge, name, help, labels)
+
+    def histogram(self, name, help, labels=(), buckets=LATENCY_BUCKETS):
+        return self._get(Histogram, name, help, labels, buckets)
+
+    def __getitem__(self, name):
+        return self._metrics[name]
+
+    def __contains__(self, name):
+        return name in self._metrics
+
+    def render(self):
+        """All metrics in the Prometheus text exposition format"""
+        lines = []
+        for metric in self._metrics.values():
+            lines.extend(metric.render())
+        return '\n'.join(lines) + '\n'
+
+    def snapshot(self):
+        """Current values by metric name, with histograms summarised"""
+        return {
+            name: metric.snapshot()
+            for name, metric in self._metrics.items()
+        }
+
+    def __repr__(self):
+        return f'<Registry metrics={len(self._metrics)}>'
+
+
+class Exporter:
+    """Serve the metrics over HTTP and publish them periodically
+
+    With a `port` the metrics are served at /metrics on `host`, and with
+    `publish` a MetricsMessage with a snapshot is sent every `publish`
+    seconds.
+    """
+    @staticmethod
+    def from_config(config):
+        publish = config.get('publish')
+        return Exporter(
+            host=config.get('host', '127.0.0.1'),
+            port=config.get('port'),
+            publish=parse_time(publish) if publish else None,
+        )
+
+    def __init__(self, host='127.0.0.1', port=None, publish=None):
+        self.host = host
+        self.port = port
+        self.publish = publish
+        self.server = None
+
+    async def run(self, looper):
+        if self.port is not None:
+            self.server = await asyncio.start_server(
+                lambda reader, writer: self.handle(looper, reader, writer),
+                self.host, self.port, loop=looper.loop
+            )
+            logger.info(f'Serving metrics on {self.host}:{self.port}')
+        try:
+            if self.publish:
+                await self.run_publish(looper)
+            else:
+                await looper.stop_event.wait_async()
+        finally:
+            if self.server is not None:
+                self.server.close()
+                await self.server.wait_closed()
+
+    async def run_publish(self, looper):
+        while not looper.stopping:
+            await looper.wait_for(self.publish)
+            if not looper.stopping:
+                await looper.send_queue.put(
+                    MetricsMessage(looper.metrics.snapshot())
+                )
+
+    async def handle(self, looper, reader, writer):
+        try:
+            request = await reader.readline()
+            # headers are not needed
+            while (await reader.readline()).strip():
+                pass
+            parts = request.decode('latin-1').split()
+            if len(parts) >= 2 and parts[0] == 'GET' and \
+                    parts[1].split('?')[0] == '/metrics':
+                status = '200 OK'
+                body = looper.metrics.render().encode('utf8')
+            else:
+                status = '404 Not Found'
+                body = b'Not found\n'
+            writer.write(
+                f'HTTP/1.0 {status}\r\n'
+                f'Content-Type: text/plain; version=0.0.4; charset=utf-8\r\n'
+                f'Content-Length: {len(body)}\r\n'
+                f'\r\n'.encode('latin-1') + body
+            )
+            await writer.drain()
+        except ConnectionError as e:
+            logger.debug(f'Metrics request failed: {e}')
+        finally:
+            writer.close()
+
+    def __repr__(self):
+        return (f'<Exporter host={self.host} port={self.port} '
+                f'publish={self.publish}>')
+
+
+def load_metrics(config):
+    if config.get('metrics') is not None:
+        return Exporter.from_config(config['metrics'])
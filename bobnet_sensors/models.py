@@ -2,6 +2,8 @@ import logging
 from datetime import datetime, timedelta
 import re
 
+from . import clock
+
 
 class BaseMessage:
     _PATTERN1 = re.compile('Message$')
@@ -62,10 +64,10 @@ class CommandMessage(BaseMessage):
         if self.state == 'new':
             return True
         elif self.state == 'ack':
-            return self.timestamp <= datetime.utcnow() - timedelta(hours=2)
+            return self.timestamp <= clock.utcnow() - timedelta(hours=2)
 
     def ack(self):
-        return CommandMessage(self.device, self.id, 'ack', datetime.utcnow())
+        return CommandMessage(self.device, self.id, 'ack', clock.utcnow())
 
 
 class DataMessage(BaseMessage):
@@ -74,6 +76,11 @@ class DataMessage(BaseMessage):
         self.data = data
 
 
+class BatchMessage(BaseMessage):
+    def __init__(self, messages):
+        self.messages = messages
+
+
 class CommandResponseMessage(BaseMessage):
     def __init__(self, device, id, state):
         self.device = device
@@ -81,6 +88,11 @@ class CommandResponseMessage(BaseMessage):
         self.state = state  # TODO validate
 
 
+class MetricsMessage(BaseMessage):
+    def __init__(self, metrics):
+        self.metrics = metrics
+
+
 class LogMessage(BaseMessage):
     @classmethod
     def error(cls, message):
@@ -0,0 +1,75 @@
+"""Recordings of raw device reads
+
+A recording is an append-only file of records, framed like the records of
+a `DiskBuffer` with their length and CRC, each holding the MessagePack of
+`[timestamp, sensor, value]`. Timestamps are seconds since the epoch.
+Reading stops at the first torn or corrupt record, so a recording cut short
+by a power cut can still be replayed up to that point.
+"""
+import logging
+import os
+import threading
+import zlib
+
+from .buffer import RECORD_HEADER
+from .encoding import MSGPACK
+
+logger = logging.getLogger(__name__)
+
+
+class Recorder:
+    """Append every read of the recorded sensors to a recording
+
+    Reads happen on the looper's executor so appends hold a lock.
+    """
+    @staticmethod
+    def from_config(config):
+        return Recorder(config['path'], sync=config.get('sync', False))
+
+    def __init__(self, path, sync=False):
+        self.path = path
+        self.sync = sync
+        self.records = 0
+        self._lock = threading.Lock()
+        self._file = open(path, 'ab')
+
+    def record(self, sensor, timestamp, value):
+        try:
+            data = MSGPACK.encode([timestamp, sensor, value])
+        except (TypeError, ValueError, OverflowError) as e:
+            logger.warning(f'Cannot record {sensor} value {value}: {e}')
+            return
+        with self._lock:
+            self._file.write(RECORD_HEADER.pack(len(data), zlib.crc32(data)))
+            self._file.write(data)
+            self._file.flush()
+            if self.sync:
+                os.fsync(self._file.fileno())
+            self.records += 1
+
+    def close(self):
+        with self._lock:
+            self._file.close()
+
+    def __repr__(self):
+        return f'<Recorder path={self.path} records={self.records}>'
+
+
+def read_recording(path, sensor=None):
+    """Yield the (timestamp, sensor, value) records of a recording
+
+    With `sensor` only the records of that sensor are yielded.
+    """
+    with open(path, 'rb') as f:
+        while True:
+            header = f.read(RECORD_HEADER.size)
+            if len(header) < RECORD_HEADER.size:
+                return
+            length, crc = RECORD_HEADER.unpack(header)
+            data = f.read(length)
+            if len(data) < length or zlib.crc32(data) != crc:
+                logger.warning(f'Recording {path} ends with a damaged record')
+                return
+            timestamp, name, value = MSGPACK.decode(data)
+            if sensor is None or name == sensor:
+                yield timestamp, name, value
@@ -1,12 +1,21 @@
 from abc import ABCMeta, abstractmethod
 import asyncio
+import collections
+import heapq
 import importlib
+import itertools
 import logging
-import re
+import threading
 
 import bobnet_sensors
+from ..config import parse_time
+from .. import clock
+from ..aggregation import Aggregator
+from ..filters import Deadband
+from ..history import History
+from ..recording import Recorder
 from ..models import (
-    ConfigMessage, CommandMessage, LogMessage
+    ConfigMessage, CommandMessage, DataMessage, LogMessage
 )
 
 
@@ -23,31 +32,31 @@ except ImportError:
 logger = logging.getLogger(__name__)
 
 
-def parse_time(t):
-    match = re.match(r'^(\d+(?:\.\d+)?)(s|m|h)$', t)
-    if not match:
-        raise ValueError(f'Invalid time format {t}')
-    multipliers = {
-        's': 1,
-        'm': 60,
-        'h': 60 * 60,
-    }
-
-    return float(match.group(1)) * multipliers[match.group(2)]
-
-
 class Sensors:
     @staticmethod
     def from_config(config):
         sensor_configs = config['sensors']
+        coalesce = parse_time(config.get('coalesce_reads', '0.05s'))
+        recorder = None
+        if config.get('record') is not None:
+            recorder = Recorder.from_config(config['record'])
+            # a recording holds every read of the hardware
+            coalesce = 0
+        registry = DeviceRegistry(coalesce)
         sensors = {}
         for name, sensor_config in sensor_configs.items():
-            sensors[name] = Sensor.create(name, sensor_config)
+            sensors[name] = Sensor.create(
+                name, sensor_config, registry, recorder
+            )
 
         return Sensors(sensors)
 
     def __init__(self, sensors):
         self._sensors = sensors
+        self._scheduler = Scheduler()
+
+    async def run(self, looper):
+        await self._scheduler.run(self, looper)
 
     async def run_update_config(self, looper):
         while not looper.stopping:
@@ -71,11 +80,14 @@ class Sensors:
                 f'Unknown device in config {config.device}'
             )
         else:
+            every = device.every
             ok, error = device.update_config(config.config)
             if not ok:
                 yield LogMessage.error(
                     f'Config error on {config.device}: {error}'
                 )
+            elif device.every != every:
+                self._scheduler.reschedule(device)
 
     def apply_command_message(self, looper, command):
         device = self._sensors.get(command.device)
@@ -98,23 +110,209 @@ class Sensors:
         return (sensor for sensor in self._sensors.values())
 
 
+class ScheduledSensor:
+    __slots__ = (
+        'sensor', 'start', 'every', 'count', 'missed', 'task', 'cancelled'
+    )
+
+    def __init__(self, sensor, start):
+        self.sensor = sensor
+        self.start = start
+        self.every = sensor.every
+        self.count = 0
+        self.missed = 0
+        self.task = None
+        self.cancelled = False
+
+    @property
+    def deadline(self):
+        return self.start + self.count * self.every
+
+    def advance(self, now):
+        if self.sensor.every != self.every:
+            # re-anchor on the current deadline with the new interval
+            self.start = self.deadline
+            self.every = self.sensor.every
+            self.count = 0
+
+        self.count += 1
+        if self.deadline <= now:
+            behind = int((now - self.start) // self.every) + 1
+            self.missed += behind - self.count
+            self.count = behind
+
+
+class Scheduler:
+    """Read sensors at absolute deadlines
+
+    The nth reading of a sensor is due at `start + n * every` so time spent
+    reading and queueing does not accumulate as drift. Deadlines for all
+    sensors are kept in one heap with a single loop timer armed for the
+    earliest of them.
+
+    Deadlines that pass while a sensor's previous reading is still in
+    progress, or while the loop was blocked, are skipped and reported as a
+    LogMessage with the sensor's next reading.
+    """
+    def __init__(self):
+        self._heap = []
+        self._entries = {}
+        self._counter = itertools.count()
+        self._looper = None
+        self._timer = None
+
+    def add(self, sensor, start=None):
+        if start is None:
+            start = self._looper.loop.time()
+        entry = ScheduledSensor(sensor, start)
+        previous = self._entries.get(sensor.name)
+        if previous:
+            previous.cancelled = True
+            entry.task = previous.task
+        self._entries[sensor.name] = entry
+        self._push(entry)
+
+    def reschedule(self, sensor):
+        if self._looper is not None and not self._looper.stopping:
+            self.add(sensor)
+
+    def _push(self, entry):
+        heapq.heappush(
+            self._heap, (entry.deadline, next(self._counter), entry)
+        )
+        if self._heap[0][2] is entry:
+            self._arm()
+
+    def _arm(self):
+        if self._timer:
+            self._timer.cancel()
+            self._timer = None
+        if self._heap and not self._looper.stopping:
+            self._timer = self._looper.loop.call_at(
+                self._heap[0][0], self._tick
+            )
+
+    def _tick(self):
+        self._timer = None
+        if self._looper.stopping:
+            return
+        now = self._looper.loop.time()
+        while self._heap and self._heap[0][0] <= now:
+            _, _, entry = heapq.heappop(self._heap)
+            if entry.cancelled:
+                continue
+            self._fire(entry, now)
+            entry.advance(now)
+            heapq.heappush(
+                self._heap, (entry.deadline, next(self._counter), entry)
+            )
+        self._arm()
+
+    def _fire(self, entry, now):
+        name = entry.sensor.name
+        self._looper.metrics.histogram(
+            'bobnet_schedule_lateness_seconds',
+            'Time from a deadline to the timer firing for it', ['sensor']
+        ).observe(now - entry.deadline, sensor=name)
+        if entry.task is not None and not entry.task.done():
+            entry.missed += 1
+            return
+        missed, entry.missed = entry.missed, 0
+        entry.task = self._looper.loop.create_task(
+            self._sample(entry.sensor, missed)
+        )
+
+    async def _sample(self, sensor, missed):
+        if missed:
+            self._looper.metrics.counter(
+                'bobnet_missed_deadlines_total', 'Deadlines skipped',
+                ['sensor']
+            ).inc(missed, sensor=sensor.name)
+            logger.warning(f'{sensor} missed {missed} deadlines')
+            await self._looper.send_queue.put(LogMessage.error(
+                f'Missed {missed} deadlines for {sensor.name}'
+            ))
+        await sensor.sample(self._looper)
+
+    async def run(self, sensors, looper):
+        self._looper = looper
+        start = looper.loop.time()
+        for sensor in sensors:
+            self.add(sensor, start)
+
+        await looper.stop_event.wait_async()
+
+        self._arm()
+        tasks = [
+            entry.task for entry in self._entries.values()
+            if entry.task is not None
+        ]
+        if tasks:
+            await asyncio.wait(tasks, loop=looper.loop)
+
+
+def parse_every(t):
+    every = parse_time(t)
+    if every <= 0:
+        raise ValueError(f'Invalid interval {t}')
+    return every
+
+
+def get_device_module(device):
+    return importlib.import_module(f'.{device}', __package__)
+
+
 def get_device_class(device):
-    return importlib.import_module(f'.{device}', __package__).Device
+    return get_device_module(device).Device
+
+
+def freeze(value):
+    if isinstance(value, dict):
+        return frozenset((k, freeze(v)) for k, v in value.items())
+    elif isinstance(value, (list, tuple)):
+        return tuple(map(freeze, value))
+    return value
 
 
 class Sensor:
     @staticmethod
-    def create(name, config):
+    def create(name, config, registry=None, recorder=None):
         config = config.copy()
         device = config.pop('device')
         every = config.pop('every', None)
-        Device = get_device_class(device)
-        return Sensor(name, every, Device(**config))
+        timeout = config.pop('timeout', None)
+        deadband = config.pop('deadband', None)
+        aggregate = config.pop('aggregate', None)
+        history = config.pop('history', None)
+        if registry is not None:
+            device = registry.get(device, config)
+        else:
+            device = get_device_class(device)(**config)
+        if recorder is not None:
+            device = RecordedDevice(device, recorder, name)
+        sensor = Sensor(name, every, device, timeout=timeout,
+                        deadband=deadband, aggregate=aggregate,
+                        history=history)
+        if device.min_read_time > sensor.timeout:
+            raise ValueError(
+                f'Reads of {name} take {device.min_read_time}s, longer than '
+                f'its {sensor.timeout}s timeout'
+            )
+        return sensor
 
-    def __init__(self, name, every, device):
+    def __init__(self, name, every, device, timeout=None, deadband=None,
+                 aggregate=None, history=None):
         self._name = name
-        self._every = parse_time(every or '30s')
+        self._every = parse_every(every or '30s')
+        self._timeout = parse_time(timeout or '10s')
+        self._deadband = Deadband.from_config(deadband) if deadband else None
+        self._aggregator = \
+            Aggregator.from_config(aggregate) if aggregate else None
+        # opt in, the ring is allocated up front
+        self._history = \
+            History.from_config(history) if history is not None else None
         self._device = device
+        self._pending_read = None
         logger.debug(
             f'Created {self} values every {self.every}s from {self.device}')
 
@@ -126,32 +324,117 @@ class Sensor:
     def every(self):
         return self._every
 
+    @property
+    def timeout(self):
+        return self._timeout
+
+    @property
+    def deadband(self):
+        return self._deadband
+
+    @property
+    def aggregator(self):
+        return self._aggregator
+
+    @property
+    def history(self):
+        return self._history
+
     @property
     def device(self):
         return self._device
 
+    @property
+    def run_command(self):
+        # sensors only take commands if their device does
+        run_command = self.device.run_command
+
+        async def run(looper):
+            data = await run_command(looper)
+            if data is not None:
+                await looper.send_queue.put(DataMessage(self.name, data))
+        return run
+
     def update_config(self, config):
         logger.debug(f'update config on {self} with {config}')
         try:
             if config.get('every'):
-                self._every = parse_time(config['every'])
+                self._every = parse_every(config['every'])
+            if config.get('timeout'):
+                self._timeout = parse_time(config['timeout'])
+            if 'deadband' in config:
+                deadband = config['deadband']
+                self._deadband = \
+                    Deadband.from_config(deadband) if deadband else None
+            if 'aggregate' in config:
+                aggregate = config['aggregate']
+                self._aggregator = \
+                    Aggregator.from_config(aggregate) if aggregate else None
 
             self.device.update_config(config)
             return (True, '')
         except Exception as e:
             return (False, str(e))
 
-    async def run(self, looper):
-        logger.debug(f'Starting {self}')
-        while not looper.stopping:
-            value = {
-                'sensor': self.name,
-                'value': self.device.value,
-            }
-            await looper.send_queue.put(value)
-            logger.debug(f'Sent value {value}')
-            await looper.wait_for(self.every)
-        logger.debug(f'Stopping {self}')
+    async def read(self, looper):
+        """Read the device value on the looper's executor
+
+        Returns the reading, or a LogMessage if the read failed, timed out or
+        a previous timed out read is still blocking the device.
+        """
+        errors = looper.metrics.counter(
+            'bobnet_read_errors_total', 'Failed device reads',
+            ['sensor', 'reason']
+        )
+        if self._pending_read and not self._pending_read.done():
+            errors.inc(sensor=self.name, reason='busy')
+            return LogMessage.error(
+                f'Skipped reading {self.name}, previous read still running'
+            )
+
+        start = looper.loop.time()
+        self._pending_read = looper.run_blocking(
+            read_device_value, self.device
+        )
+        try:
+            value = await asyncio.wait_for(
+                asyncio.shield(self._pending_read, loop=looper.loop),
+                self.timeout,
+                loop=looper.loop
+            )
+        except asyncio.TimeoutError:
+            errors.inc(sensor=self.name, reason='timeout')
+            return LogMessage.error(
+                f'Timed out reading {self.name} after {self.timeout}s'
+            )
+        except Exception as e:
+            errors.inc(sensor=self.name, reason='error')
+            return LogMessage.error(f'Error reading {self.name}: {e}')
+        looper.metrics.histogram(
+            'bobnet_read_seconds', 'Device read latency', ['sensor']
+        ).observe(looper.loop.time() - start, sensor=self.name)
+
+        return {
+            'sensor': self.name,
+            'value': value,
+        }
+
+    async def sample(self, looper):
+        value = await self.read(looper)
+        if self.history is not None and isinstance(value, dict):
+            self.history.append(int(clock.time() * 1000), value['value'])
+        if self.aggregator and isinstance(value, dict):
+            summary = self.aggregator.add(value['value'], looper.loop.time())
+            if summary is None:
+                return
+            value = {'sensor': self.name, 'value': summary}
+        if self.deadband and isinstance(value, dict) and \
+                not self.deadband.should_send(value['value'],
+                                              looper.loop.time()):
+            logger.debug(f'Value within deadband {value}')
+            return
+        await looper.send_queue.put(value)
+        logger.debug(f'Sent value {value}')
 
     def __repr__(self):
         return f'<Sensor name={self.name}>'
@@ -163,9 +446,139 @@ class BaseDevice(metaclass=ABCMeta):
     def value(self):
         pass
 
+    @property
+    def min_read_time(self):
+        """How long a read takes at least, in seconds"""
+        return 0
+
+    def share_lock(self, lock):
+        """Hold `lock` only while using the shared resource
+
+        Returns False to have reads hold it throughout, which devices with
+        short reads do.
+        """
+        return False
+
     def update_config(self, config):
         pass
 
 
+class SharedReads:
+    """The last read of the sensors with the same device config"""
+    def __init__(self):
+        self.value = None
+        self.read_at = None
+        self.readers = set()
+
+
+class SharedDevice(BaseDevice):
+    """A sensor's device on a physical resource shared with other sensors
+
+    Reads hold the lock of the resource. With `reads`, a read that starts
+    within `coalesce` seconds of the end of another sensor's read of the
+    same device config returns that value rather than reading the hardware
+    again. A sensor never gets the same read twice. Devices that take the
+    lock themselves, with `share_lock`, hold it for the parts of a read
+    that use the resource and their reads are never shared.
+    """
+    def __init__(self, device, lock, reads=None, coalesce=0.05):
+        self.device = device
+        self.lock = lock
+        self.locks_itself = device.share_lock(lock)
+        self.reads = None if self.locks_itself else reads
+        self.coalesce = coalesce
+
+    @property
+    def min_read_time(self):
+        return self.device.min_read_time
+
+    @property
+    def value(self):
+        if self.locks_itself:
+            return self.device.value
+        with self.lock:
+            reads = self.reads
+            if reads is None:
+                return self.device.value
+            if self not in reads.readers and reads.read_at is not None and \
+                    clock.monotonic() - reads.read_at <= self.coalesce:
+                reads.readers.add(self)
+                return reads.value
+            reads.value = self.device.value
+            reads.read_at = clock.monotonic()
+            reads.readers = {self}
+            return reads.value
+
+    def update_config(self, config):
+        self.device.update_config(config)
+
+    def __getattr__(self, name):
+        return getattr(self.device, name)
+
+    def __repr__(self):
+        return f'<SharedDevice {self.device}>'
+
+
+class RecordedDevice(BaseDevice):
+    """A device whose values are appended to a recording as they are read"""
+    def __init__(self, device, recorder, sensor):
+        self.device = device
+        self.recorder = recorder
+        self.sensor = sensor
+
+    @property
+    def value(self):
+        value = self.device.value
+        self.recorder.record(self.sensor, clock.time(), value)
+        return value
+
+    @property
+    def min_read_time(self):
+        return self.device.min_read_time
+
+    def update_config(self, config):
+        self.device.update_config(config)
+
+    def __getattr__(self, name):
+        return getattr(self.device, name)
+
+    def __repr__(self):
+        return f'<RecordedDevice {self.device}>'
+
+
+class DeviceRegistry:
+    """Locks and reads shared between sensors on the same hardware
+
+    Each sensor has a device of its own. Devices on the same physical
+    resource, which a device module names with a `resource(config)`
+    function, share one lock so reads do not contend, and with a
+    `coalesce` window sensors with the same device config share reads.
+    Devices without a resource, like counters and synthetic devices, share
+    nothing.
+    """
+    def __init__(self, coalesce=0.05):
+        self.coalesce = coalesce
+        self._locks = collections.defaultdict(threading.Lock)
+        self._reads = collections.defaultdict(SharedReads)
+
+    def get(self, device, config):
+        module = get_device_module(device)
+        resource = getattr(module, 'resource', None)
+        resource = resource(config) if resource else None
+        if resource is None:
+            return module.Device(**config)
+        reads = None
+        if self.coalesce:
+            reads = self._reads[device, freeze(config)]
+        return SharedDevice(
+            module.Device(**config), self._locks[device, resource], reads,
+            self.coalesce
+        )
+
+
+def read_device_value(device):
+    return device.value
+
+
 def load_sensors(config):
     return Sensors.from_config(config)
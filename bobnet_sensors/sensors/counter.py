@@ -1,14 +1,23 @@
 from . import BaseDevice
+from .. import clock
 
 
 class Device(BaseDevice):
-    def __init__(self, start=0):
+    """A count that goes up by one with each read
+
+    With `timestamp` each value also has the time it was read, in seconds
+    since the epoch, so the latency of the pipeline can be measured.
+    """
+    def __init__(self, start=0, timestamp=False):
         self._count = start
+        self._timestamp = timestamp
 
     @property
     def value(self):
         v = self._count
         self._count += 1
+        if self._timestamp:
+            return {'count': v, 'time': clock.time()}
         return {'count': v}
 
     def __repr__(self):
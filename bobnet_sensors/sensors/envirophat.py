@@ -1,8 +1,13 @@
+import array
+import collections
 import functools
 import logging
+import threading
+import time
 
 import bobnet_sensors
 from . import BaseDevice
+from .. import features
 
 try:
     import envirophat
@@ -15,28 +20,93 @@ except ImportError:
 logger = logging.getLogger(__name__)
 
 
-@functools.singledispatch
-def read_sensor_value(sensor):
-    module, method = sensor.split('.')
+SENSORS = {
+    'light': ['rgb', 'light'],
+    'weather': ['temperature', 'pressure', 'altitude'],
+    'motion': ['accelerometer', 'magnetometer', 'heading'],
+}
+AXES = ('x', 'y', 'z')
+
+
+def read_light(light):
+    """rgb and light from one read of the TCS3472 colour channels"""
+    r, g, b, c = light.raw()
+    if c == 0:
+        rgb = (0, 0, 0)
+    else:
+        rgb = tuple(int(float(x) / c * 255) for x in (r, g, b))
+    return {'rgb': rgb, 'light': c}
+
+
+def read_weather(weather, qnh=1020):
+    """temperature, pressure and altitude from one BMP280 update"""
+    # the envirophat accessors each update the BMP280 and keep the
+    # compensated temperature and pressure from it
+    weather.update()
+    pressure = weather._pressure
     return {
-        sensor: getattr(getattr(envirophat, module), method)()
+        'temperature': weather._temperature,
+        'pressure': pressure,
+        'altitude': 44330.0 * (1.0 - pow(pressure / (qnh * 100), 1 / 5.255)),
     }
 
 
-@read_sensor_value.register(dict)
+SHARED_READS = {
+    'light': read_light,
+    'weather': read_weather,
+}
+
+
+@functools.singledispatch
+def sensor_label(sensor):
+    return sensor, sensor
+
+
+@sensor_label.register(dict)
 def _(sensor):
-    name = sensor['sensor']
-    label = sensor['label']
+    return sensor['sensor'], sensor['label']
 
-    return {label: read_sensor_value(name)[name]}
+
+def read_one(accessor, label, result):
+    result[label] = accessor()
+
+
+def read_shared(read_chip, chip, labels, result):
+    values = read_chip(chip)
+    for label, method in labels:
+        result[label] = values[method]
+
+
+def compile_reads(sensors):
+    """Resolve the sensors to one read per chip
+
+    A chip with one sensor is read with its envirophat accessor, a chip
+    with several is read once and the values shared between them.
+    """
+    chips = collections.OrderedDict()
+    for sensor in sensors:
+        name, label = sensor_label(sensor)
+        chip, method = name.split('.')
+        chips.setdefault(chip, []).append((label, method))
+
+    reads = []
+    for chip, labels in chips.items():
+        module = getattr(envirophat, chip)
+        if len(labels) == 1 or chip not in SHARED_READS:
+            reads.extend(
+                functools.partial(read_one, getattr(module, method), label)
+                for label, method in labels
+            )
+        else:
+            reads.append(functools.partial(
+                read_shared, SHARED_READS[chip], module, labels
+            ))
+    return reads
 
 
 @functools.singledispatch
 def validate_sensor(sensor):
-    allowed = {
-        'light': ['rgb', 'light'],
-        'weather': ['temperature', 'pressure', 'altitude'],
-    }
+    allowed = SENSORS
     try:
         parts = sensor.split('.', maxsplit=1)
     except AttributeError:
@@ -47,8 +117,6 @@ def validate_sensor(sensor):
         raise ValueError
     if parts[1] not in allowed[parts[0]]:
         raise ValueError
-    if parts[0] not in ['light', 'weather']:
-        raise ValueError
 
 
 @validate_sensor.register(dict)
@@ -58,24 +126,128 @@ def _(sensor):
         raise ValueError
 
 
+def resource(config):
+    # every sensor is on the one board's I2C bus
+    return 'i2c'
+
+
+class Motion:
+    """Vibration features from bursts of LSM303D samples
+
+    Each read samples the motion `sensors` `samples` times at `rate` Hz,
+    into preallocated buffers, and reduces each axis to its RMS and peak
+    to peak with the mean (gravity for the accelerometer) removed, and to
+    the share of its power in each of the frequency `bands` if set. `lock`
+    is held for each sample, not for the whole window, so other reads of
+    the bus can go in between.
+    """
+    def __init__(self, sensors=('accelerometer',), samples=256, rate=100,
+                 bands=None, lock=None):
+        for sensor in sensors:
+            if sensor not in ('accelerometer', 'magnetometer'):
+                raise ValueError(f'Invalid motion sensor {sensor}')
+        if samples < 2:
+            raise ValueError(f'Invalid motion samples {samples}')
+        if rate <= 0:
+            raise ValueError(f'Invalid motion rate {rate}')
+        self.bands = [tuple(band) for band in bands or []]
+        if self.bands:
+            features.require_numpy('Band energies')
+        self.sensors = list(sensors)
+        self.samples = samples
+        self.rate = rate
+        self.lock = lock or threading.Lock()
+        self._accessors = [
+            getattr(envirophat.motion, sensor) for sensor in self.sensors
+        ]
+        if features.numpy is not None:
+            self._buffers = [
+                features.numpy.zeros((len(AXES), samples))
+                for _ in self.sensors
+            ]
+        else:
+            self._buffers = [
+                [array.array('d', bytes(8 * samples)) for _ in AXES]
+                for _ in self.sensors
+            ]
+
+    @property
+    def window(self):
+        return self.samples / self.rate
+
+    def sample(self):
+        """Fill the buffers, returning the sample rate achieved"""
+        interval = 1 / self.rate
+        readings = list(zip(self._accessors, self._buffers))
+        start = time.perf_counter()
+        for i in range(self.samples):
+            delay = start + i * interval - time.perf_counter()
+            if delay > 0:
+                time.sleep(delay)
+            with self.lock:
+                for accessor, buffer in readings:
+                    x, y, z = accessor()
+                    buffer[0][i] = x
+                    buffer[1][i] = y
+                    buffer[2][i] = z
+        elapsed = time.perf_counter() - start
+        return self.samples / elapsed if elapsed else self.rate
+
+    def read(self, result):
+        rate = self.sample()
+        result['motion.rate'] = rate
+        for sensor, buffer in zip(self.sensors, self._buffers):
+            for axis, samples in zip(AXES, buffer):
+                samples = features.remove_dc(features.as_samples(samples))
+                prefix = f'{sensor}.{axis}'
+                result[f'{prefix}.rms'] = features.rms(samples)
+                result[f'{prefix}.peak_to_peak'] = \
+                    features.peak_to_peak(samples)
+                energies = features.band_energies(samples, rate, self.bands) \
+                    if self.bands else []
+                for (low, high), energy in zip(self.bands, energies):
+                    result[f'{prefix}.band_{low:g}_{high:g}'] = energy
+
+    def __repr__(self):
+        return f'<Motion samples={self.samples} rate={self.rate}>'
+
+
 class Device(BaseDevice):
-    def __init__(self, sensor=None, sensors=None):
+    def __init__(self, sensor=None, sensors=None, motion=None):
         if sensor is not None:
             self.sensors = [sensor]
         elif sensors:
             self.sensors = sensors
+        elif motion is not None:
+            self.sensors = []
         else:
             raise ValueError
         list(map(validate_sensor, self.sensors))
+        self._reads = compile_reads(self.sensors)
+        self.lock = threading.Lock()
+        self.motion = None
+        if motion is not None:
+            self.motion = Motion(lock=self.lock, **motion)
+
+    @property
+    def min_read_time(self):
+        return self.motion.window if self.motion is not None else 0
+
+    def share_lock(self, lock):
+        # hold the bus per motion sample rather than for the whole window
+        if self.motion is None:
+            return False
+        self.lock = self.motion.lock = lock
+        return True
 
     @property
     def value(self):
-        values = [
-            read_sensor_value(sensor) for sensor in self.sensors
-        ]
         result = {}
-        for value in values:
-            result.update(value)
+        with self.lock:
+            for read in self._reads:
+                read(result)
+        if self.motion is not None:
+            self.motion.read(result)
         return result
 
     def update_config(self, config):
@@ -1,66 +1,387 @@
+import array
+import collections
+import itertools
 import logging
+import statistics
+import threading
+import time
 
 import bobnet_sensors
 from . import BaseDevice
+from .. import features
 
 try:
-    from gpiozero import MCP3008
+    from gpiozero import SPIDevice
     import RPi
 except ImportError:
     # dummies for unit testing
     if not bobnet_sensors.TESTING:
         raise
-    MCP3008 = None
+    SPIDevice = None
     RPi = None
 
+try:
+    import spidev
+except ImportError:
+    # only needed for hardware SPI
+    spidev = None
+
 
 logger = logging.getLogger(__name__)
 
+MAX_RAW = 1023
+
+# one lock per physical bus so reads from devices sharing it do not overlap
+_bus_locks = collections.defaultdict(threading.Lock)
+# gpiozero devices by pins, so devices on the same chip do not reopen pins
+_spi_devices = {}
+
 
 def validate_channel(channel):
     try:
         c = int(channel.get('channel'))
-        if c < 0 or c > 8:
+        if c < 0 or c > 7:
             raise ValueError
     except (TypeError, ValueError):
         raise ValueError(f'Invalid channel {channel.get("channel")}')
     if not isinstance(channel.get('label'), str):
         raise ValueError('Label not set')
+    try:
+        if int(channel.get('chip', 0)) < 0:
+            raise ValueError
+    except (TypeError, ValueError):
+        raise ValueError(f'Invalid chip {channel.get("chip")}')
+    try:
+        if int(channel.get('oversample', 1)) < 1:
+            raise ValueError
+    except (TypeError, ValueError):
+        raise ValueError(f'Invalid oversample {channel.get("oversample")}')
+    if channel.get('reduce', 'mean') not in REDUCERS:
+        raise ValueError(f'Invalid reduce {channel.get("reduce")}')
+    if not 0 <= channel.get('trim', 0.1) < 0.5:
+        raise ValueError(f'Invalid trim {channel.get("trim")}')
+    if 'capture' in channel:
+        if not isinstance(channel['capture'], dict):
+            raise ValueError(f'Invalid capture {channel["capture"]}')
+        if 'oversample' in channel:
+            raise ValueError('Cannot oversample a captured channel')
+
+
+def trimmed_mean(samples, trim=0.1):
+    """Mean without the `trim` fraction of samples at either end"""
+    cut = int(len(samples) * trim)
+    samples = sorted(samples)[cut:len(samples) - cut]
+    return sum(samples) / len(samples)
+
+
+REDUCERS = {
+    'mean': lambda samples, trim: sum(samples) / len(samples),
+    'median': lambda samples, trim: statistics.median(samples),
+    'trimmed_mean': trimmed_mean,
+}
+
+
+def channel_message(channel):
+    """Start bit, then single ended mode and the channel number"""
+    return [0x01, (0x08 | channel) << 4, 0x00]
+
 
+def parse_response(response):
+    return ((response[1] & 0x03) << 8) | response[2]
 
-def read_channel_value(channel):
-    return {
-        channel['label']: channel['client'].value
-    }
+
+def spi_device(clock_pin, mosi_pin, miso_pin, select_pin):
+    pins = (clock_pin, mosi_pin, miso_pin, select_pin)
+    if pins not in _spi_devices:
+        RPi.GPIO.setmode(RPi.GPIO.BCM)
+        _spi_devices[pins] = SPIDevice(
+            clock_pin=clock_pin,
+            mosi_pin=mosi_pin, miso_pin=miso_pin, select_pin=select_pin
+        )
+    return _spi_devices[pins]
+
+
+class GPIOZeroBus:
+    """Software SPI on the GPIO pins through gpiozero
+
+    Each chip has its own select pin, the first chip's is `select_pins[0]`.
+    Software SPI has no bulk transfer, each message is bit-banged with its
+    own chip select cycle, so this bus only saves opening a gpiozero device
+    per channel. Use the `spidev` bus where read speed matters.
+    """
+    def __init__(self, clock_pin=18, mosi_pin=24, miso_pin=23,
+                 select_pins=(25,)):
+        if isinstance(select_pins, int):
+            select_pins = [select_pins]
+        self.lock = _bus_locks['gpiozero', clock_pin, mosi_pin, miso_pin]
+        self._devices = [
+            spi_device(clock_pin, mosi_pin, miso_pin, select_pin)
+            for select_pin in select_pins
+        ]
+
+    @property
+    def chips(self):
+        return len(self._devices)
+
+    def transfer_many(self, messages, chip=0):
+        # gpiozero has no public transfer, its own MCP3xxx classes use the
+        # SPI interface directly in the same way
+        spi = self._devices[chip]._spi
+        return [spi.transfer(message) for message in messages]
+
+    def close(self):
+        # the gpiozero devices are shared with other buses on the same pins
+        pass
+
+    def __repr__(self):
+        return f'<GPIOZeroBus chips={self.chips}>'
+
+
+class SpidevBus:
+    """Hardware SPI through the spidev kernel driver
+
+    Chip `n` is the device on chip enable `n` of SPI `port`, that is
+    /dev/spidev<port>.<n>.
+    """
+    def __init__(self, port=0, max_speed_hz=1350000, chips=2):
+        if spidev is None:
+            raise ValueError('spidev is not installed')
+        self.port = port
+        self.max_speed_hz = max_speed_hz
+        self.chips = chips
+        self.lock = _bus_locks['spidev', port]
+        self._devices = {}
+
+    def _device(self, chip):
+        if chip not in self._devices:
+            device = spidev.SpiDev()
+            device.open(self.port, chip)
+            device.max_speed_hz = self.max_speed_hz
+            device.mode = 0
+            self._devices[chip] = device
+        return self._devices[chip]
+
+    def transfer_many(self, messages, chip=0):
+        device = self._device(chip)
+        # select is released between messages to start each conversion
+        return [device.xfer2(message) for message in messages]
+
+    def close(self):
+        for device in self._devices.values():
+            device.close()
+        self._devices = {}
+
+    def __repr__(self):
+        return (f'<SpidevBus port={self.port} '
+                f'max_speed_hz={self.max_speed_hz}>')
+
+
+class FakeBus:
+    """An MCP3008 simulated in memory for tests
+
+    `values` maps the channels of the first chip to raw readings, or to
+    functions returning them, and `chips` maps further chips to their
+    values.
+    """
+    def __init__(self, values=None, chips=None):
+        self.values = {0: values or {}}
+        self.values.update(
+            (int(chip), chip_values) for chip, chip_values in
+            (chips or {}).items()
+        )
+        self.values = {
+            chip: {int(k): v for k, v in chip_values.items()}
+            for chip, chip_values in self.values.items()
+        }
+        self.chips = max(self.values) + 1
+        self.lock = threading.Lock()
+        self.transfers = 0
+
+    def transfer_many(self, messages, chip=0):
+        return [self._transfer(message, chip) for message in messages]
+
+    def _transfer(self, message, chip):
+        self.transfers += 1
+        channel = (message[1] >> 4) & 0x07
+        raw = self.values.get(chip, {}).get(channel, 0)
+        if callable(raw):
+            raw = raw()
+        return [0x00, (raw >> 8) & 0x03, raw & 0xff]
+
+    def close(self):
+        pass
+
+    def __repr__(self):
+        return f'<FakeBus transfers={self.transfers}>'
+
+
+BUSES = {
+    'gpiozero': GPIOZeroBus,
+    'spidev': SpidevBus,
+    'fake': FakeBus,
+}
+
+
+def bus_key(config):
+    """The physical bus a bus config uses, None for a fake bus"""
+    config = config or {}
+    bus_type = config.get('type', 'gpiozero')
+    if bus_type == 'gpiozero':
+        return (
+            bus_type,
+            config.get('clock_pin', 18),
+            config.get('mosi_pin', 24),
+            config.get('miso_pin', 23),
+        )
+    elif bus_type == 'spidev':
+        return bus_type, config.get('port', 0)
+
+
+def resource(config):
+    return bus_key(config.get('bus'))
+
+
+def create_bus(config):
+    config = dict(config or {})
+    bus_type = config.pop('type', 'gpiozero')
+    try:
+        Bus = BUSES[bus_type]
+    except KeyError:
+        raise ValueError(f'Unknown bus {bus_type}')
+    return Bus(**config)
+
+
+class Capture:
+    """A burst of samples from one channel in a preallocated buffer
+
+    The burst is reduced to features of the waveform, see
+    `features.burst_features`, and the raw samples of the last burst are
+    kept until the next one.
+    """
+    def __init__(self, message, samples=1024, frequency=False, ac=True):
+        if samples < 2:
+            raise ValueError(f'Invalid capture samples {samples}')
+        if frequency:
+            features.require_numpy('Dominant frequency')
+        self.samples = samples
+        self.frequency = frequency
+        self.ac = ac
+        self.messages = [message] * samples
+        self.rate = None
+        if features.numpy is not None:
+            self.buffer = features.numpy.zeros(samples, dtype='uint16')
+        else:
+            self.buffer = array.array('H', bytes(2 * samples))
+
+    def record(self, responses, elapsed):
+        self.rate = self.samples / elapsed if elapsed else None
+        if features.numpy is not None:
+            data = features.numpy.array(responses, dtype='uint16')
+            features.numpy.bitwise_or(
+                (data[:, 1] & 0x03) << 8, data[:, 2], out=self.buffer
+            )
+        else:
+            for i, response in enumerate(responses):
+                self.buffer[i] = parse_response(response)
+
+    def features(self):
+        return features.burst_features(
+            self.buffer / MAX_RAW if features.numpy is not None else
+            [sample / MAX_RAW for sample in self.buffer],
+            rate=self.rate, frequency=self.frequency, ac=self.ac
+        )
+
+    def raw(self):
+        return {
+            'rate': self.rate,
+            'samples': [int(sample) for sample in self.buffer],
+        }
+
+
+def channel_address(channel):
+    return int(channel.get('chip', 0)), int(channel['channel'])
 
 
 class Device(BaseDevice):
-    def __init__(self, channels):
+    """Channels of one or more MCP3008 analog to digital converters
+
+    Chips share the bus and are told apart by their chip select. All
+    channels are read while holding the bus, chip by chip with one
+    conversion per message, and values are scaled from 0 to 1.
+
+    A channel with `oversample` set is read that many times in the same
+    burst and its value is the `reduce` (mean, median or trimmed_mean) of
+    the samples.
+
+    A channel with `capture` set is read in a burst of `samples`
+    conversions as fast as the bus allows, and features of the waveform
+    are published in place of its value, e.g. `current.rms`. The raw
+    samples of the last bursts are published by running a command.
+    """
+    def __init__(self, channels, bus=None):
         if not channels:
             raise ValueError('No channels')
         list(map(validate_channel, channels))
-        if len(set(c['channel'] for c in channels)) != len(channels):
+        if len(set(map(channel_address, channels))) != len(channels):
             raise ValueError('Duplicate channels used')
 
         self.channels = channels
+        self.bus = create_bus(bus)
 
-        RPi.GPIO.setmode(RPi.GPIO.BCM)
-        for channel in self.channels:
-            channel['client'] = MCP3008(
-                channel=channel['channel'],
-                clock_pin=18,
-                mosi_pin=24, miso_pin=23, select_pin=25
-            )
+        chips = collections.OrderedDict()
+        self._captures = []
+        for channel in sorted(channels, key=channel_address):
+            chip, number = channel_address(channel)
+            if chip >= self.bus.chips:
+                raise ValueError(f'Invalid chip {chip}')
+            if 'capture' in channel:
+                self._captures.append((chip, channel['label'], Capture(
+                    channel_message(number), **channel['capture']
+                )))
+                continue
+            reads, messages = chips.setdefault(chip, ([], []))
+            oversample = int(channel.get('oversample', 1))
+            reads.append((
+                channel['label'], oversample,
+                REDUCERS[channel.get('reduce', 'mean')],
+                channel.get('trim', 0.1),
+            ))
+            messages.extend([channel_message(number)] * oversample)
+        self._chips = list(chips.items())
 
     @property
     def value(self):
-        values = [
-            read_channel_value(channel) for channel in self.channels
-        ]
         result = {}
-        for value in values:
-            result.update(value)
+        with self.bus.lock:
+            responses = [
+                (reads, self.bus.transfer_many(messages, chip))
+                for chip, (reads, messages) in self._chips
+            ]
+            for chip, label, capture in self._captures:
+                start = time.perf_counter()
+                burst = self.bus.transfer_many(capture.messages, chip)
+                capture.record(burst, time.perf_counter() - start)
+        for reads, chip_responses in responses:
+            samples = map(parse_response, chip_responses)
+            for label, oversample, reduce, trim in reads:
+                if oversample == 1:
+                    raw = next(samples)
+                else:
+                    raw = reduce(
+                        list(itertools.islice(samples, oversample)), trim
+                    )
+                result[label] = raw / MAX_RAW
+        for chip, label, capture in self._captures:
+            for name, value in capture.features().items():
+                result[f'{label}.{name}'] = value
         return result
 
+    async def run_command(self, looper):
+        if self._captures:
+            return {
+                label: capture.raw()
+                for chip, label, capture in self._captures
+            }
+
     def __repr__(self):
         return f'<mcp3008.Device with {len(self.channels)} channels>'
@@ -0,0 +1,73 @@
+"""Replay a recording of a sensor's reads
+
+Each read returns the recorded value that was current at the same point in
+the recording, with the recording's clock running `speed` times faster
+than real time from the first read. With `speed: max` each read returns the
+next recorded value, so a recording can be played through as fast as the
+sensor is read.
+
+`sensor` picks the readings of one sensor from a recording of several.
+With `repeat` the recording starts again after its last reading, otherwise
+reads fail once it has been played.
+"""
+from . import BaseDevice
+from .. import clock
+from ..recording import read_recording
+
+MAX_SPEED = 'max'
+
+
+class Device(BaseDevice):
+    def __init__(self, path, sensor=None, speed=1.0, repeat=False):
+        if speed != MAX_SPEED and (
+            not isinstance(speed, (int, float)) or speed <= 0
+        ):
+            raise ValueError(f'Invalid speed {speed}')
+        self.path = path
+        self.sensor = sensor
+        self.speed = speed
+        self.repeat = repeat
+        self.replayed = 0
+        self._records = None
+        self._current = None
+        self._next = None
+        self._start()
+        if self._next is None:
+            raise ValueError(f'No readings to replay in {path}')
+
+    def _start(self):
+        self._records = read_recording(self.path, self.sensor)
+        self._next = next(self._records, None)
+        self._current = None
+        # real and recorded time of the first read
+        self._started = None
+
+    def _advance(self):
+        self._current, self._next = \
+            self._next, next(self._records, None)
+        self.replayed += 1
+
+    def _step(self):
+        if self._next is None:
+            if not self.repeat:
+                raise EOFError('End of recording')
+            self._start()
+        self._advance()
+        if self._started is None:
+            self._started = (clock.monotonic(), self._current[0])
+
+    @property
+    def value(self):
+        if self._current is None or self._next is None or \
+                self.speed == MAX_SPEED:
+            self._step()
+        else:
+            started, recorded = self._started
+            now = recorded + (clock.monotonic() - started) * self.speed
+            while self._next is not None and self._next[0] <= now:
+                self._advance()
+        return self._current[2]
+
+    def __repr__(self):
+        return (f'<replay.Device path={self.path} speed={self.speed} '
+                f'replayed={self.replayed}>')
@@ -0,0 +1,145 @@
+"""Synthetic devices for load testing without hardware
+
+A synthetic device produces values of a configurable shape for each of its
+labels, and can be made to pad its payload, take time to read and fail a
+fraction of its reads so that thousands of them stand in for a fleet of
+real sensors.
+"""
+import math
+import random
+import time
+
+from . import BaseDevice
+from .. import clock
+from ..config import parse_time
+
+
+class Sine:
+    def __init__(self, rng, index, period='60s', amplitude=1.0, offset=0.0):
+        self.period = parse_time(period)
+        if self.period <= 0:
+            raise ValueError(f'Invalid period {period}')
+        self.amplitude = amplitude
+        self.offset = offset
+        # spread the labels of a device over the cycle
+        self.phase = rng.uniform(0, 2 * math.pi) if index else 0.0
+
+    def value(self, now):
+        return self.offset + self.amplitude * math.sin(
+            2 * math.pi * now / self.period + self.phase
+        )
+
+
+class RandomWalk:
+    def __init__(self, rng, index, start=0.0, step=0.1, minimum=None,
+                 maximum=None):
+        self.rng = rng
+        self.current = start
+        self.step = step
+        self.minimum = minimum
+        self.maximum = maximum
+
+    def value(self, now):
+        self.current += self.rng.gauss(0, self.step)
+        if self.minimum is not None:
+            self.current = max(self.current, self.minimum)
+        if self.maximum is not None:
+            self.current = min(self.current, self.maximum)
+        return self.current
+
+
+class Replay:
+    """The configured values in turn, starting again after the last"""
+    def __init__(self, rng, index, values=()):
+        if not values:
+            raise ValueError('No values to replay')
+        self.values = list(values)
+        self.next = 0
+
+    def value(self, now):
+        value = self.values[self.next]
+        self.next = (self.next + 1) % len(self.values)
+        return value
+
+
+class Burst:
+    """`low` with bursts of `high` lasting `length` every `interval`"""
+    def __init__(self, rng, index, interval='60s', length='5s', low=0.0,
+                 high=1.0, noise=0.0):
+        self.rng = rng
+        self.interval = parse_time(interval)
+        self.length = parse_time(length)
+        if not 0 < self.length <= self.interval:
+            raise ValueError(f'Invalid burst length {length}')
+        self.low = low
+        self.high = high
+        self.noise = noise
+
+    def value(self, now):
+        value = self.high if now % self.interval < self.length else self.low
+        if self.noise:
+            value += self.rng.gauss(0, self.noise)
+        return value
+
+
+SHAPES = {
+    'sine': Sine,
+    'random_walk': RandomWalk,
+    'replay': Replay,
+    'burst': Burst,
+}
+
+
+class Device(BaseDevice):
+    """Values of a synthetic `shape` for each label
+
+    `shape` is one of sine, random_walk, replay or burst and is configured
+    by the other keys of the config, e.g. `period` and `amplitude` for a
+    sine. Each read sleeps for `latency` seconds plus up to `jitter`, fails
+    with a probability of `failure_rate` and pads the value with a
+    `padding` string of `payload_bytes` characters. `seed` makes the values
+    repeatable.
+    """
+    def __init__(self, shape='sine', labels=('value',), latency=None,
+                 jitter=None, failure_rate=0.0, payload_bytes=0, seed=None,
+                 **config):
+        try:
+            Shape = SHAPES[shape]
+        except KeyError:
+            raise ValueError(f'Unknown shape {shape}')
+        if isinstance(labels, str):
+            labels = [labels]
+        if not labels:
+            raise ValueError('No labels')
+        if not 0 <= failure_rate <= 1:
+            raise ValueError(f'Invalid failure rate {failure_rate}')
+        if payload_bytes < 0:
+            raise ValueError(f'Invalid payload bytes {payload_bytes}')
+
+        self.shape = shape
+        self.labels = list(labels)
+        self.latency = parse_time(latency) if latency else 0.0
+        self.jitter = parse_time(jitter) if jitter else 0.0
+        self.failure_rate = failure_rate
+        self.padding = 'x' * payload_bytes
+        self._rng = random.Random(seed)
+        self._shapes = [
+            (label, Shape(self._rng, index, **config))
+            for index, label in enumerate(self.labels)
+        ]
+
+    @property
+    def value(self):
+        if self.latency or self.jitter:
+            time.sleep(self.latency + self._rng.uniform(0, self.jitter))
+        if self.failure_rate and self._rng.random() < self.failure_rate:
+            raise RuntimeError('Synthetic read failure')
+        now = clock.time()
+        result = {label: shape.value(now) for label, shape in self._shapes}
+        if self.padding:
+            result['padding'] = self.padding
+        return result
+
+    def __repr__(self):
+        return (f'<synthetic.Device shape={self.shape} '
+                f'labels={len(self.labels)}>')
@@ -18,7 +18,6 @@ install_requires = [
     'paho-mqtt==1.3.1',
     'pyjwt==1.5.3',
     'cryptography==2.1.3',
-    'janus==0.3.0',
 ]
 
 extras_require = {
@@ -26,11 +25,15 @@ extras_require = {
     'mcp3008': [
         'gpiozero==1.4.0',
         'RPi.GPIO==0.6.3',
+        'spidev==3.2',
     ],
     'envirophat': [
         'envirophat==0.0.6',
         'smbus-cffi==0.5.1',
-    ]
+    ],
+    'numpy': [
+        'numpy==1.14.0',
+    ],
 }
 
 setup(
@@ -39,7 +42,7 @@ setup(
     description='Package for running bobnet sensor nodes',
     author='Rob Young',
     author_email='rob@robyoung.digital',
-    packages=find_packages(),
+    packages=find_packages(exclude=['benchmarks']),
 
     install_requires=install_requires,
 
@@ -12,6 +12,9 @@ from bobnet_sensors.sensors import Sensors, Sensor  # noqa: E402
 from bobnet_sensors.async_helper import Looper  # noqa: E402
 
 
+VIRTUAL_START = 1514764800
+
+
 async def return_immediately():
     pass
 
@@ -51,7 +54,18 @@ def loop():
 
 @pytest.fixture
 def looper(loop):
-    return Looper(loop)
+    the_looper = Looper(loop)
+    yield the_looper
+    the_looper.close()
+
+
+@pytest.fixture
+def virtual_looper():
+    """A looper on virtual time starting at 2018-01-01 00:00 UTC"""
+    the_looper = Looper.virtual(start=VIRTUAL_START)
+    yield the_looper
+    the_looper.close()
+    the_looper.loop.close()
 
 
 @pytest.fixture
@@ -113,6 +127,8 @@ def iotcore_connection(looper, private_key):
 @pytest.fixture
 def mock_iotcore_conn(loop):
     mock_connection = mock.Mock()
+    mock_connection.run = AsyncMock()
+    mock_connection.wait_until_connected = AsyncMock()
 
     return mock_connection
 
@@ -151,8 +167,10 @@ def sensor_set():
 
 
 @pytest.fixture(autouse=True)
-def mock_mcp3008():
-    with mock.patch('bobnet_sensors.sensors.mcp3008.MCP3008') as m:
+def mock_spi_device():
+    with mock.patch('bobnet_sensors.sensors.mcp3008.SPIDevice') as m, \
+            mock.patch.dict('bobnet_sensors.sensors.mcp3008._spi_devices',
+                            clear=True):
         yield m
 
 
@@ -1,3 +1,7 @@
+import time
+
+import pytest
+
 from bobnet_sensors.sensors.counter import Device as CounterDevice
 
 
@@ -21,3 +25,12 @@ def test_counter_repr_does_not_affect_value():
 
     assert str(counter) == '<counter.Device count=0>'
     assert counter.value == {'count': 0}
+
+
+def test_counter_with_timestamp():
+    counter = CounterDevice(timestamp=True)
+
+    value = counter.value
+
+    assert value['count'] == 0
+    assert value['time'] == pytest.approx(time.time(), abs=5)
@@ -1,6 +1,12 @@
+import itertools
+import math
+import threading
+
 import pytest
 from unittest import mock
 
+from bobnet_sensors import features
+from bobnet_sensors.sensors import DeviceRegistry, Sensor
 from bobnet_sensors.sensors.envirophat import Device as EnvirophatDevice
 
 
@@ -64,7 +70,7 @@ def test_create_envirophat_fails_with_empty_sensors(mock_envirophat):
     {'sensor': 'weather.pressure', 'label': 'downness'},
     {'sensor': 'weather.altitude', 'label': 'upness'},
 ])
-def test_create_envirophat_with_valid_sensors(sensor):
+def test_create_envirophat_with_valid_sensors(sensor, mock_envirophat):
     d = EnvirophatDevice(sensor=sensor)
 
     assert d.sensors == [sensor]
@@ -120,6 +126,49 @@ def test_value_returns_dict_for_single_sensor_with_label(mock_envirophat):
     assert d.value == {'shiny': 123}
 
 
+def test_accessors_are_resolved_once(mock_envirophat):
+    d = EnvirophatDevice(sensor='light.light')
+    accessor = mock_envirophat.light.light
+    mock_envirophat.light = mock.Mock()
+    accessor.return_value = 123
+
+    assert d.value == {'light.light': 123}
+
+
+def test_sensors_on_one_chip_share_a_read(mock_envirophat):
+    mock_envirophat.light.raw.return_value = (10, 20, 40, 80)
+    mock_envirophat.weather._temperature = 21.5
+    mock_envirophat.weather._pressure = 102000
+    d = EnvirophatDevice(sensors=[
+        'light.rgb',
+        {'sensor': 'light.light', 'label': 'light'},
+        'weather.temperature',
+        'weather.pressure',
+        'weather.altitude',
+    ])
+
+    value = d.value
+
+    assert value == {
+        'light.rgb': (31, 63, 127),
+        'light': 80,
+        'weather.temperature': 21.5,
+        'weather.pressure': 102000,
+        'weather.altitude': 0,
+    }
+    mock_envirophat.light.raw.assert_called_once_with()
+    mock_envirophat.weather.update.assert_called_once_with()
+    assert not mock_envirophat.light.rgb.called
+    assert not mock_envirophat.weather.temperature.called
+
+
+def test_shared_rgb_read_without_light(mock_envirophat):
+    mock_envirophat.light.raw.return_value = (0, 0, 0, 0)
+    d = EnvirophatDevice(sensors=['light.rgb', 'light.light'])
+
+    assert d.value == {'light.rgb': (0, 0, 0), 'light.light': 0}
+
+
 def test_update_config_set_led_on(mock_envirophat):
     d = EnvirophatDevice(sensor='light.light')
     d.update_config({'leds': 'on'})
@@ -134,3 +183,133 @@ def test_update_config_set_led_off(mock_envirophat):
 
     assert not mock_envirophat.leds.on.called
     assert mock_envirophat.leds.off.called
+
+
+@pytest.mark.parametrize('sensor', [
+    'motion.accelerometer',
+    'motion.magnetometer',
+    'motion.heading',
+])
+def test_create_envirophat_with_motion_sensors(sensor, mock_envirophat):
+    d = EnvirophatDevice(sensor=sensor)
+
+    assert d.sensors == [sensor]
+
+
+def test_motion_sensors_are_read_separately(mock_envirophat):
+    mock_envirophat.motion.heading.return_value = 90
+    mock_envirophat.motion.accelerometer.return_value = (0, 0, 1)
+    d = EnvirophatDevice(sensors=['motion.heading', 'motion.accelerometer'])
+
+    assert d.value == {
+        'motion.heading': 90,
+        'motion.accelerometer': (0, 0, 1),
+    }
+
+
+@pytest.mark.parametrize('motion', [
+    {'sensors': ['heading']},
+    {'samples': 1},
+    {'rate': 0},
+])
+def test_create_envirophat_fails_with_invalid_motion(motion, mock_envirophat):
+    with pytest.raises(ValueError):
+        EnvirophatDevice(motion=motion)
+
+
+def vibration(frequency, rate, amplitude=0.5):
+    samples = itertools.count()
+
+    def accelerometer():
+        t = next(samples) / rate
+        return (
+            amplitude * math.sin(2 * math.pi * frequency * t),
+            0.0,
+            1.0,
+        )
+    return accelerometer
+
+
+def test_motion_publishes_vibration_features(mock_envirophat):
+    mock_envirophat.motion.accelerometer.side_effect = vibration(10, 200)
+    d = EnvirophatDevice(motion={'samples': 200, 'rate': 10000})
+
+    value = d.value
+
+    assert mock_envirophat.motion.accelerometer.call_count == 200
+    assert value['accelerometer.x.rms'] == pytest.approx(0.5 / math.sqrt(2))
+    assert value['accelerometer.x.peak_to_peak'] == pytest.approx(1.0)
+    assert value['accelerometer.z.rms'] == 0
+    assert value['accelerometer.z.peak_to_peak'] == 0
+    assert value['motion.rate'] > 0
+
+
+def test_motion_band_energies(mock_envirophat):
+    pytest.importorskip('numpy')
+    mock_envirophat.motion.accelerometer.side_effect = vibration(10, 200)
+    d = EnvirophatDevice(motion={
+        'samples': 200, 'rate': 10000, 'bands': [[0, 5], [5, 20]],
+    })
+    sample = d.motion.sample
+    # features are calculated at the rate achieved, pretend it was 200Hz
+    d.motion.sample = lambda: sample() and 200
+
+    value = d.value
+
+    assert value['accelerometer.x.band_0_5'] == pytest.approx(0, abs=1e-6)
+    assert value['accelerometer.x.band_5_20'] == pytest.approx(1)
+
+
+def test_motion_band_energies_require_numpy(mock_envirophat, monkeypatch):
+    monkeypatch.setattr(features, 'numpy', None)
+
+    with pytest.raises(ValueError):
+        EnvirophatDevice(motion={'bands': [[0, 10]]})
+
+
+def test_motion_without_numpy(mock_envirophat, monkeypatch):
+    monkeypatch.setattr(features, 'numpy', None)
+    mock_envirophat.motion.accelerometer.side_effect = vibration(10, 200)
+    d = EnvirophatDevice(motion={'samples': 200, 'rate': 10000})
+
+    value = d.value
+
+    assert value['accelerometer.x.rms'] == pytest.approx(0.5 / math.sqrt(2))
+
+
+def test_motion_window_must_fit_the_read_timeout(mock_envirophat):
+    config = {
+        'device': 'envirophat',
+        'motion': {'samples': 2000, 'rate': 100},
+    }
+
+    with pytest.raises(ValueError):
+        Sensor.create('vibration', config)
+    sensor = Sensor.create('vibration', {**config, 'timeout': '30s'})
+
+    assert sensor.device.min_read_time == 20
+
+
+def test_motion_releases_the_bus_between_samples(mock_envirophat):
+    registry = DeviceRegistry()
+    motion = registry.get('envirophat', {
+        'motion': {'samples': 3, 'rate': 20},
+    })
+    weather = registry.get('envirophat', {'sensor': 'weather.temperature'})
+    accelerometer = mock_envirophat.motion.accelerometer
+    samples_before_weather = []
+    reader = threading.Thread(target=lambda: weather.value)
+
+    def sample():
+        if accelerometer.call_count == 1:
+            reader.start()
+        return (0.0, 0.0, 1.0)
+    accelerometer.side_effect = sample
+    mock_envirophat.weather.temperature.side_effect = \
+        lambda: samples_before_weather.append(accelerometer.call_count)
+
+    motion.value
+    reader.join()
+
+    # the weather was read part way through the motion window
+    assert samples_before_weather == [1]
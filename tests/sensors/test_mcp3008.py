@@ -1,17 +1,29 @@
 from unittest import mock
+import itertools
+import math
 
 import pytest
 
-from bobnet_sensors.sensors.mcp3008 import Device as MCP3008Device
+from bobnet_sensors import features
+from bobnet_sensors.sensors.mcp3008 import (
+    Device as MCP3008Device, FakeBus, channel_message, parse_response,
+    resource
+)
+
+
+@pytest.fixture
+def mock_spidev():
+    with mock.patch('bobnet_sensors.sensors.mcp3008.spidev') as m:
+        yield m
 
 
 @pytest.mark.parametrize('channel', [
     {'channel': '1', 'label': 'light'},
     {'channel': '0', 'label': 'light'},
-    {'channel': '8', 'label': 'light'},
+    {'channel': '7', 'label': 'light'},
     {'channel': 1, 'label': 'light'},
     {'channel': 0, 'label': 'light'},
-    {'channel': 8, 'label': 'light'},
+    {'channel': 7, 'label': 'light'},
 ])
 def test_create_mcp3008_with_valid_channels(channel):
     MCP3008Device([channel])
@@ -19,6 +31,7 @@ def test_create_mcp3008_with_valid_channels(channel):
 
 @pytest.mark.parametrize('channel', [
     {'channel': -1, 'label': 'light'},
+    {'channel': 8, 'label': 'light'},
     {'channel': 9, 'label': 'light'},
     {'channel': 'blah', 'label': 'light'},
     {},
@@ -36,29 +49,290 @@ def test_create_mcp3008_fails_with_no_channels():
         MCP3008Device([])
 
 
-def test_read_values(mock_mcp3008):
-    clients = [
-        mock.Mock(),
-        mock.Mock(),
-    ]
-    mock_mcp3008.side_effect = clients
-    clients[0].value = 123
-    clients[1].value = 321
+def test_create_mcp3008_fails_with_duplicate_channels():
+    with pytest.raises(ValueError):
+        MCP3008Device([
+            {'channel': 1, 'label': 'a'},
+            {'channel': '1', 'label': 'b'},
+        ])
+
+
+def test_create_mcp3008_fails_with_unknown_bus():
+    with pytest.raises(ValueError):
+        MCP3008Device([{'channel': 0, 'label': 'temp'}], bus={'type': 'bad'})
+
+
+@pytest.mark.parametrize('channel', range(8))
+def test_channel_message_round_trip(channel):
+    bus = FakeBus({channel: 700})
+
+    response = bus.transfer_many([channel_message(channel)])[0]
+
+    assert channel_message(channel)[1] >> 4 == 0x08 | channel
+    assert parse_response(response) == 700
+
+
+def test_read_values():
     channels = [
         {'channel': 0, 'label': 'temp'},
         {'channel': 1, 'label': 'light'},
     ]
-    device = MCP3008Device(channels)
+    device = MCP3008Device(channels, bus={
+        'type': 'fake', 'values': {0: 1023, 1: 0}
+    })
 
     assert device.value == {
-        'temp': 123,
-        'light': 321,
+        'temp': 1.0,
+        'light': 0.0,
     }
 
 
+def test_read_all_channels():
+    channels = [{'channel': c, 'label': str(c)} for c in range(8)]
+    device = MCP3008Device(channels, bus={
+        'type': 'fake', 'values': {c: c * 100 for c in range(8)}
+    })
+
+    value = device.value
+
+    assert device.bus.transfers == 8
+    assert value['5'] == 500 / 1023
+
+
+def test_gpiozero_bus_uses_one_spi_interface(mock_spi_device):
+    spi = mock_spi_device.return_value._spi
+    spi.transfer.side_effect = [[0, 0x03, 0xff], [0, 0x00, 0x00]]
+    channels = [
+        {'channel': 0, 'label': 'temp'},
+        {'channel': 1, 'label': 'light'},
+    ]
+    device = MCP3008Device(channels)
+
+    assert device.value == {'temp': 1.0, 'light': 0.0}
+    mock_spi_device.assert_called_once_with(
+        clock_pin=18, mosi_pin=24, miso_pin=23, select_pin=25
+    )
+    spi.transfer.assert_has_calls([
+        mock.call(channel_message(0)),
+        mock.call(channel_message(1)),
+    ])
+
+
 def test_gpio_mode_is_set(mock_RPi):
     mock_RPi.GPIO.BCM = 'bcm'
 
     MCP3008Device([{'channel': 0, 'label': 'temp'}])
 
     mock_RPi.GPIO.setmode.assert_called_with('bcm')
+
+
+def test_create_mcp3008_fails_with_invalid_chip():
+    with pytest.raises(ValueError):
+        MCP3008Device([{'channel': 0, 'label': 'temp', 'chip': -1}])
+    with pytest.raises(ValueError):
+        MCP3008Device([{'channel': 0, 'label': 'temp', 'chip': 1}])
+
+
+def test_same_channel_on_different_chips():
+    channels = [
+        {'channel': 0, 'label': 'a'},
+        {'channel': 0, 'label': 'b', 'chip': 1},
+    ]
+    device = MCP3008Device(channels, bus={
+        'type': 'fake', 'values': {0: 1023}, 'chips': {1: {0: 0}},
+    })
+
+    assert device.value == {'a': 1.0, 'b': 0.0}
+
+
+def test_gpiozero_bus_with_custom_pins_and_chips(mock_spi_device):
+    MCP3008Device(
+        [{'channel': 0, 'label': 'a'},
+         {'channel': 0, 'label': 'b', 'chip': 1}],
+        bus={'clock_pin': 11, 'mosi_pin': 10, 'miso_pin': 9,
+             'select_pins': [8, 7]}
+    )
+
+    mock_spi_device.assert_has_calls([
+        mock.call(clock_pin=11, mosi_pin=10, miso_pin=9, select_pin=8),
+        mock.call(clock_pin=11, mosi_pin=10, miso_pin=9, select_pin=7),
+    ])
+
+
+def test_spidev_bus(mock_spidev):
+    spi = mock_spidev.SpiDev.return_value
+    spi.xfer2.return_value = [0, 0x02, 0x00]
+    device = MCP3008Device(
+        [{'channel': 3, 'label': 'a'}],
+        bus={'type': 'spidev', 'port': 1, 'max_speed_hz': 3600000}
+    )
+
+    assert device.value == {'a': 512 / 1023}
+    assert device.value == {'a': 512 / 1023}
+    spi.open.assert_called_once_with(1, 0)
+    assert spi.max_speed_hz == 3600000
+    spi.xfer2.assert_called_with(channel_message(3))
+
+
+def test_spidev_bus_fails_without_spidev():
+    with mock.patch('bobnet_sensors.sensors.mcp3008.spidev', None):
+        with pytest.raises(ValueError):
+            MCP3008Device([{'channel': 0, 'label': 'a'}],
+                          bus={'type': 'spidev'})
+
+
+def test_devices_on_the_same_bus_share_a_lock(mock_spi_device):
+    first = MCP3008Device([{'channel': 0, 'label': 'a'}])
+    second = MCP3008Device([{'channel': 1, 'label': 'b'}])
+    other = MCP3008Device([{'channel': 1, 'label': 'b'}],
+                          bus={'clock_pin': 11})
+
+    assert first.bus.lock is second.bus.lock
+    assert first.bus.lock is not other.bus.lock
+
+
+@pytest.mark.parametrize('channel', [
+    {'channel': 0, 'label': 'a', 'oversample': 0},
+    {'channel': 0, 'label': 'a', 'oversample': 'many'},
+    {'channel': 0, 'label': 'a', 'reduce': 'mode'},
+    {'channel': 0, 'label': 'a', 'trim': 0.5},
+])
+def test_create_mcp3008_fails_with_invalid_oversample(channel):
+    with pytest.raises(ValueError):
+        MCP3008Device([channel])
+
+
+def sequence(*values):
+    return iter(values).__next__
+
+
+@pytest.mark.parametrize('reduce,expected', [
+    ('mean', 300),
+    ('median', 110),
+    ('trimmed_mean', 410 / 3),
+])
+def test_oversample_reduces_burst(reduce, expected):
+    channels = [
+        {'channel': 0, 'label': 'a', 'oversample': 5,
+         'reduce': reduce, 'trim': 0.2},
+        {'channel': 1, 'label': 'b'},
+    ]
+    device = MCP3008Device(channels, bus={
+        'type': 'fake',
+        'values': {0: sequence(90, 100, 1000, 110, 200), 1: 7},
+    })
+
+    value = device.value
+
+    assert value == {'a': pytest.approx(expected / 1023), 'b': 7 / 1023}
+    assert device.bus.transfers == 6
+
+
+def waveform(n, amplitude=400, offset=512):
+    samples = itertools.cycle(
+        round(offset + amplitude * math.sin(2 * math.pi * i / n))
+        for i in range(n)
+    )
+    return samples.__next__
+
+
+@pytest.mark.parametrize('channel', [
+    {'channel': 0, 'label': 'a', 'capture': 1024},
+    {'channel': 0, 'label': 'a', 'capture': {'samples': 1}},
+    {'channel': 0, 'label': 'a', 'capture': {}, 'oversample': 2},
+])
+def test_create_mcp3008_fails_with_invalid_capture(channel):
+    with pytest.raises(ValueError):
+        MCP3008Device([channel])
+
+
+def test_capture_publishes_features():
+    channels = [
+        {'channel': 0, 'label': 'current', 'capture': {'samples': 200}},
+        {'channel': 1, 'label': 'light'},
+    ]
+    device = MCP3008Device(channels, bus={
+        'type': 'fake', 'values': {0: waveform(20), 1: 1023},
+    })
+
+    value = device.value
+
+    assert value['light'] == 1.0
+    assert value['current.rms'] == pytest.approx(400 / 1023 / math.sqrt(2),
+                                                 rel=1e-2)
+    assert value['current.peak'] == pytest.approx(400 / 1023, rel=1e-2)
+    assert value['current.crest'] == pytest.approx(math.sqrt(2), rel=1e-2)
+    assert device.bus.transfers == 201
+
+
+def test_capture_dominant_frequency():
+    pytest.importorskip('numpy')
+    channels = [{'channel': 0, 'label': 'current',
+                 'capture': {'samples': 400, 'frequency': True}}]
+    device = MCP3008Device(channels, bus={
+        'type': 'fake', 'values': {0: waveform(20)},
+    })
+    device.value
+    capture = device._captures[0][2]
+
+    result = capture.features()
+
+    # one cycle every 20 samples
+    assert result['frequency'] == pytest.approx(capture.rate / 20, rel=0.05)
+
+
+def test_capture_raw_samples_on_command(looper):
+    channels = [{'channel': 0, 'label': 'current',
+                 'capture': {'samples': 4}}]
+    device = MCP3008Device(channels, bus={
+        'type': 'fake', 'values': {0: sequence(1, 2, 3, 4)},
+    })
+    device.value
+
+    raw = looper.loop.run_until_complete(device.run_command(looper))
+
+    assert raw['current']['samples'] == [1, 2, 3, 4]
+    assert raw['current']['rate'] > 0
+
+
+def test_no_command_without_capture(looper):
+    device = MCP3008Device([{'channel': 0, 'label': 'a'}],
+                           bus={'type': 'fake'})
+
+    assert looper.loop.run_until_complete(device.run_command(looper)) is None
+
+
+def test_capture_without_numpy(monkeypatch):
+    monkeypatch.setattr(features, 'numpy', None)
+    channels = [{'channel': 0, 'label': 'current',
+                 'capture': {'samples': 200}}]
+    device = MCP3008Device(channels, bus={
+        'type': 'fake', 'values': {0: waveform(20)},
+    })
+
+    assert device.value['current.peak'] == pytest.approx(400 / 1023,
+                                                         rel=1e-2)
+    with pytest.raises(ValueError):
+        MCP3008Device([{'channel': 0, 'label': 'current',
+                        'capture': {'frequency': True}}])
+
+
+def test_devices_on_the_same_pins_share_spi_devices(
+        mock_spi_device, mock_RPi):
+    MCP3008Device([{'channel': 0, 'label': 'a'}])
+    MCP3008Device([{'channel': 1, 'label': 'b'}],
+                  bus={'select_pins': [25, 8]})
+
+    assert mock_spi_device.call_count == 2
+    assert mock_RPi.GPIO.setmode.call_count == 2
+
+
+@pytest.mark.parametrize('config,key', [
+    ({}, ('gpiozero', 18, 24, 23)),
+    ({'bus': {'clock_pin': 11, 'select_pins': [8]}},
+     ('gpiozero', 11, 24, 23)),
+    ({'bus': {'type': 'spidev', 'port': 1}}, ('spidev', 1)),
+    ({'bus': {'type': 'fake'}}, None),
+])
+def test_resource(config, key):
+    assert resource(config) == key
@@ -0,0 +1,110 @@
+from unittest import mock
+
+import pytest
+
+from bobnet_sensors.recording import Recorder
+from bobnet_sensors.sensors import Sensors
+from bobnet_sensors.sensors.replay import Device as ReplayDevice
+
+
+@pytest.fixture
+def recording(tmpdir):
+    path = str(tmpdir.join('recording'))
+    recorder = Recorder(path)
+    for i in range(4):
+        recorder.record('a', 100 + 10 * i, {'value': i})
+        recorder.record('b', 100 + 10 * i, {'value': -i})
+    recorder.close()
+    return path
+
+
+@pytest.fixture
+def mock_monotonic():
+    with mock.patch('bobnet_sensors.sensors.replay.clock') as m:
+        m.monotonic.return_value = 0
+        yield m.monotonic
+
+
+def test_replay_as_fast_as_possible(recording):
+    device = ReplayDevice(recording, sensor='a', speed='max')
+
+    assert [device.value['value'] for _ in range(4)] == [0, 1, 2, 3]
+
+
+def test_replay_fails_at_end_of_recording(recording):
+    device = ReplayDevice(recording, sensor='a', speed='max')
+    for _ in range(4):
+        device.value
+
+    with pytest.raises(EOFError):
+        device.value
+
+
+def test_replay_repeats(recording):
+    device = ReplayDevice(recording, sensor='b', speed='max', repeat=True)
+
+    assert [device.value['value'] for _ in range(6)] == [0, -1, -2, -3, 0, -1]
+
+
+@pytest.mark.parametrize('speed,elapsed,expected', [
+    (1, 0, 0),
+    (1, 9, 0),
+    (1, 10, 1),
+    (1, 25, 2),
+    (10, 1, 1),
+    (10, 2.5, 2),
+    (1000, 0.03, 3),
+])
+def test_replay_in_time(recording, mock_monotonic, speed, elapsed, expected):
+    device = ReplayDevice(recording, sensor='a', speed=speed)
+    device.value
+    mock_monotonic.return_value = elapsed
+
+    assert device.value['value'] == expected
+
+
+def test_replay_in_time_ends(recording, mock_monotonic):
+    device = ReplayDevice(recording, sensor='a')
+    device.value
+    mock_monotonic.return_value = 100
+    assert device.value['value'] == 3
+
+    with pytest.raises(EOFError):
+        device.value
+
+
+@pytest.mark.parametrize('speed', [0, -1, 'fast'])
+def test_create_replay_fails_with_invalid_speed(recording, speed):
+    with pytest.raises(ValueError):
+        ReplayDevice(recording, speed=speed)
+
+
+def test_create_replay_fails_without_readings(recording):
+    with pytest.raises(ValueError):
+        ReplayDevice(recording, sensor='c')
+
+
+def test_replay_sensor_reads_every_record_at_max_speed(virtual_looper,
+                                                       tmpdir):
+    # arrange
+    looper = virtual_looper
+    path = str(tmpdir.join('long'))
+    recorder = Recorder(path)
+    for i in range(1000):
+        recorder.record('a', i, {'value': i})
+    recorder.close()
+    sensors = Sensors.from_config({'sensors': {'a': {
+        'device': 'replay', 'path': path, 'sensor': 'a', 'speed': 'max',
+        'every': '0.001s',
+    }}})
+    looper.loop.call_later(0.5, looper.stop)
+
+    # act
+    looper.loop.run_until_complete(sensors.run(looper))
+
+    # assert
+    values = []
+    while not looper.send_queue.empty():
+        values.append(looper.send_queue.get_nowait()['value']['value'])
+    assert len(values) > 400
+    assert values == list(range(len(values)))
@@ -0,0 +1,160 @@
+import asyncio
+from unittest import mock
+
+import pytest
+
+from bobnet_sensors.sensors import Sensor, Sensors, get_device_class
+from bobnet_sensors.sensors.synthetic import Device as SyntheticDevice
+
+
+@pytest.fixture
+def mock_time():
+    m = mock.Mock()
+    m.time.return_value = 0
+    with mock.patch('bobnet_sensors.sensors.synthetic.time', m), \
+            mock.patch('bobnet_sensors.sensors.synthetic.clock', m):
+        yield m
+
+
+def test_synthetic_device_is_loaded_by_name():
+    assert get_device_class('synthetic') == SyntheticDevice
+
+
+@pytest.mark.parametrize('now,expected', [
+    (0, 2.0),
+    (15, 5.0),
+    (30, 2.0),
+    (45, -1.0),
+])
+def test_sine(mock_time, now, expected):
+    device = SyntheticDevice('sine', period='60s', amplitude=3, offset=2)
+    mock_time.time.return_value = now
+
+    assert device.value['value'] == pytest.approx(expected)
+
+
+def test_random_walk_is_repeatable_with_seed():
+    first = SyntheticDevice('random_walk', seed=1)
+    second = SyntheticDevice('random_walk', seed=1)
+
+    assert [first.value for _ in range(5)] == \
+        [second.value for _ in range(5)]
+
+
+def test_random_walk_stays_in_bounds():
+    device = SyntheticDevice(
+        'random_walk', step=10, minimum=-1, maximum=1, seed=1
+    )
+
+    values = [device.value['value'] for _ in range(100)]
+
+    assert min(values) == -1
+    assert max(values) == 1
+
+
+def test_replay_cycles_through_values():
+    device = SyntheticDevice('replay', values=[1, 2, 3])
+
+    assert [device.value['value'] for _ in range(4)] == [1, 2, 3, 1]
+
+
+@pytest.mark.parametrize('now,expected', [
+    (0, 5),
+    (9, 5),
+    (10, 1),
+    (59, 1),
+    (60, 5),
+])
+def test_burst(mock_time, now, expected):
+    device = SyntheticDevice(
+        'burst', interval='60s', length='10s', low=1, high=5
+    )
+    mock_time.time.return_value = now
+
+    assert device.value == {'value': expected}
+
+
+def test_labels_have_their_own_values():
+    device = SyntheticDevice('random_walk', labels=['a', 'b'], seed=1)
+
+    value = device.value
+
+    assert set(value) == {'a', 'b'}
+    assert value['a'] != value['b']
+
+
+def test_payload_is_padded():
+    device = SyntheticDevice('replay', values=[1], payload_bytes=100)
+
+    assert device.value['padding'] == 'x' * 100
+
+
+def test_read_latency(mock_time):
+    device = SyntheticDevice('replay', values=[1], latency='0.5s')
+
+    device.value
+
+    mock_time.sleep.assert_called_once_with(0.5)
+
+
+def test_failure_rate():
+    device = SyntheticDevice('replay', values=[1], failure_rate=1)
+
+    with pytest.raises(RuntimeError):
+        device.value
+
+
+@pytest.mark.parametrize('config', [
+    {'shape': 'square'},
+    {'shape': 'replay'},
+    {'shape': 'sine', 'period': '0s'},
+    {'shape': 'burst', 'interval': '10s', 'length': '20s'},
+    {'shape': 'sine', 'labels': []},
+    {'shape': 'sine', 'failure_rate': 2},
+    {'shape': 'sine', 'payload_bytes': -1},
+])
+def test_create_synthetic_fails_with_invalid_config(config):
+    with pytest.raises(ValueError):
+        SyntheticDevice(**config)
+
+
+def test_create_synthetic_sensor(looper):
+    sensor = Sensor.create('load', {
+        'device': 'synthetic', 'shape': 'replay', 'values': [4],
+        'labels': ['a', 'b'],
+    })
+
+    value = looper.loop.run_until_complete(sensor.read(looper))
+
+    assert value == {'sensor': 'load', 'value': {'a': 4, 'b': 4}}
+
+
+def test_identical_synthetic_sensors_have_their_own_devices(looper):
+    config = {
+        'shape': 'replay', 'values': [1, 2, 3], 'failure_rate': 0.5,
+        'seed': 7,
+    }
+    sensors = list(Sensors.from_config({'sensors': {
+        f'load{i}': dict(config, device='synthetic') for i in range(100)
+    }}))
+    reference = SyntheticDevice(**config)
+
+    def read_reference():
+        try:
+            return reference.value['value']
+        except RuntimeError:
+            return None
+
+    def read_all():
+        values = looper.loop.run_until_complete(asyncio.gather(
+            *(sensor.read(looper) for sensor in sensors), loop=looper.loop
+        ))
+        return [
+            value['value']['value'] if isinstance(value, dict) else None
+            for value in values
+        ]
+
+    assert len({id(sensor.device) for sensor in sensors}) == 100
+    # every sensor fails and replays the same reads as a lone device
+    for _ in range(6):
+        assert read_all() == [read_reference()] * 100
@@ -0,0 +1,110 @@
+import math
+
+import pytest
+
+from bobnet_sensors.aggregation import Aggregator, Summary, percentile
+
+
+@pytest.mark.parametrize('p,result', [
+    (0, 1),
+    (50, 3),
+    (75, 4),
+    (90, 4.6),
+    (100, 5),
+])
+def test_percentile(p, result):
+    assert percentile([1, 2, 3, 4, 5], p) == pytest.approx(result)
+
+
+def test_summary_statistics():
+    summary = Summary(percentiles=(50, 99.9))
+    for value in [2, 4, 4, 4, 5, 5, 7, 9]:
+        summary.add(value)
+
+    assert summary.as_dict() == {
+        'count': 8,
+        'last': 9,
+        'min': 2,
+        'max': 9,
+        'mean': 5,
+        'stddev': 2,
+        'p50': 4.5,
+        'p99.9': pytest.approx(8.986),
+    }
+
+
+def test_summary_of_non_numeric_values():
+    summary = Summary()
+    summary.add((1, 2, 3))
+    summary.add((4, 5, 6))
+
+    assert summary.as_dict() == {'count': 2, 'last': (4, 5, 6)}
+
+
+def test_create_aggregator_from_config():
+    aggregator = Aggregator.from_config({
+        'window': '1m',
+        'percentiles': [50, 95],
+    })
+
+    assert aggregator.window == 60
+    assert aggregator.percentiles == (50, 95)
+
+
+@pytest.mark.parametrize('config', [
+    {'window': '0s'},
+    {'window': '1m', 'percentiles': [101]},
+    {'window': 'bad'},
+])
+def test_create_aggregator_fails_with_invalid_config(config):
+    with pytest.raises(ValueError):
+        Aggregator.from_config(config)
+
+
+def test_aggregator_returns_summary_after_window():
+    aggregator = Aggregator(10)
+
+    results = [aggregator.add(v, t) for t, v in enumerate(range(12))]
+
+    assert results[:10] == [None] * 10
+    assert results[10]['count'] == 10
+    assert results[10]['mean'] == 4.5
+    assert results[11] is None
+
+
+def test_aggregator_windows_keep_fixed_boundaries():
+    aggregator = Aggregator(10)
+
+    aggregator.add(1, 0)
+    assert aggregator.add(1, 10.5)['count'] == 1
+    assert aggregator.add(1, 19.9) is None
+    assert aggregator.add(1, 20)['count'] == 2
+
+
+def test_aggregator_restarts_windows_after_stall():
+    aggregator = Aggregator(10)
+
+    aggregator.add(1, 0)
+    assert aggregator.add(1, 35)['count'] == 1
+    assert aggregator.add(1, 44) is None
+    assert aggregator.add(1, 45)['count'] == 2
+
+
+def test_aggregator_summarises_labels_separately():
+    aggregator = Aggregator(10)
+
+    aggregator.add({'temperature': 20, 'humidity': 50}, 0)
+    aggregator.add({'temperature': 22, 'humidity': 40}, 5)
+    result = aggregator.add({'temperature': 0, 'humidity': 0}, 10)
+
+    assert result['temperature']['mean'] == 21
+    assert result['humidity']['min'] == 40
+    assert math.isclose(result['humidity']['stddev'], 5)
+
+
+def test_aggregator_flush_resets_window():
+    aggregator = Aggregator(10)
+
+    aggregator.add(1, 0)
+    assert aggregator.flush()['count'] == 1
+    assert aggregator.flush() is None
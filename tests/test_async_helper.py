@@ -1,9 +1,14 @@
 import asyncio
 import threading
+import time
 
+import pytest
+
+from bobnet_sensors import clock
 from bobnet_sensors.async_helper import (
-    StopEvent, Queue
+    Looper, StopEvent, Queue
 )
+from bobnet_sensors.models import LogMessage
 
 
 def test_stopping(looper):
@@ -82,3 +87,363 @@ def test_queue_sync_put_async_get(loop):
     thread2.join()
 
     assert answers == ['one']
+
+
+def test_queue_get_times_out(loop):
+    stop_event = StopEvent(loop)
+    queue = Queue(loop, stop_event)
+
+    answer = loop.run_until_complete(queue.get(timeout=0.001))
+
+    assert answer is None
+    assert not stop_event.stopping
+
+
+def test_run_blocking_runs_off_the_loop(looper):
+    def blocking():
+        return threading.current_thread()
+
+    thread = looper.loop.run_until_complete(looper.run_blocking(blocking))
+
+    assert thread != threading.current_thread()
+
+
+def test_queue_get_nowait(loop):
+    queue = Queue(loop, StopEvent(loop))
+
+    loop.run_until_complete(queue.put('one'))
+
+    assert queue.qsize() == 1
+    assert queue.get_nowait() == 'one'
+    assert queue.empty()
+    with pytest.raises(asyncio.QueueEmpty):
+        queue.get_nowait()
+
+
+def test_queue_get_many(loop):
+    queue = Queue(loop, StopEvent(loop))
+    for item in range(5):
+        queue.put_nowait(item)
+
+    first = loop.run_until_complete(queue.get_many(3))
+    second = loop.run_until_complete(queue.get_many(3))
+
+    assert (first, second) == ([0, 1, 2], [3, 4])
+
+
+def test_queue_get_many_waits_for_an_item(loop):
+    queue = Queue(loop, StopEvent(loop))
+
+    async def feeder():
+        await asyncio.sleep(0.001)
+        queue.put_nowait('one')
+        queue.put_nowait('two')
+
+    answers, _ = loop.run_until_complete(
+        asyncio.gather(queue.get_many(5), feeder(), loop=loop)
+    )
+
+    assert answers == ['one', 'two']
+
+
+def test_queue_get_many_times_out(loop):
+    queue = Queue(loop, StopEvent(loop))
+
+    assert loop.run_until_complete(queue.get_many(5, timeout=0.001)) == []
+
+
+def test_queue_stop_wakes_waiting_getters(loop):
+    stop_event = StopEvent(loop)
+    queue = Queue(loop, stop_event)
+
+    async def stopper():
+        await asyncio.sleep(0.001)
+        # only the getters and this coroutine are running
+        assert len(asyncio.Task.all_tasks(loop)) == 3
+        stop_event.stop()
+
+    answers = loop.run_until_complete(
+        asyncio.gather(queue.get(), queue.get_many(5), stopper(), loop=loop)
+    )
+
+    assert answers == [None, [], None]
+
+
+def test_queue_cancelled_getter_passes_item_on(loop):
+    queue = Queue(loop, StopEvent(loop))
+
+    async def run():
+        first = loop.create_task(queue.get())
+        second = loop.create_task(queue.get())
+        await asyncio.sleep(0)
+        queue.put_nowait('one')
+        first.cancel()
+        return await second
+
+    assert loop.run_until_complete(run()) == 'one'
+    assert not queue._getters
+
+
+def test_queue_timed_out_getter_is_removed(loop):
+    queue = Queue(loop, StopEvent(loop))
+
+    loop.run_until_complete(queue.get(timeout=0.001))
+
+    assert not queue._getters
+
+
+def test_queue_put_after_stop_is_dropped(loop):
+    stop_event = StopEvent(loop)
+    queue = Queue(loop, stop_event)
+    stop_event.stop()
+
+    queue.put_nowait('one')
+    queue.sync_put('two')
+
+    assert queue.empty()
+
+
+def test_looper_from_config(loop):
+    looper = Looper.from_config(loop, {
+        'send_queue': {'capacity': 10, 'policy': 'conflate'}
+    })
+
+    assert looper.send_queue.maxsize == 10
+    assert looper.send_queue.policy == 'conflate'
+    assert looper.config_queue.maxsize == 0
+
+
+def test_looper_from_config_defaults_to_unbounded(loop):
+    looper = Looper.from_config(loop, {})
+
+    assert looper.send_queue.maxsize == 0
+    assert not looper.send_queue.full()
+
+
+def test_looper_from_config_sets_read_threads(loop):
+    looper = Looper.from_config(loop, {'read_threads': 2})
+
+    def read():
+        time.sleep(0.01)
+        return threading.current_thread()
+
+    threads = loop.run_until_complete(asyncio.gather(
+        *[looper.run_blocking(read) for _ in range(6)], loop=loop
+    ))
+    looper.close()
+
+    assert len(set(threads)) == 2
+
+
+def test_queue_fails_with_invalid_policy(loop):
+    with pytest.raises(ValueError):
+        Queue(loop, StopEvent(loop), maxsize=1, policy='invalid')
+
+
+def test_queue_block_policy_waits_for_space(loop):
+    queue = Queue(loop, StopEvent(loop), maxsize=2)
+    answers = []
+
+    async def producer():
+        for item in range(4):
+            await queue.put(item)
+            answers.append(('put', item))
+
+    async def consumer():
+        await asyncio.sleep(0.001)
+        for _ in range(4):
+            answers.append(('get', await queue.get()))
+
+    loop.run_until_complete(asyncio.gather(producer(), consumer(), loop=loop))
+
+    assert answers[:3] == [('put', 0), ('put', 1), ('get', 0)]
+    assert sorted(answers) == sorted(
+        [('put', i) for i in range(4)] + [('get', i) for i in range(4)]
+    )
+
+
+def test_queue_block_policy_put_nowait_fails_when_full(loop):
+    queue = Queue(loop, StopEvent(loop), maxsize=1)
+    queue.put_nowait('one')
+
+    with pytest.raises(asyncio.QueueFull):
+        queue.put_nowait('two')
+
+
+def test_queue_block_policy_blocks_sync_put(loop):
+    queue = Queue(loop, StopEvent(loop), maxsize=1)
+    answers = []
+
+    def feeder():
+        queue.sync_put('one')
+        queue.sync_put('two')
+
+    async def get():
+        await asyncio.sleep(0.01)
+        assert queue.qsize() == 1
+        answers.append(await queue.get())
+        answers.append(await queue.get())
+
+    thread = threading.Thread(target=feeder)
+    thread.start()
+    loop.run_until_complete(get())
+    thread.join()
+
+    assert answers == ['one', 'two']
+
+
+def test_queue_cancelled_putter_passes_space_on(loop):
+    queue = Queue(loop, StopEvent(loop), maxsize=1)
+    queue.put_nowait('one')
+
+    async def cancel_woken_putter():
+        p1 = asyncio.ensure_future(queue.put('two'), loop=loop)
+        p2 = asyncio.ensure_future(queue.put('three'), loop=loop)
+        await asyncio.sleep(0)
+        assert queue.get_nowait() == 'one'
+        # p1 has been woken but is cancelled before it runs
+        p1.cancel()
+        await asyncio.wait_for(p2, 1, loop=loop)
+
+    loop.run_until_complete(cancel_woken_putter())
+
+    assert queue.get_nowait() == 'three'
+
+
+def test_queue_get_many_wakes_a_putter_per_item(loop):
+    queue = Queue(loop, StopEvent(loop), maxsize=2)
+    queue.put_nowait(0)
+    queue.put_nowait(1)
+
+    async def put_after_get_many():
+        putters = [
+            asyncio.ensure_future(queue.put(item), loop=loop)
+            for item in range(2, 5)
+        ]
+        await asyncio.sleep(0)
+        assert await queue.get_many(2) == [0, 1]
+        await asyncio.sleep(0)
+        done = [putter.done() for putter in putters]
+        putters[-1].cancel()
+        return done
+
+    done = loop.run_until_complete(put_after_get_many())
+
+    assert done == [True, True, False]
+    assert queue.qsize() == 2
+
+
+def test_queue_stop_wakes_blocked_producers(loop):
+    stop_event = StopEvent(loop)
+    queue = Queue(loop, stop_event, maxsize=1)
+
+    async def stopper():
+        await asyncio.sleep(0.001)
+        stop_event.stop()
+
+    loop.run_until_complete(
+        asyncio.gather(queue.put('one'), queue.put('two'), stopper(),
+                       loop=loop)
+    )
+
+    assert queue.qsize() == 1
+
+
+def test_queue_drop_oldest_policy(loop):
+    queue = Queue(loop, StopEvent(loop), maxsize=2, policy='drop_oldest')
+
+    for item in range(4):
+        queue.put_nowait(item)
+
+    assert loop.run_until_complete(queue.get_many(5)) == [2, 3]
+    assert queue.dropped == 2
+
+
+def reading(sensor, value):
+    return {'sensor': sensor, 'value': value}
+
+
+def test_queue_conflate_policy_replaces_reading_from_same_sensor(loop):
+    queue = Queue(loop, StopEvent(loop), maxsize=2, policy='conflate')
+
+    queue.put_nowait(reading('a', 1))
+    queue.put_nowait(reading('b', 1))
+    queue.put_nowait(reading('a', 2))
+
+    assert loop.run_until_complete(queue.get_many(5)) == [
+        reading('b', 1), reading('a', 2)
+    ]
+    assert queue.dropped == 1
+
+
+def test_queue_conflate_policy_drops_oldest_reading(loop):
+    queue = Queue(loop, StopEvent(loop), maxsize=3, policy='conflate')
+    log = LogMessage.error('hi')
+
+    queue.put_nowait(log)
+    queue.put_nowait(reading('a', 1))
+    queue.put_nowait(reading('b', 1))
+    queue.put_nowait(reading('c', 1))
+
+    assert loop.run_until_complete(queue.get_many(5)) == [
+        log, reading('b', 1), reading('c', 1)
+    ]
+
+
+def test_queue_conflate_policy_keeps_other_messages(loop):
+    queue = Queue(loop, StopEvent(loop), maxsize=1, policy='conflate')
+    logs = [LogMessage.error('one'), LogMessage.error('two')]
+
+    for log in logs:
+        queue.put_nowait(log)
+
+    assert loop.run_until_complete(queue.get_many(5)) == logs
+    assert queue.dropped == 0
+
+
+def test_virtual_loop_sleeps_without_waiting(virtual_looper):
+    start = time.monotonic()
+
+    virtual_looper.loop.run_until_complete(
+        asyncio.sleep(24 * 60 * 60, loop=virtual_looper.loop)
+    )
+
+    assert virtual_looper.loop.time() == pytest.approx(24 * 60 * 60)
+    assert time.monotonic() - start < 1
+
+
+def test_virtual_loop_wait_for_times_out(virtual_looper):
+    virtual_looper.loop.run_until_complete(virtual_looper.wait_for(3600))
+
+    assert virtual_looper.loop.time() == pytest.approx(3600)
+    assert not virtual_looper.stopping
+
+
+def test_virtual_loop_waits_for_the_executor(virtual_looper):
+    def blocking():
+        time.sleep(0.05)
+        return virtual_looper.loop.time()
+
+    async def read_with_timeout():
+        return await asyncio.wait_for(
+            virtual_looper.run_blocking(blocking), 0.01,
+            loop=virtual_looper.loop
+        )
+
+    read_at = virtual_looper.loop.run_until_complete(read_with_timeout())
+
+    assert read_at == 0
+    assert virtual_looper.loop.time() == 0
+
+
+def test_virtual_looper_sets_the_clock_until_closed():
+    looper = Looper.virtual(start=0)
+    try:
+        assert clock.time() == 0
+        looper.loop.run_until_complete(looper.wait_for(60))
+        assert clock.time() == pytest.approx(60)
+    finally:
+        looper.close()
+        looper.loop.close()
+
+    assert isinstance(clock.get_clock(), clock.RealClock)
@@ -0,0 +1,147 @@
+import os
+
+import pytest
+
+from bobnet_sensors.buffer import DiskBuffer
+
+
+def records(n, start=0):
+    return [f'record {i}'.encode('utf8') for i in range(start, start + n)]
+
+
+def fill(buffer, items):
+    for item in items:
+        buffer.append(item)
+
+
+def test_create_buffer_from_config(tmpdir):
+    buffer = DiskBuffer.from_config({
+        'path': str(tmpdir),
+        'max_bytes': 4096,
+        'segment_bytes': 1024,
+    })
+
+    assert buffer.max_bytes == 4096
+    assert buffer.segment_bytes == 1024
+    assert len(buffer) == 0
+
+
+def test_create_buffer_fails_with_large_segments(tmpdir):
+    with pytest.raises(ValueError):
+        DiskBuffer(str(tmpdir), max_bytes=1024, segment_bytes=4096)
+
+
+def test_peek_returns_records_in_order(tmpdir):
+    buffer = DiskBuffer(str(tmpdir))
+    fill(buffer, records(5))
+
+    assert buffer.peek(3) == records(3)
+    assert buffer.peek(10) == records(5)
+    assert len(buffer) == 5
+
+
+def test_commit_advances_read_position(tmpdir):
+    buffer = DiskBuffer(str(tmpdir))
+    fill(buffer, records(5))
+
+    buffer.peek(3)
+    buffer.commit(2)
+
+    assert buffer.peek(10) == records(3, start=2)
+    assert len(buffer) == 3
+
+
+def test_records_are_read_across_segments(tmpdir):
+    buffer = DiskBuffer(str(tmpdir), max_bytes=4096, segment_bytes=64)
+    fill(buffer, records(10))
+
+    assert len(os.listdir(str(tmpdir))) > 2
+    assert buffer.peek(10) == records(10)
+    buffer.commit(10)
+    assert len(buffer) == 0
+
+
+def test_fully_read_segments_are_removed(tmpdir):
+    buffer = DiskBuffer(str(tmpdir), max_bytes=4096, segment_bytes=64)
+    fill(buffer, records(10))
+
+    buffer.peek(10)
+    buffer.commit(10)
+
+    segments = [n for n in os.listdir(str(tmpdir)) if n.endswith('.seg')]
+    assert len(segments) == 1
+
+
+def test_unread_records_survive_reopening(tmpdir):
+    buffer = DiskBuffer(str(tmpdir), max_bytes=4096, segment_bytes=64)
+    fill(buffer, records(10))
+    buffer.peek(4)
+    buffer.commit(4)
+    buffer.close()
+
+    buffer = DiskBuffer(str(tmpdir), max_bytes=4096, segment_bytes=64)
+    fill(buffer, records(1, start=10))
+
+    assert len(buffer) == 7
+    assert buffer.peek(10) == records(7, start=4)
+
+
+def test_oldest_segments_are_evicted_when_full(tmpdir):
+    buffer = DiskBuffer(str(tmpdir), max_bytes=256, segment_bytes=64)
+    fill(buffer, records(100))
+
+    assert buffer.size <= 256
+    remaining = buffer.peek(100)
+    assert remaining == records(len(remaining), start=100 - len(remaining))
+
+
+def test_eviction_moves_read_position(tmpdir):
+    buffer = DiskBuffer(str(tmpdir), max_bytes=256, segment_bytes=64)
+    fill(buffer, records(3))
+    peeked = buffer.peek(1)
+    fill(buffer, records(100, start=3))
+
+    # the peeked record has been evicted so committing it does nothing
+    buffer.commit(len(peeked))
+
+    remaining = buffer.peek(100)
+    assert len(buffer) == len(remaining)
+    assert remaining[-1] == b'record 102'
+
+
+def test_damaged_records_are_truncated_on_reopening(tmpdir):
+    buffer = DiskBuffer(str(tmpdir))
+    fill(buffer, records(3))
+    buffer.close()
+    segment = os.path.join(str(tmpdir), sorted(os.listdir(str(tmpdir)))[0])
+    with open(segment, 'ab') as f:
+        f.write(b'\x00\x00\x00\x10torn')
+
+    buffer = DiskBuffer(str(tmpdir))
+    fill(buffer, records(1, start=3))
+
+    assert buffer.peek(10) == records(4)
+
+
+def test_read_continues_after_a_position(tmpdir):
+    buffer = DiskBuffer(str(tmpdir), segment_bytes=30)
+    fill(buffer, records(5))
+
+    first = buffer.read(2)
+    rest = buffer.read(10, after=first[-1][1])
+
+    assert [record for record, _ in first + rest] == records(5)
+    assert len(buffer) == 5
+
+
+def test_commit_to_position_survives_a_restart(tmpdir):
+    buffer = DiskBuffer(str(tmpdir), segment_bytes=30)
+    fill(buffer, records(5))
+    entries = buffer.read(10)
+
+    buffer.commit_to(entries[2][1])
+    # positions already committed are ignored
+    buffer.commit_to(entries[0][1])
+    buffer.close()
+
+    assert DiskBuffer(str(tmpdir)).peek(10) == records(2, start=3)
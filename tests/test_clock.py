@@ -0,0 +1,41 @@
+from datetime import datetime
+import time
+
+import pytest
+
+from bobnet_sensors import clock
+
+
+def test_real_clock_tells_the_time():
+    assert clock.time() == pytest.approx(time.time(), abs=5)
+
+
+def test_virtual_clock_stands_still_until_advanced():
+    virtual = clock.VirtualClock(start=1514764800)
+
+    assert virtual.time() == 1514764800
+    assert virtual.monotonic() == 0
+
+    virtual.advance(90)
+
+    assert virtual.time() == 1514764890
+    assert virtual.monotonic() == 90
+    assert virtual.utcnow() == datetime(2018, 1, 1, 0, 1, 30)
+
+
+def test_virtual_clock_cannot_go_back():
+    with pytest.raises(ValueError):
+        clock.VirtualClock().advance(-1)
+
+
+def test_set_clock_returns_the_clock_it_replaces():
+    virtual = clock.VirtualClock(start=0)
+
+    previous = clock.set_clock(virtual)
+    try:
+        assert clock.time() == 0
+        assert clock.utcnow() == datetime(1970, 1, 1)
+    finally:
+        clock.set_clock(previous)
+
+    assert clock.get_clock() is previous
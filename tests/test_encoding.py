@@ -0,0 +1,156 @@
+from datetime import datetime
+
+import pytest
+
+from bobnet_sensors import encoding
+from bobnet_sensors.models import BatchMessage, CommandMessage, LogMessage
+
+
+MESSAGES = [
+    None,
+    True,
+    False,
+    0,
+    127,
+    128,
+    255,
+    256,
+    65536,
+    2 ** 32,
+    2 ** 64 - 1,
+    -1,
+    -32,
+    -33,
+    -129,
+    -32769,
+    -2 ** 31 - 1,
+    -2 ** 63,
+    0.5,
+    -1234.5678,
+    '',
+    'sensor',
+    'x' * 31,
+    'x' * 32,
+    'x' * 256,
+    'x' * 65536,
+    'ünïcødé',
+    b'\x00\x01',
+    b'x' * 256,
+    [],
+    list(range(16)),
+    list(range(70000)),
+    {},
+    {f'label{i}': i for i in range(16)},
+    {'sensor': 'mcp3008', 'value': {'temp': 0.4985337243401759}},
+]
+
+
+@pytest.mark.parametrize('message', MESSAGES)
+def test_msgpack_round_trip(message):
+    payload = encoding.MSGPACK.encode(message)
+
+    assert encoding.MSGPACK.decode(payload) == message
+
+
+@pytest.mark.parametrize('message,payload', [
+    (None, b'\xc0'),
+    (True, b'\xc3'),
+    (5, b'\x05'),
+    (-5, b'\xfb'),
+    (200, b'\xcc\xc8'),
+    (-100, b'\xd0\x9c'),
+    (1.5, b'\xcb\x3f\xf8\x00\x00\x00\x00\x00\x00'),
+    ('abc', b'\xa3abc'),
+    ([1, 2], b'\x92\x01\x02'),
+    ({'a': 1}, b'\x81\xa1a\x01'),
+])
+def test_msgpack_encode(message, payload):
+    assert encoding.MSGPACK.encode(message) == payload
+
+
+def test_msgpack_decodes_float32():
+    assert encoding.MSGPACK.decode(b'\xca\x3f\xc0\x00\x00') == 1.5
+
+
+def test_msgpack_tuples_are_arrays():
+    assert encoding.MSGPACK.decode(
+        encoding.MSGPACK.encode((1, 2, 3))
+    ) == [1, 2, 3]
+
+
+def test_msgpack_fails_on_trailing_data():
+    with pytest.raises(ValueError):
+        encoding.MSGPACK.decode(b'\x01\x02')
+
+
+def test_msgpack_fails_on_unsupported_type():
+    with pytest.raises(ValueError):
+        encoding.MSGPACK.decode(b'\xc1')
+
+
+@pytest.mark.parametrize('codec', [encoding.JSON, encoding.MSGPACK])
+@pytest.mark.parametrize('count', [0, 1, 20])
+def test_encode_batch_matches_encoding_the_batch(codec, count):
+    messages = [{'sensor': 'name', 'value': n} for n in range(count)]
+
+    payload = codec.encode_batch([codec.encode(m) for m in messages])
+
+    assert payload == codec.encode(BatchMessage(messages))
+    # already encoded payloads are published as they are
+    assert codec.encode(payload) is payload
+
+
+def test_msgpack_fails_on_unserializable_objects():
+    with pytest.raises(TypeError):
+        encoding.MSGPACK.encode(object())
+
+
+@pytest.mark.parametrize('codec', [encoding.JSON, encoding.MSGPACK])
+def test_messages_are_encoded_as_json_values(codec):
+    message = BatchMessage([
+        {'sensor': 'name', 'value': {'count': 1}},
+        LogMessage.error('hi'),
+        CommandMessage('mydevice', 1, 'ack',
+                       datetime(2012, 12, 12, 12, 12, 12, 1200)),
+    ])
+
+    assert codec.decode(codec.encode(message)) == {
+        'type': 'batch',
+        'messages': [
+            {'sensor': 'name', 'value': {'count': 1}},
+            {'type': 'log', 'level': 'error', 'message': 'hi'},
+            {'type': 'command', 'device': 'mydevice', 'id': 1,
+             'state': 'ack', 'timestamp': '2012-12-12T12:12:12.001200Z'},
+        ]
+    }
+
+
+def test_msgpack_is_smaller_than_json():
+    message = {'sensor': 'mcp3008', 'value': {'temp': 0.49, 'light': 0.12}}
+
+    assert len(encoding.MSGPACK.encode(message)) < \
+        len(encoding.JSON.encode(message))
+
+
+def test_get_encoding():
+    assert encoding.get_encoding('msgpack') == encoding.MSGPACK
+
+
+def test_get_encoding_fails_with_unknown_encoding():
+    with pytest.raises(ValueError):
+        encoding.get_encoding('xml')
+
+
+@pytest.mark.parametrize('subfolder,codec', [
+    (None, encoding.JSON),
+    ('msgpack', encoding.MSGPACK),
+])
+def test_decode_by_subfolder(subfolder, codec):
+    payload = codec.encode({'foo': 'bar'})
+
+    assert encoding.decode(payload, subfolder) == {'foo': 'bar'}
+
+
+def test_decode_fails_with_unknown_subfolder():
+    with pytest.raises(ValueError):
+        encoding.decode(b'{}', 'unknown')
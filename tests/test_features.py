@@ -0,0 +1,77 @@
+import math
+
+import pytest
+
+from bobnet_sensors import features
+
+
+def sine(n, rate, frequency, amplitude=1.0, offset=0.0):
+    return [
+        offset + amplitude * math.sin(2 * math.pi * frequency * i / rate)
+        for i in range(n)
+    ]
+
+
+@pytest.fixture(params=['numpy', 'python'])
+def backend(request, monkeypatch):
+    if request.param == 'numpy':
+        pytest.importorskip('numpy')
+    else:
+        monkeypatch.setattr(features, 'numpy', None)
+    return request.param
+
+
+def test_burst_features_of_sine(backend):
+    result = features.burst_features(sine(1000, 1000, 50, 2, offset=5))
+
+    assert result['rms'] == pytest.approx(2 / math.sqrt(2))
+    assert result['peak'] == pytest.approx(2, rel=1e-3)
+    assert result['crest'] == pytest.approx(math.sqrt(2), rel=1e-3)
+
+
+def test_burst_features_without_removing_dc(backend):
+    result = features.burst_features([3, 3, 3, 3], ac=False)
+
+    assert result == {'rms': 3, 'peak': 3, 'crest': 1}
+
+
+def test_burst_features_of_flat_signal(backend):
+    result = features.burst_features([3, 3, 3, 3])
+
+    assert result == {'rms': 0, 'peak': 0, 'crest': 0}
+
+
+def test_peak_to_peak(backend):
+    samples = features.as_samples([1, -2, 3])
+
+    assert features.peak_to_peak(samples) == 5
+
+
+def test_dominant_frequency():
+    pytest.importorskip('numpy')
+
+    result = features.burst_features(
+        sine(1024, 2000, 125, offset=1), rate=2000, frequency=True
+    )
+
+    assert result['frequency'] == pytest.approx(125, abs=2)
+
+
+def test_band_energies():
+    pytest.importorskip('numpy')
+    samples = features.as_samples(
+        [a + b for a, b in zip(sine(1000, 1000, 50), sine(1000, 1000, 200))]
+    )
+
+    energies = features.band_energies(
+        samples, 1000, [(0, 100), (100, 300), (300, 500)]
+    )
+
+    assert energies == pytest.approx([0.5, 0.5, 0], abs=1e-3)
+
+
+def test_spectral_features_require_numpy(monkeypatch):
+    monkeypatch.setattr(features, 'numpy', None)
+
+    with pytest.raises(ValueError):
+        features.require_numpy('Dominant frequency')
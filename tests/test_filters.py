@@ -0,0 +1,90 @@
+import pytest
+
+from bobnet_sensors.filters import Band, Deadband
+
+
+@pytest.mark.parametrize('band,value,last,result', [
+    (Band(), 1, 1, False),
+    (Band(), 1.1, 1, True),
+    (Band(absolute=0.5), 1.4, 1, False),
+    (Band(absolute=0.5), 1.6, 1, True),
+    (Band(absolute=0.5), 0.4, 1, True),
+    (Band(relative=0.1), 105, 100, False),
+    (Band(relative=0.1), 111, 100, True),
+    (Band(absolute=10, relative=0.01), 102, 100, True),
+    (Band(absolute=1), [1, 2, 3], [1, 2, 3.5], False),
+    (Band(absolute=1), [1, 2, 3], [1, 2, 5], True),
+    (Band(absolute=1), [1, 2], [1, 2, 3], True),
+    (Band(absolute=1), 'on', 'off', True),
+    (Band(absolute=1), True, False, True),
+])
+def test_band_exceeded(band, value, last, result):
+    assert band.exceeded(value, last) == result
+
+
+def test_create_deadband_from_config():
+    deadband = Deadband.from_config({
+        'absolute': 0.5,
+        'heartbeat': '10m',
+        'labels': {
+            'temperature': {'relative': 0.1},
+        },
+    })
+
+    assert deadband.band.absolute == 0.5
+    assert deadband.heartbeat == 600
+    assert deadband.labels['temperature'].absolute == 0.5
+    assert deadband.labels['temperature'].relative == 0.1
+
+
+def test_deadband_sends_first_value():
+    deadband = Deadband(Band(absolute=1))
+
+    assert deadband.should_send(10, 0)
+
+
+def test_deadband_suppresses_small_changes():
+    deadband = Deadband(Band(absolute=1))
+
+    sent = [deadband.should_send(v, t) for t, v in enumerate(
+        [10, 10.5, 10.9, 11.1, 11.5, 12.2]
+    )]
+
+    assert sent == [True, False, False, True, False, True]
+
+
+def test_deadband_compares_with_last_sent_value():
+    deadband = Deadband(Band(absolute=1))
+
+    sent = [deadband.should_send(v, t) for t, v in enumerate(
+        [10, 10.6, 11.2, 10.4]
+    )]
+
+    assert sent == [True, False, True, False]
+
+
+def test_deadband_sends_heartbeat():
+    deadband = Deadband(Band(absolute=1), heartbeat=60)
+
+    assert deadband.should_send(10, 0)
+    assert not deadband.should_send(10, 59)
+    assert deadband.should_send(10, 60)
+    assert not deadband.should_send(10, 61)
+
+
+def test_deadband_compares_labels_separately():
+    deadband = Deadband(Band(absolute=1), {
+        'humidity': Band(absolute=5),
+    })
+
+    assert deadband.should_send({'temperature': 20, 'humidity': 50}, 0)
+    assert not deadband.should_send({'temperature': 20, 'humidity': 54}, 1)
+    assert deadband.should_send({'temperature': 21.5, 'humidity': 50}, 2)
+    assert deadband.should_send({'temperature': 21.5, 'humidity': 56}, 3)
+
+
+def test_deadband_sends_when_labels_change():
+    deadband = Deadband(Band(absolute=1))
+
+    assert deadband.should_send({'a': 1}, 0)
+    assert deadband.should_send({'a': 1, 'b': 1}, 1)
@@ -0,0 +1,136 @@
+import array
+import math
+
+import pytest
+
+from bobnet_sensors import history
+from bobnet_sensors.history import History
+
+
+BACKENDS = ['array', pytest.param('numpy', marks=pytest.mark.skipif(
+    history.numpy is None, reason='NumPy is not installed'
+))]
+
+
+def fill(h, n, start=0):
+    for i in range(start, start + n):
+        h.append(i * 1000, {'a': float(i), 'b': float(-i)})
+
+
+def test_create_history_from_config():
+    h = History.from_config({'capacity': 10, 'backend': 'array'})
+
+    assert h.capacity == 10
+    assert h.backend.name == 'array'
+    assert len(h) == 0
+
+
+@pytest.mark.parametrize('config', [
+    {'capacity': 0},
+    {'backend': 'bad'},
+])
+def test_create_history_fails_with_invalid_config(config):
+    with pytest.raises(ValueError):
+        History.from_config(config)
+
+
+def test_create_history_without_numpy(monkeypatch):
+    monkeypatch.setattr(history, 'numpy', None)
+
+    assert History().backend.name == 'array'
+    with pytest.raises(ValueError):
+        History(backend='numpy')
+
+
+@pytest.mark.parametrize('backend', BACKENDS)
+def test_window_returns_rows_in_order(backend):
+    h = History(10, backend)
+    fill(h, 3)
+
+    timestamps, values = h.window()
+
+    assert list(timestamps) == [0, 1000, 2000]
+    assert list(values['a']) == [0, 1, 2]
+    assert list(values['b']) == [0, -1, -2]
+
+
+@pytest.mark.parametrize('backend', BACKENDS)
+def test_window_wraps_around(backend):
+    h = History(5, backend)
+    fill(h, 12)
+
+    timestamps, values = h.window()
+
+    assert len(h) == 5
+    assert list(timestamps) == [7000, 8000, 9000, 10000, 11000]
+    assert list(values['a']) == [7, 8, 9, 10, 11]
+
+
+@pytest.mark.parametrize('backend', BACKENDS)
+def test_window_since(backend):
+    h = History(5, backend)
+    fill(h, 7)
+
+    timestamps, values = h.window(since=4500, labels=['a'])
+
+    assert list(timestamps) == [5000, 6000]
+    assert list(values) == ['a']
+    assert list(values['a']) == [5, 6]
+
+
+@pytest.mark.parametrize('backend', BACKENDS)
+def test_last(backend):
+    h = History(5, backend)
+    fill(h, 7)
+
+    assert list(h.last(2)[1]['b']) == [-5, -6]
+    assert list(h.last(10)[0]) == [2000, 3000, 4000, 5000, 6000]
+
+
+def test_window_columns_match_backend():
+    h = History(5, 'array')
+    fill(h, 7)
+
+    timestamps, values = h.window()
+
+    assert isinstance(timestamps, array.array)
+    assert isinstance(values['a'], array.array)
+
+
+@pytest.mark.skipif(history.numpy is None, reason='NumPy is not installed')
+def test_numpy_window_is_a_view_when_not_wrapped():
+    h = History(5, 'numpy')
+    fill(h, 3)
+
+    timestamps, values = h.window()
+
+    assert values['a'].base is not None
+    assert values['a'].mean() == 1
+
+
+def test_single_values_are_stored_under_default_label():
+    h = History(5)
+    h.append(0, 1.5)
+
+    assert list(h.window()[1]['value']) == [1.5]
+
+
+def test_missing_and_non_numeric_values_are_nan():
+    h = History(5)
+    h.append(0, {'a': 1, 'rgb': (1, 2, 3)})
+    h.append(1, {'b': 2})
+
+    timestamps, values = h.window()
+
+    assert h.labels == ['a', 'b']
+    assert list(values['a'])[0] == 1
+    assert math.isnan(values['a'][1])
+    assert math.isnan(values['b'][0])
+    assert values['b'][1] == 2
+
+
+def test_nbytes():
+    h = History(3600)
+    fill(h, 1)
+
+    assert h.nbytes == 3600 * 8 * 3
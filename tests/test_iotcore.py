@@ -2,14 +2,21 @@ import asyncio
 from unittest import mock
 from collections import namedtuple
 import json
+import threading
+import time
 
 import pytest
 import jwt
 
-from bobnet_sensors import iotcore
-from bobnet_sensors.models import ConfigMessage, CommandMessage
+from bobnet_sensors import clock, iotcore
+from bobnet_sensors.buffer import DiskBuffer
+from bobnet_sensors.encoding import JSON, MSGPACK
+from bobnet_sensors.models import (
+    BatchMessage, ConfigMessage, CommandMessage, LogMessage
+)
 
-from conftest import return_immediately
+from benchmarks.fake_broker import FakeBroker, make_certificate
+from conftest import AsyncMock, VIRTUAL_START
 
 
 @pytest.mark.parametrize('rc,error', [
@@ -110,6 +117,21 @@ def test_create_connection_from_config(
     assert conn.private_key == private_key
 
 
+def test_create_connection_with_host_and_port(
+    looper, mock_mqtt_client, valid_config
+):
+    # arrange
+    valid_config['iotcore']['host'] = 'localhost'
+    valid_config['iotcore']['port'] = 18883
+    conn = iotcore.Connection.from_config(looper, valid_config)
+
+    # act
+    conn.connect()
+
+    # assert
+    mock_mqtt_client.connect.assert_called_once_with('localhost', 18883)
+
+
 def test_create_connection_from_config_fails_on_missing_keys(
     looper, mock_mqtt, valid_config
 ):
@@ -255,17 +277,17 @@ def test_on_message_sends_no_message_if_no_payload(
     assert answers == [None]
 
 
-def test_publish_message(iotcore_connection):
+def test_publish_message(looper, iotcore_connection):
     # arrange
     conn = iotcore_connection
     conn.connect_event.set()
 
     # act
-    conn.publish({'foo': 'bar'})
+    looper.loop.run_until_complete(conn.publish({'foo': 'bar'}))
 
     # assert
     conn._client.publish.assert_called_once_with(
-        '/devices/test01/events', '{"foo": "bar"}',
+        '/devices/test01/events', b'{"foo": "bar"}',
         qos=1)
 
 
@@ -288,6 +310,7 @@ def test_run_send_stop_no_value(looper):
         looper.stop()
 
     mock_client = mock.Mock()
+    mock_client.wait_until_connected = AsyncMock()
 
     client = iotcore.IOTCoreClient(mock_client)
 
@@ -309,7 +332,8 @@ def test_run_send_value_then_stop(looper):
         looper.stop()
 
     mock_client = mock.Mock()
-    mock_client._wait_for_connection = return_immediately
+    mock_client.wait_until_connected = AsyncMock()
+    mock_client.publish = AsyncMock()
 
     client = iotcore.IOTCoreClient(mock_client)
 
@@ -322,3 +346,973 @@ def test_run_send_value_then_stop(looper):
     )
 
     mock_client.publish.assert_called_with('test value')
+
+
+def test_run_send_leaves_messages_queued_while_disconnected(
+    looper, private_key
+):
+    # arrange
+    conn = connected_with_mids(looper, private_key)
+    conn._set_state(iotcore.DISCONNECTED)
+    client = iotcore.IOTCoreClient(conn)
+    while_disconnected = []
+
+    async def do_task(looper):
+        for n in range(3):
+            await looper.send_queue.put({'n': n})
+        await asyncio.sleep(0.01, loop=looper.loop)
+        while_disconnected.extend([looper.send_queue.qsize(), conn.pending])
+        conn._set_state(iotcore.CONNECTED)
+        await asyncio.sleep(0.01, loop=looper.loop)
+        looper.stop()
+
+    # act
+    looper.loop.run_until_complete(
+        asyncio.gather(
+            client.run_send(looper),
+            do_task(looper),
+            loop=looper.loop
+        )
+    )
+
+    # assert
+    # the send queue's capacity and policy apply during the outage
+    assert while_disconnected == [3, 0]
+    assert conn._client.publish.call_count == 3
+
+
+def test_publish_message_serializes_models(looper, iotcore_connection):
+    # arrange
+    conn = iotcore_connection
+    conn.connect_event.set()
+
+    # act
+    looper.loop.run_until_complete(conn.publish(
+        BatchMessage([{'foo': 'bar'}, LogMessage.error('hi')])
+    ))
+
+    # assert
+    conn._client.publish.assert_called_once_with(
+        '/devices/test01/events',
+        b'{"type": "batch", "messages": [{"foo": "bar"}, '
+        b'{"type": "log", "message": "hi", "level": "error"}]}',
+        qos=1)
+
+
+@mock.patch('bobnet_sensors.iotcore.Connection')
+def test_load_iotcore_with_batching(mock_Connection, looper):
+    # act
+    client = iotcore.load_iotcore(looper, {'iotcore': {'batch': {
+        'max_messages': 10,
+        'linger': '1s',
+    }}})
+
+    # assert
+    assert client._batcher.max_messages == 10
+    assert client._batcher.linger == 1.0
+
+
+def test_create_batcher_fails_with_no_messages():
+    with pytest.raises(ValueError):
+        iotcore.Batcher(max_messages=0)
+
+
+def collect_batches(looper, batcher, messages, count):
+    batches = []
+
+    async def feed():
+        for message in messages:
+            await looper.send_queue.put(message)
+
+    async def collect():
+        for _ in range(count):
+            batches.append(await batcher.collect(looper))
+
+    looper.loop.run_until_complete(
+        asyncio.gather(feed(), collect(), loop=looper.loop)
+    )
+    return batches
+
+
+def test_batcher_flushes_on_max_messages(looper):
+    batcher = iotcore.Batcher(max_messages=2, linger=10)
+
+    batches = collect_batches(looper, batcher, [1, 2, 3, 4, 5], 2)
+
+    assert batches == [[1, 2], [3, 4]]
+
+
+def test_batcher_flushes_on_linger(looper):
+    batcher = iotcore.Batcher(max_messages=10, linger=0.01)
+
+    batches = collect_batches(looper, batcher, [1, 2, 3], 1)
+
+    assert batches == [[1, 2, 3]]
+
+
+def test_batcher_flushes_on_max_bytes(looper):
+    message = {'sensor': 'name', 'value': {'count': 1}}
+    size = iotcore.Batcher().message_size(message)
+    batcher = iotcore.Batcher(max_messages=10, max_bytes=size * 2,
+                              linger=0.01)
+
+    batches = collect_batches(looper, batcher, [message] * 3, 2)
+
+    assert batches == [[message, message], [message]]
+
+
+@pytest.mark.parametrize('encoding', [JSON, MSGPACK])
+def test_batcher_encodes_each_message_once(looper, encoding):
+    # arrange
+    messages = [{'sensor': 'name', 'value': n} for n in range(3)]
+    counting = mock.Mock(wraps=encoding)
+    batcher = iotcore.Batcher(max_messages=3, linger=10, encoding=counting)
+
+    async def collect(looper):
+        for message in messages:
+            await looper.send_queue.put(message)
+        return await batcher.collect_payload(looper)
+
+    # act
+    batch, payload = looper.loop.run_until_complete(collect(looper))
+
+    # assert
+    assert batch == messages
+    assert payload == encoding.encode(BatchMessage(messages))
+    assert counting.encode.call_count == 3
+
+
+def test_batcher_flushes_on_stop(looper):
+    batcher = iotcore.Batcher(max_messages=10, linger=10)
+    batches = []
+
+    async def do_task(looper):
+        await looper.send_queue.put('one')
+        await asyncio.sleep(0.001)
+        looper.stop()
+
+    async def collect(looper):
+        batches.append(await batcher.collect(looper))
+
+    looper.loop.run_until_complete(
+        asyncio.gather(collect(looper), do_task(looper), loop=looper.loop)
+    )
+
+    assert batches == [['one']]
+
+
+def test_run_send_batches_then_stop(looper):
+    async def do_task(looper):
+        for value in ['one', 'two', 'three']:
+            await looper.send_queue.put(value)
+        await asyncio.sleep(0.01)
+        looper.stop()
+
+    mock_client = mock.Mock()
+    mock_client.wait_until_connected = AsyncMock()
+    mock_client.publish = AsyncMock()
+
+    client = iotcore.IOTCoreClient(
+        mock_client, iotcore.Batcher(max_messages=2, linger=0.001)
+    )
+
+    looper.loop.run_until_complete(
+        asyncio.gather(
+            client.run_send(looper),
+            do_task(looper),
+            loop=looper.loop
+        )
+    )
+
+    assert mock_client.publish.call_args_list == [
+        mock.call(JSON.encode(BatchMessage(['one', 'two']))),
+        mock.call(JSON.encode(BatchMessage(['three']))),
+    ]
+
+
+def test_publish_payload(iotcore_connection):
+    # arrange
+    conn = iotcore_connection
+    conn.connect_event.set()
+
+    # act
+    conn.publish_payload(b'{"foo": "bar"}')
+
+    # assert
+    conn._client.publish.assert_called_once_with(
+        '/devices/test01/events', b'{"foo": "bar"}', qos=1)
+
+
+@mock.patch('bobnet_sensors.iotcore.Connection')
+def test_load_iotcore_with_buffer(mock_Connection, looper, tmpdir):
+    # act
+    client = iotcore.load_iotcore(looper, {'iotcore': {'buffer': {
+        'path': str(tmpdir),
+        'retry_interval': '10s',
+        'commit_every': 50,
+        'commit_interval': '2s',
+    }}})
+
+    # assert
+    assert client._buffer.path == str(tmpdir)
+    assert client.retry_interval == 10
+    assert client.commit_every == 50
+    assert client.commit_interval == 2
+
+
+def test_start_with_buffer_tolerates_no_connection(tmpdir):
+    mock_client = mock.Mock()
+    mock_client.wait_for_connection.side_effect = RuntimeError('no')
+    client = iotcore.IOTCoreClient(mock_client, buffer=DiskBuffer(str(tmpdir)))
+
+    client.start()
+
+    assert mock_client.connect.called
+
+
+def test_start_without_buffer_fails_with_no_connection():
+    mock_client = mock.Mock()
+    mock_client.wait_for_connection.side_effect = RuntimeError('no')
+    client = iotcore.IOTCoreClient(mock_client)
+
+    with pytest.raises(RuntimeError):
+        client.start()
+
+
+def test_forward_publishes_buffered_messages(tmpdir):
+    buffer = DiskBuffer(str(tmpdir))
+    for payload in [b'one', b'two', b'three']:
+        buffer.append(payload)
+    mock_client = mock.Mock()
+    mock_client.window = 100
+    client = iotcore.IOTCoreClient(mock_client, buffer=buffer)
+
+    assert client.forward(max_n=2)
+    assert client.forward(max_n=2)
+    assert not client.forward(max_n=2)
+
+    assert mock_client.publish_payload.call_args_list == [
+        mock.call(b'one'), mock.call(b'two'), mock.call(b'three'),
+    ]
+
+
+def test_forward_does_nothing_when_disconnected(tmpdir):
+    buffer = DiskBuffer(str(tmpdir))
+    buffer.append(b'one')
+    mock_client = mock.Mock()
+    mock_client.connected = False
+    client = iotcore.IOTCoreClient(mock_client, buffer=buffer)
+
+    assert not client.forward()
+
+    assert not mock_client.publish_payload.called
+    assert len(buffer) == 1
+
+
+def test_forward_commits_records_as_they_are_acked(looper, tmpdir):
+    # arrange
+    buffer = DiskBuffer(str(tmpdir))
+    for payload in [b'one', b'two', b'three']:
+        buffer.append(payload)
+    acks = [looper.loop.create_future() for _ in range(3)]
+    mock_client = mock.Mock()
+    mock_client.window = 100
+    mock_client.publish_payload.side_effect = acks
+    client = iotcore.IOTCoreClient(mock_client, buffer=buffer)
+
+    # act
+    assert client.forward()
+    acks[1].set_result(0.01)
+    run_soon(looper)
+
+    # assert
+    # the first record is still in flight, so nothing is committed
+    assert len(buffer) == 3
+    assert not client.forward()
+
+    acks[0].set_result(0.01)
+    run_soon(looper)
+
+    assert len(buffer) == 1
+    looper.loop.run_until_complete(client.save_position(looper))
+    # a restart forwards the record still awaiting PUBACK
+    assert DiskBuffer(str(tmpdir)).peek(10) == [b'three']
+
+
+def test_forward_saves_position_every_commit_every_acks(looper, tmpdir):
+    # arrange
+    buffer = DiskBuffer(str(tmpdir))
+    for i in range(10):
+        buffer.append(str(i).encode('ascii'))
+
+    def acked(payload):
+        ack = looper.loop.create_future()
+        ack.set_result(0.01)
+        return ack
+
+    mock_client = mock.Mock()
+    mock_client.window = 4
+    mock_client.wait_for_window = AsyncMock()
+    mock_client.publish_payload.side_effect = acked
+    client = iotcore.IOTCoreClient(
+        mock_client, buffer=buffer, commit_every=4, commit_interval=60
+    )
+    saves = []
+    save_position = buffer.save_position
+
+    def counting_save_position(position=None):
+        saves.append(threading.current_thread())
+        save_position(position)
+    buffer.save_position = counting_save_position
+
+    async def stop_when_forwarded(looper):
+        while len(buffer):
+            await asyncio.sleep(0.01, loop=looper.loop)
+        await asyncio.sleep(0.05, loop=looper.loop)
+        looper.stop()
+
+    # act
+    looper.loop.run_until_complete(asyncio.gather(
+        client.run_store_and_forward(looper), stop_when_forwarded(looper),
+        loop=looper.loop
+    ))
+
+    # assert
+    # once or twice for 10 acks off the loop, then again on shutdown
+    assert 2 <= len(saves) <= 3
+    assert threading.main_thread() not in saves[:-1]
+    assert saves[-1] is threading.main_thread()
+    assert len(DiskBuffer(str(tmpdir))) == 0
+
+
+def test_forward_resends_records_dropped_while_offline(
+    looper, private_key, tmpdir
+):
+    # arrange
+    buffer = DiskBuffer(str(tmpdir))
+    for i in range(20):
+        buffer.append(str(i).encode('ascii'))
+    conn = connected_with_mids(
+        looper, private_key, offline_messages=5, max_inflight=20
+    )
+    delivered = []
+    publish = conn._client.publish.side_effect
+
+    def publish_then_drop(topic, payload, qos):
+        delivered.append(payload)
+        if len(delivered) == 2:
+            # the bridge goes away part way through forwarding
+            conn._set_state(iotcore.DISCONNECTED)
+        return publish(topic, payload, qos=qos)
+    conn._client.publish.side_effect = publish_then_drop
+    client = iotcore.IOTCoreClient(conn, buffer=buffer)
+
+    def ack_all():
+        for mid in list(conn._inflight):
+            conn._acked(mid)
+        run_soon(looper)
+
+    # act
+    assert client.forward()
+    run_soon(looper)
+    conn._requeue_inflight()
+    conn._set_state(iotcore.CONNECTED)
+    conn._send_pending()
+    ack_all()
+
+    # assert
+    # records dropped from the offline queue are not committed
+    assert len(buffer) == 18
+    while client.forward():
+        ack_all()
+    assert len(buffer) == 0
+    assert set(delivered) == {str(i).encode('ascii') for i in range(20)}
+
+
+def test_run_send_stores_and_forwards(looper, tmpdir):
+    async def do_task(looper):
+        await looper.send_queue.put({'foo': 'bar'})
+        await asyncio.sleep(0.01)
+        looper.stop()
+
+    def acked(payload):
+        ack = looper.loop.create_future()
+        ack.set_result(0.01)
+        return ack
+
+    mock_client = mock.Mock()
+    mock_client.encoding = JSON
+    mock_client.window = 100
+    mock_client.wait_for_window = AsyncMock()
+    mock_client.publish_payload.side_effect = acked
+    buffer = DiskBuffer(str(tmpdir))
+    client = iotcore.IOTCoreClient(mock_client, buffer=buffer)
+
+    looper.loop.run_until_complete(
+        asyncio.gather(
+            client.run_send(looper),
+            do_task(looper),
+            loop=looper.loop
+        )
+    )
+
+    mock_client.publish_payload.assert_called_once_with(b'{"foo": "bar"}')
+    assert len(DiskBuffer(str(tmpdir))) == 0
+
+
+def test_run_send_keeps_messages_while_disconnected(looper, tmpdir):
+    async def do_task(looper):
+        await looper.send_queue.put({'foo': 'bar'})
+        await asyncio.sleep(0.01)
+        looper.stop()
+
+    mock_client = mock.Mock()
+    mock_client.encoding = JSON
+    mock_client.window = 100
+    mock_client.wait_for_window = AsyncMock()
+    mock_client.connected = False
+    client = iotcore.IOTCoreClient(
+        mock_client, buffer=DiskBuffer(str(tmpdir))
+    )
+
+    looper.loop.run_until_complete(
+        asyncio.gather(
+            client.run_send(looper),
+            do_task(looper),
+            loop=looper.loop
+        )
+    )
+
+    assert not mock_client.publish_payload.called
+    assert DiskBuffer(str(tmpdir)).peek(10) == [b'{"foo": "bar"}']
+
+
+def test_create_connection_with_encoding(looper, mock_mqtt, valid_config):
+    # arrange
+    valid_config['iotcore']['encoding'] = 'msgpack'
+
+    # act
+    conn = iotcore.Connection.from_config(looper, valid_config)
+
+    # assert
+    assert conn.encoding == MSGPACK
+    assert conn.events_topic == '/devices/test01/events/msgpack'
+
+
+def test_create_connection_fails_with_unknown_encoding(
+    looper, mock_mqtt, valid_config
+):
+    # arrange
+    valid_config['iotcore']['encoding'] = 'xml'
+
+    # act and assert
+    with pytest.raises(ValueError):
+        iotcore.Connection.from_config(looper, valid_config)
+
+
+def test_publish_message_with_msgpack(looper, iotcore_connection):
+    # arrange
+    conn = iotcore_connection
+    conn.encoding = MSGPACK
+    conn.connect_event.set()
+
+    # act
+    looper.loop.run_until_complete(conn.publish({'foo': 'bar'}))
+
+    # assert
+    conn._client.publish.assert_called_once_with(
+        '/devices/test01/events/msgpack', b'\x81\xa3foo\xa3bar',
+        qos=1)
+
+
+def test_batcher_sizes_messages_with_encoding():
+    message = {'sensor': 'name', 'value': {'count': 1}}
+
+    json_size = iotcore.Batcher(encoding=JSON).message_size(message)
+    msgpack_size = iotcore.Batcher(encoding=MSGPACK).message_size(message)
+
+    assert msgpack_size < json_size
+
+
+def test_create_jwt_with_lifetime(private_key):
+    token = iotcore.create_jwt('bobnet-project', private_key, lifetime=600)
+
+    payload = jwt.decode(token, private_key,
+                         algorithms=['RS256'], verify=False)
+    assert payload['exp'] - payload['iat'] == 600
+
+
+def test_create_connection_with_token_lifetime(
+    looper, mock_mqtt, valid_config
+):
+    valid_config['iotcore']['token_lifetime'] = '20m'
+    valid_config['iotcore']['token_refresh'] = '1m'
+
+    conn = iotcore.Connection.from_config(looper, valid_config)
+
+    assert conn.token_lifetime == 20 * 60
+    assert conn.token_refresh == 60
+
+
+def test_create_connection_fails_with_refresh_after_expiry(
+    looper, mock_mqtt, valid_config
+):
+    valid_config['iotcore']['token_lifetime'] = '5m'
+    valid_config['iotcore']['token_refresh'] = '5m'
+
+    with pytest.raises(ValueError):
+        iotcore.Connection.from_config(looper, valid_config)
+
+
+def test_connect_records_token_expiry(mock_mqtt_client, iotcore_connection):
+    conn = iotcore_connection
+
+    conn.connect()
+
+    assert conn.token_expires == pytest.approx(time.time() + 60 * 60, abs=5)
+    mock_mqtt_client.username_pw_set.assert_called_once_with(
+        username='unused', password=mock.ANY
+    )
+
+
+def test_rotate_token_reconnects_same_client(iotcore_connection):
+    # arrange
+    conn = iotcore_connection
+    conn.connect = mock.Mock()
+    # paho may report the old session closing while reconnecting
+    conn._client.reconnect.side_effect = \
+        lambda: conn.on_disconnect(None, None, 0)
+
+    # act
+    conn.rotate_token('new token', 1234)
+
+    # assert
+    conn._client.username_pw_set.assert_called_once_with(
+        username='unused', password='new token'
+    )
+    assert conn._client.method_calls[-4:] == [
+        mock.call.loop_stop(),
+        mock.call.username_pw_set(username='unused', password='new token'),
+        mock.call.reconnect(),
+        mock.call.loop_start(),
+    ]
+    assert not conn.connect.called
+    assert not conn._rotating
+    assert conn.token_expires == 1234
+
+
+@pytest.fixture
+def broker(tmpdir):
+    cert_path, key_path = make_certificate(str(tmpdir))
+    the_broker = FakeBroker(cert_path, key_path)
+    the_broker.ca_certs_path = cert_path
+    the_broker.start()
+    yield the_broker
+    the_broker.stop()
+
+
+def test_token_rotation_makes_one_connection_each(looper, broker,
+                                                  private_key):
+    # arrange
+    conn = iotcore.Connection(
+        looper, 'europe-west1', 'test-project', 'test-registry', 'test01',
+        private_key, broker.ca_certs_path, token_lifetime=1.0,
+        token_refresh=0.7, backoff=iotcore.Backoff(0.01, 0.01),
+        host='localhost', port=broker.port,
+    )
+    rotations = []
+    rotate_token = conn.rotate_token
+
+    def counting_rotate_token(token, expires):
+        rotate_token(token, expires)
+        rotations.append(expires)
+    conn.rotate_token = counting_rotate_token
+    looper.loop.call_later(3, looper.stop)
+
+    async def publish(looper):
+        while not looper.stopping:
+            conn.publish_payload(b'reading')
+            await looper.wait_for(0.01)
+
+    # act
+    conn.connect()
+    conn.wait_for_connection()
+    try:
+        looper.loop.run_until_complete(asyncio.gather(
+            conn.run(looper), publish(looper), loop=looper.loop
+        ))
+        # the broker counts connections on its own thread, let it catch up
+        deadline = time.time() + 5
+        while conn.state != iotcore.CONNECTED and time.time() < deadline:
+            time.sleep(0.01)
+    finally:
+        conn._client.loop_stop()
+        conn._client.disconnect()
+
+    # assert
+    assert len(rotations) >= 3
+    assert broker.connections == len(rotations) + 1
+
+
+def test_run_token_refresh_rotates_before_expiry(looper, iotcore_connection):
+    # arrange
+    conn = iotcore_connection
+    conn._set_state(iotcore.CONNECTED)
+    conn.token_expires = time.time() + conn.token_refresh
+    rotated = []
+
+    def rotate_token(token, expires):
+        rotated.append((token, expires))
+        conn.token_expires = expires
+        looper.loop.call_soon_threadsafe(looper.stop)
+    conn.rotate_token = rotate_token
+
+    # act
+    looper.loop.run_until_complete(asyncio.wait_for(
+        conn.run_token_refresh(looper), 5, loop=looper.loop
+    ))
+
+    # assert
+    assert len(rotated) == 1
+    token, expires = rotated[0]
+    assert jwt.decode(token, verify=False)['aud'] == 'test-project'
+    assert expires == pytest.approx(time.time() + 60 * 60, abs=5)
+
+
+def test_run_token_refresh_sleeps_while_disconnected(
+        looper, iotcore_connection):
+    # arrange
+    conn = iotcore_connection
+    conn.token_expires = time.time() - 1
+    # as left by a state change the reconnect has not seen yet
+    conn._state_changed.set()
+    waits = []
+    wait_event = conn._wait_event
+
+    def counting_wait_event(*args, **kwargs):
+        waits.append(args)
+        return wait_event(*args, **kwargs)
+    conn._wait_event = counting_wait_event
+    rotated = []
+
+    def rotate_token(token, expires):
+        rotated.append(expires)
+        conn.token_expires = expires
+        looper.loop.call_soon_threadsafe(looper.stop)
+    conn.rotate_token = rotate_token
+    looper.loop.call_later(0.1, conn._set_state, iotcore.CONNECTED)
+
+    # act
+    looper.loop.run_until_complete(asyncio.wait_for(
+        conn.run_token_refresh(looper), 5, loop=looper.loop
+    ))
+
+    # assert
+    assert len(waits) == 1
+    assert len(rotated) == 1
+
+
+def test_token_refresh_over_a_virtual_day(virtual_looper, private_key):
+    # arrange
+    looper = virtual_looper
+    conn = iotcore.Connection(
+        looper, 'europe-west1', 'test-project', 'test-registry', 'test01',
+        private_key, './tests/fixtures/roots.pem',
+    )
+    conn._client = mock.Mock()
+    conn._set_state(iotcore.CONNECTED)
+    conn.token_expires = clock.time() + conn.token_lifetime
+    expiries = []
+
+    def rotate_token(token, expires):
+        expiries.append(jwt.decode(token, verify=False)['exp'])
+        conn.token_expires = expires
+    conn.rotate_token = rotate_token
+    day = 24 * 60 * 60
+    looper.loop.call_later(day, looper.stop)
+
+    # act
+    looper.loop.run_until_complete(conn.run_token_refresh(looper))
+
+    # assert
+    interval = conn.token_lifetime - conn.token_refresh
+    assert len(expiries) == day // interval
+    assert expiries[-1] == pytest.approx(
+        VIRTUAL_START + len(expiries) * interval + conn.token_lifetime, abs=1
+    )
+
+
+def test_backoff_delay_is_capped_and_jittered():
+    backoff = iotcore.Backoff(initial=1, maximum=10)
+
+    delays = [backoff.delay(attempt) for attempt in range(20)]
+
+    assert all(0 <= delay <= 10 for delay in delays)
+    assert backoff.delay(0) <= 1
+    assert len(set(delays)) > 1
+
+
+def test_backoff_delay_grows_exponentially():
+    backoff = iotcore.Backoff(initial=1, maximum=300)
+
+    with mock.patch('random.uniform', side_effect=lambda a, b: b):
+        delays = [backoff.delay(attempt) for attempt in range(10)]
+
+    assert delays == [1, 2, 4, 8, 16, 32, 64, 128, 256, 300]
+
+
+def test_backoff_rejects_invalid_bounds():
+    with pytest.raises(ValueError):
+        iotcore.Backoff(initial=0)
+    with pytest.raises(ValueError):
+        iotcore.Backoff(initial=10, maximum=5)
+
+
+def test_create_connection_with_reconnect(looper, mock_mqtt, valid_config):
+    valid_config['iotcore']['reconnect'] = {'initial': '2s', 'max': '1m'}
+
+    conn = iotcore.Connection.from_config(looper, valid_config)
+
+    assert conn.backoff.initial == 2
+    assert conn.backoff.maximum == 60
+
+
+def test_on_connect_refused(iotcore_connection):
+    conn = iotcore_connection
+
+    conn.on_connect(None, None, None, 5)
+
+    assert not conn._client.subscribe.called
+    assert not conn.connected
+
+
+def test_on_disconnect_does_not_reconnect(iotcore_connection):
+    # arrange
+    conn = iotcore_connection
+    conn.connect = mock.Mock()
+    states = []
+    conn.add_state_callback(states.append)
+    conn.on_connect(None, None, None, 0)
+
+    # act
+    conn.on_disconnect(None, None, 1)
+
+    # assert
+    assert not conn.connect.called
+    assert conn.state == iotcore.DISCONNECTED
+    assert states == [iotcore.CONNECTED, iotcore.DISCONNECTED]
+
+
+def test_publish_holds_messages_while_disconnected(
+    looper, iotcore_connection
+):
+    # arrange
+    conn = iotcore_connection
+
+    # act
+    result = conn.publish_payload(b'one')
+    conn.publish_payload(b'two')
+
+    # assert
+    assert not result.done()
+    assert not conn._client.publish.called
+    assert conn.pending == 2
+
+    # act
+    conn.on_connect(None, None, None, 0)
+    looper.loop.run_until_complete(asyncio.sleep(0, loop=looper.loop))
+
+    # assert
+    assert conn.pending == 0
+    assert conn._client.publish.call_args_list == [
+        mock.call('/devices/test01/events', b'one', qos=1),
+        mock.call('/devices/test01/events', b'two', qos=1),
+    ]
+
+
+def test_publish_drops_oldest_when_offline_queue_full(
+    looper, private_key
+):
+    conn = iotcore.Connection(
+        looper, 'europe-west1', 'test-project', 'test-registry', 'test01',
+        private_key, './tests/fixtures/roots.pem', offline_messages=2,
+    )
+    conn._client = mock.Mock()
+
+    acks = [conn.publish_payload(p) for p in (b'one', b'two', b'three')]
+    conn.on_connect(None, None, None, 0)
+    looper.loop.run_until_complete(asyncio.sleep(0, loop=looper.loop))
+
+    assert [c[0][1] for c in conn._client.publish.call_args_list] == \
+        [b'two', b'three']
+    assert acks[0].cancelled()
+
+
+def test_run_reconnect_connects_after_disconnect(looper, iotcore_connection):
+    # arrange
+    conn = iotcore_connection
+    conn.backoff = iotcore.Backoff(initial=0.01, maximum=0.01)
+    attempts = []
+
+    def connect():
+        attempts.append(conn.state)
+        if len(attempts) < 3:
+            raise OSError('refused')
+        conn.on_connect(None, None, None, 0)
+        looper.loop.call_soon_threadsafe(looper.stop)
+    conn.connect = connect
+
+    # act
+    looper.loop.run_until_complete(asyncio.wait_for(
+        conn.run_reconnect(looper), 5, loop=looper.loop
+    ))
+
+    # assert
+    assert attempts == [iotcore.WAITING] * 3
+    assert conn.connected
+
+
+def test_run_reconnect_abandons_slow_connection(looper, iotcore_connection):
+    # arrange
+    conn = iotcore_connection
+    conn.connect_timeout = 0.01
+    conn._set_state(iotcore.CONNECTING)
+    states = []
+    stopped_on = None
+
+    def loop_stop():
+        nonlocal stopped_on
+        stopped_on = threading.current_thread()
+    conn._client.loop_stop.side_effect = loop_stop
+
+    def on_state(state):
+        states.append(state)
+        if state == iotcore.WAITING:
+            looper.loop.call_soon_threadsafe(looper.stop)
+    conn.add_state_callback(on_state)
+
+    # act
+    looper.loop.run_until_complete(asyncio.wait_for(
+        conn.run_reconnect(looper), 5, loop=looper.loop
+    ))
+
+    # assert
+    assert states[:2] == [iotcore.DISCONNECTED, iotcore.WAITING]
+    assert conn._client.loop_stop.called
+    # joining the network thread does not block the event loop
+    assert stopped_on is not threading.main_thread()
+
+
+def connected_with_mids(looper, private_key, **kwargs):
+    conn = iotcore.Connection(
+        looper, 'europe-west1', 'test-project', 'test-registry', 'test01',
+        private_key, './tests/fixtures/roots.pem', **kwargs
+    )
+    conn._client = mock.Mock()
+    mids = iter(range(1, 1000))
+    conn._client.publish.side_effect = \
+        lambda *args, **kwargs: mock.Mock(mid=next(mids))
+    conn._set_state(iotcore.CONNECTED)
+    return conn
+
+
+def run_soon(looper):
+    looper.loop.run_until_complete(asyncio.sleep(0, loop=looper.loop))
+
+
+def test_publish_resolves_on_ack(looper, private_key):
+    # arrange
+    conn = connected_with_mids(looper, private_key)
+
+    # act
+    ack = looper.loop.run_until_complete(conn.publish({'foo': 'bar'}))
+    conn.on_publish(None, None, 1)
+    run_soon(looper)
+
+    # assert
+    assert ack.result() >= 0
+    assert conn.inflight == 0
+    latency = looper.metrics['bobnet_publish_ack_seconds'].snapshot()
+    assert latency['count'] == 1
+
+
+def test_publish_holds_messages_beyond_inflight_window(looper, private_key):
+    # arrange
+    conn = connected_with_mids(looper, private_key, max_inflight=2)
+
+    # act
+    acks = [conn.publish_payload(p) for p in (b'one', b'two', b'three')]
+
+    # assert
+    assert conn._client.publish.call_count == 2
+    assert conn.inflight == 2
+    assert conn.pending == 1
+    assert conn.window == 0
+
+    # act
+    conn.on_publish(None, None, 1)
+    run_soon(looper)
+
+    # assert
+    assert acks[0].done() and not acks[2].done()
+    assert conn._client.publish.call_args[0][1] == b'three'
+    assert conn.inflight == 2
+
+
+def test_publish_waits_for_room_in_window(looper, private_key):
+    # arrange
+    conn = connected_with_mids(looper, private_key, max_inflight=1)
+    looper.loop.run_until_complete(conn.publish('one'))
+    looper.loop.call_later(0.01, conn.on_publish, None, None, 1)
+
+    # act
+    looper.loop.run_until_complete(asyncio.wait_for(
+        conn.publish('two'), 1, loop=looper.loop
+    ))
+
+    # assert
+    assert conn._client.publish.call_count == 2
+
+
+def test_unacked_messages_are_resent_on_reconnect(looper, private_key):
+    # arrange
+    conn = connected_with_mids(looper, private_key)
+    acks = [conn.publish_payload(p) for p in (b'one', b'two')]
+    conn.on_publish(None, None, 1)
+    run_soon(looper)
+
+    # act
+    conn.on_disconnect(None, None, 1)
+    run_soon(looper)
+
+    # assert
+    assert conn.inflight == 0
+    assert conn.pending == 1
+
+    # act
+    conn.on_connect(None, None, None, 0)
+    run_soon(looper)
+    conn.on_publish(None, None, 3)
+    run_soon(looper)
+
+    # assert
+    assert conn._client.publish.call_args[0][1] == b'two'
+    assert all(ack.done() for ack in acks)
+
+
+def test_forward_is_limited_by_window(tmpdir):
+    buffer = DiskBuffer(str(tmpdir))
+    for payload in [b'one', b'two', b'three']:
+        buffer.append(payload)
+    mock_client = mock.Mock()
+    mock_client.window = 1
+    client = iotcore.IOTCoreClient(mock_client, buffer=buffer)
+
+    assert client.forward(max_n=10)
+    assert client.forward(max_n=10)
+
+    # records are only committed once acked
+    assert mock_client.publish_payload.call_args_list == [
+        mock.call(b'one'), mock.call(b'two'),
+    ]
+    assert len(buffer) == 3
@@ -3,6 +3,8 @@ from unittest import mock
 
 from bobnet_sensors.main import run
 
+from conftest import AsyncMock
+
 
 async def send_one_value_then_stop(looper):
     await looper.send_queue.put('one value')
@@ -10,10 +12,6 @@ async def send_one_value_then_stop(looper):
     looper.stop()
 
 
-async def do_nothing(looper):
-    pass
-
-
 def test_run_immediately_stop(looper, sensors, iotcore_client):
     looper.stop()
     sensors.update_config = mock.Mock()
@@ -27,9 +25,8 @@ def test_run_immediately_stop(looper, sensors, iotcore_client):
 
 def test_run_with_one_value(looper, sensors, iotcore_client):
     sensors.update_config = mock.Mock()
-    iotcore_client.send = mock.Mock()
-    sensors._sensors['sensor1'].run = send_one_value_then_stop
-    sensors._sensors['sensor2'].run = do_nothing
+    iotcore_client.send = AsyncMock()
+    sensors.run = send_one_value_then_stop
 
     run(looper, iotcore_client, sensors)
 
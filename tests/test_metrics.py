@@ -0,0 +1,152 @@
+import asyncio
+
+import pytest
+
+from bobnet_sensors.metrics import (
+    Exporter, Histogram, Registry, load_metrics
+)
+from bobnet_sensors.models import MetricsMessage
+
+
+def test_counter_renders_by_label():
+    registry = Registry()
+    counter = registry.counter('reads_total', 'Reads', ['sensor'])
+
+    counter.inc(sensor='a')
+    counter.inc(2, sensor='a')
+    counter.inc(sensor='b')
+
+    assert registry.render() == (
+        '# HELP reads_total Reads\n'
+        '# TYPE reads_total counter\n'
+        'reads_total{sensor="a"} 3.0\n'
+        'reads_total{sensor="b"} 1.0\n'
+    )
+
+
+def test_counter_requires_its_labels():
+    counter = Registry().counter('reads_total', 'Reads', ['sensor'])
+
+    with pytest.raises(ValueError):
+        counter.inc()
+
+
+def test_gauge_reads_function_when_rendered():
+    registry = Registry()
+    items = []
+    registry.gauge('depth', 'Depth').set_function(lambda: len(items))
+
+    items.append(1)
+
+    assert 'depth 1.0' in registry.render()
+    assert registry.snapshot() == {'depth': 1}
+
+
+def test_registry_returns_existing_metric():
+    registry = Registry()
+
+    counter = registry.counter('reads_total', 'Reads')
+
+    assert registry.counter('reads_total', 'Reads') is counter
+    with pytest.raises(ValueError):
+        registry.gauge('reads_total', 'Reads')
+
+
+def test_histogram_renders_cumulative_buckets():
+    registry = Registry()
+    histogram = registry.histogram('latency', 'Latency', buckets=(0.1, 1))
+
+    for value in (0.05, 0.1, 0.5, 2):
+        histogram.observe(value)
+
+    assert registry.render().splitlines()[2:] == [
+        'latency_bucket{le="0.1"} 2.0',
+        'latency_bucket{le="1.0"} 3.0',
+        'latency_bucket{le="+Inf"} 4.0',
+        'latency_sum 2.65',
+        'latency_count 4.0',
+    ]
+
+
+@pytest.mark.parametrize('q,expected', [
+    (0.25, 0.5),
+    (0.5, 1.0),
+    (0.75, 1.5),
+    (1.0, 2.0),
+])
+def test_histogram_quantile_interpolates_in_bucket(q, expected):
+    histogram = Histogram('latency', 'Latency', buckets=(1, 2))
+
+    for value in (0.5, 0.9, 1.5, 1.9):
+        histogram.observe(value)
+
+    assert histogram.quantile(q) == pytest.approx(expected)
+
+
+def test_histogram_snapshot_is_compact():
+    histogram = Histogram('latency', 'Latency', ['sensor'], buckets=(1, 2))
+
+    histogram.observe(0.5, sensor='a')
+    histogram.observe(5, sensor='a')
+
+    assert histogram.snapshot() == {'a': {
+        'count': 2, 'sum': 5.5, 'p50': 1.0, 'p95': 2,
+    }}
+
+
+def test_load_metrics():
+    assert load_metrics({}) is None
+
+    exporter = load_metrics({'metrics': {'port': 9100, 'publish': '1m'}})
+
+    assert exporter.host == '127.0.0.1'
+    assert exporter.port == 9100
+    assert exporter.publish == 60
+
+
+def test_looper_exposes_queue_depth(looper):
+    looper.send_queue.put_nowait('one')
+
+    assert 'bobnet_queue_depth{queue="send"} 1.0' in looper.metrics.render()
+
+
+def test_exporter_serves_metrics(looper):
+    looper.metrics.counter('reads_total', 'Reads').inc()
+    exporter = Exporter(port=0)
+
+    async def scrape():
+        while exporter.server is None:
+            await asyncio.sleep(0.001, loop=looper.loop)
+        port = exporter.server.sockets[0].getsockname()[1]
+        reader, writer = await asyncio.open_connection(
+            '127.0.0.1', port, loop=looper.loop
+        )
+        writer.write(b'GET /metrics HTTP/1.1\r\nHost: localhost\r\n\r\n')
+        response = await reader.read()
+        looper.stop()
+        return response
+
+    response, _ = looper.loop.run_until_complete(asyncio.gather(
+        scrape(), exporter.run(looper), loop=looper.loop
+    ))
+
+    assert response.startswith(b'HTTP/1.0 200 OK\r\n')
+    assert b'\r\n\r\n# HELP' in response
+    assert b'reads_total 1.0\n' in response
+
+
+def test_exporter_publishes_metrics(looper):
+    looper.metrics.counter('reads_total', 'Reads').inc()
+    exporter = Exporter(publish=0.001)
+
+    async def receive():
+        message = await looper.send_queue.get()
+        looper.stop()
+        return message
+
+    message, _ = looper.loop.run_until_complete(asyncio.gather(
+        receive(), exporter.run(looper), loop=looper.loop
+    ))
+
+    assert isinstance(message, MetricsMessage)
+    assert message.metrics['reads_total'] == 1
@@ -6,10 +6,12 @@ from conftest import roughly
 
 from bobnet_sensors.models import (
     ConfigMessage,
+    BatchMessage,
     CommandMessage,
     CommandResponseMessage,
     DataMessage,
-    LogMessage
+    LogMessage,
+    MetricsMessage,
 )
 
 
@@ -19,6 +21,8 @@ from bobnet_sensors.models import (
     (DataMessage('d', {}), 'data'),
     (CommandResponseMessage('d', 1, 'new'), 'command_response'),
     (LogMessage.error('hi'), 'log'),
+    (BatchMessage([]), 'batch'),
+    (MetricsMessage({}), 'metrics'),
 ])
 def test_message_type(message, expected_type):
     assert message.type == expected_type
@@ -43,7 +47,12 @@ def test_message_type(message, expected_type):
         {'type': 'log',
          'level': 'error',
          'message': 'hi'}
-    )
+    ),
+    (
+        BatchMessage([{'foo': 'bar'}]),
+        {'type': 'batch',
+         'messages': [{'foo': 'bar'}]}
+    ),
 ])
 def test_message_as_json(message, expected_json):
     assert message.as_json() == expected_json
@@ -79,6 +88,18 @@ def test_command_message_from_dict(command_dict, expected_command):
     assert command == expected_command
 
 
+def test_acked_command_runs_again_after_two_hours(virtual_looper):
+    command = CommandMessage('mydevice', 1, 'new', None).ack()
+
+    virtual_looper.loop.run_until_complete(
+        virtual_looper.wait_for(2 * 60 * 60 - 1)
+    )
+    assert not command.should_run
+
+    virtual_looper.loop.run_until_complete(virtual_looper.wait_for(1))
+    assert command.should_run
+
+
 def test_command_message_ack():
     command = CommandMessage('mydevice', 1, 'new', None)
     assert command.ack() == CommandMessage('mydevice', 1, 'ack',
@@ -0,0 +1,58 @@
+from bobnet_sensors.recording import Recorder, read_recording
+
+
+def test_recording_round_trip(tmpdir):
+    path = str(tmpdir.join('recording'))
+    recorder = Recorder(path)
+
+    recorder.record('a', 1.5, {'temp': 20.5, 'rgb': (1, 2, 3)})
+    recorder.record('b', 2.5, 7)
+    recorder.close()
+
+    assert list(read_recording(path)) == [
+        (1.5, 'a', {'temp': 20.5, 'rgb': [1, 2, 3]}),
+        (2.5, 'b', 7),
+    ]
+    assert recorder.records == 2
+
+
+def test_recording_is_appended(tmpdir):
+    path = str(tmpdir.join('recording'))
+    for value in (1, 2):
+        recorder = Recorder(path)
+        recorder.record('a', value, value)
+        recorder.close()
+
+    assert [value for _, _, value in read_recording(path)] == [1, 2]
+
+
+def test_read_recording_for_sensor(tmpdir):
+    path = str(tmpdir.join('recording'))
+    recorder = Recorder(path)
+    for i, sensor in enumerate('abab'):
+        recorder.record(sensor, i, i)
+    recorder.close()
+
+    assert list(read_recording(path, 'b')) == [(1, 'b', 1), (3, 'b', 3)]
+
+
+def test_read_recording_stops_at_torn_record(tmpdir):
+    path = str(tmpdir.join('recording'))
+    recorder = Recorder(path)
+    recorder.record('a', 1, 1)
+    recorder.record('a', 2, 2)
+    recorder.close()
+    with open(path, 'r+b') as f:
+        f.truncate(len(f.read()) - 1)
+
+    assert list(read_recording(path)) == [(1, 'a', 1)]
+
+
+def test_recorder_skips_values_it_cannot_encode(tmpdir):
+    path = str(tmpdir.join('recording'))
+    recorder = Recorder(path)
+
+    recorder.record('a', 1, object())
+    recorder.close()
+
+    assert list(read_recording(path)) == []
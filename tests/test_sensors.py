@@ -1,18 +1,21 @@
 from unittest import mock
 from datetime import datetime
 import asyncio
+import threading
+import time
 
 import pytest
 
-from conftest import roughly, sleep_short
+from conftest import AsyncMock, VIRTUAL_START, roughly, sleep_short
 from bobnet_sensors.sensors import (
-    Sensors, Sensor, parse_time, BaseDevice,
-    get_device_class
+    Sensors, Sensor, Scheduler, parse_time, BaseDevice,
+    DeviceRegistry, SharedDevice, SharedReads, get_device_class
 )
 from bobnet_sensors.sensors.counter import Device as CounterDevice
+from bobnet_sensors.recording import read_recording
 # from bobnet_sensors.sensors.mcp3008 import Device as MCP3008Device
 from bobnet_sensors.models import (
-    ConfigMessage, CommandMessage, LogMessage
+    ConfigMessage, CommandMessage, DataMessage, LogMessage
 )
 
 
@@ -195,7 +198,7 @@ def test_run_update_config(looper, mock_sensor_set):
         )
     )
 
-    assert looper.send_queue.queue.async_q.qsize() == 0
+    assert looper.send_queue.qsize() == 0
     assert answers == [CommandMessage('sensor1', 1, 'ack',
                                       roughly(datetime.utcnow()))]
     assert_update_config_called_once(
@@ -226,12 +229,12 @@ def test_run_update_config_with_error(looper, mock_sensor_set):
         )
     )
 
-    assert looper.send_queue.queue.async_q.qsize() == 0
+    assert looper.send_queue.qsize() == 0
     assert answers == [LogMessage.error('Unknown device in config invalid')]
     assert_no_update_config_called(mock_sensor_set)
 
 
-def test_create_sensors_from_config(mock_mcp3008, valid_config):
+def test_create_sensors_from_config(mock_spi_device, valid_config):
     sensors = Sensors.from_config(valid_config)
 
     sensors = list(sensors)
@@ -277,22 +280,615 @@ def test_update_config_failure():
     assert error == 'bad thing'
 
 
-def test_sensor_run(looper):
-    async def do_task(looper):
-        value = await looper.send_queue.get()
-        looper.stop()
-        return value
+def test_sensor_sample(looper):
+    sensor = Sensor('name', '10s', mock.Mock())
+
+    looper.loop.run_until_complete(sensor.sample(looper))
+
+    assert looper.send_queue.get_nowait() == {
+        'sensor': 'name', 'value': mock.ANY
+    }
+
+
+def test_create_sensor_with_deadband():
+    sensor = Sensor.create('name', {
+        'device': 'counter',
+        'deadband': {'absolute': 1, 'heartbeat': '1m'},
+    })
+
+    assert sensor.deadband.band.absolute == 1
+    assert sensor.deadband.heartbeat == 60
+
+
+def test_update_config_deadband():
+    sensor = Sensor('name', '10s', mock.Mock())
+
+    ok, error = sensor.update_config({'deadband': {'absolute': 2}})
+    assert ok
+    assert sensor.deadband.band.absolute == 2
+
+    ok, error = sensor.update_config({'deadband': None})
+    assert ok
+    assert sensor.deadband is None
+
+
+def test_sensor_sample_within_deadband(looper):
+    device = mock.Mock()
+    sensor = Sensor('name', '10s', device, deadband={'absolute': 1})
+
+    for value in [10, 10.5, 11.5]:
+        device.value = value
+        looper.loop.run_until_complete(sensor.sample(looper))
+
+    assert drain(looper.send_queue) == [
+        {'sensor': 'name', 'value': 10},
+        {'sensor': 'name', 'value': 11.5},
+    ]
+
+
+def test_sensor_sample_deadband_does_not_filter_errors(looper):
+    sensor = Sensor('name', '10s', BrokenDevice(), deadband={'absolute': 1})
+
+    looper.loop.run_until_complete(sensor.sample(looper))
+    looper.loop.run_until_complete(sensor.sample(looper))
+
+    assert len(drain(looper.send_queue)) == 2
+
+
+def test_create_sensor_with_aggregate():
+    sensor = Sensor.create('name', {
+        'device': 'counter',
+        'every': '0.1s',
+        'aggregate': {'window': '1m', 'percentiles': [95]},
+    })
+
+    assert sensor.aggregator.window == 60
+    assert sensor.aggregator.percentiles == (95,)
+
 
+def test_update_config_aggregate():
     sensor = Sensor('name', '10s', mock.Mock())
 
-    results = looper.loop.run_until_complete(
+    ok, error = sensor.update_config({'aggregate': {'window': '10s'}})
+    assert ok
+    assert sensor.aggregator.window == 10
+
+    ok, error = sensor.update_config({'aggregate': None})
+    assert ok
+    assert sensor.aggregator is None
+
+
+def test_sensor_sample_publishes_window_summaries(looper):
+    sensor = Sensor('name', '1s', CounterDevice(), aggregate={'window': '3s'})
+    start = looper.loop.time()
+
+    for now in range(5):
+        with mock.patch.object(looper.loop, 'time', return_value=start + now):
+            looper.loop.run_until_complete(sensor.sample(looper))
+
+    assert drain(looper.send_queue) == [
+        {'sensor': 'name', 'value': {'count': {
+            'count': 3, 'last': 2, 'min': 0, 'max': 2,
+            'mean': 1, 'stddev': pytest.approx(0.816, abs=1e-3),
+        }}},
+    ]
+
+
+def test_create_sensor_with_history():
+    sensor = Sensor.create('name', {
+        'device': 'counter',
+        'history': {'capacity': 60},
+    })
+
+    assert sensor.history.capacity == 60
+
+
+def test_sensor_keeps_no_history_unless_configured(looper):
+    sensor = Sensor.create('name', {'device': 'counter'})
+
+    looper.loop.run_until_complete(sensor.sample(looper))
+
+    assert sensor.history is None
+
+
+def test_sensor_sample_records_history(looper):
+    sensor = Sensor('name', '10s', CounterDevice(), history={})
+
+    for _ in range(3):
+        looper.loop.run_until_complete(sensor.sample(looper))
+
+    timestamps, values = sensor.history.window()
+    assert list(values['count']) == [0, 1, 2]
+    assert list(timestamps) == sorted(timestamps)
+
+
+def test_sensor_run_command_publishes_device_data(looper):
+    device = mock.Mock()
+    device.run_command = AsyncMock(return_value={'raw': [1, 2]})
+    sensor = Sensor('name', '10s', device)
+
+    looper.loop.run_until_complete(sensor.run_command(looper))
+
+    assert looper.send_queue.get_nowait() == DataMessage(
+        'name', {'raw': [1, 2]}
+    )
+
+
+def test_sensor_without_device_run_command():
+    sensor = Sensor('name', '10s', CounterDevice())
+
+    assert not hasattr(sensor, 'run_command')
+
+
+def test_sensors_with_the_same_device_config_have_their_own_devices():
+    sensors = Sensors.from_config({'sensors': {
+        'fast': {'device': 'counter', 'every': '1s'},
+        'slow': {'device': 'counter', 'every': '1m'},
+    }})
+
+    fast, slow = list(sensors)
+
+    assert fast.device is not slow.device
+    assert isinstance(fast.device, CounterDevice)
+    assert fast.device.value == slow.device.value == {'count': 0}
+
+
+@pytest.mark.parametrize('every', ['0.01s', '0.05s'])
+def test_fast_sensor_gets_a_fresh_value_every_read(virtual_looper, every):
+    sensors = Sensors.from_config({'sensors': {
+        'fast': {'device': 'counter', 'every': every},
+    }})
+    looper = virtual_looper
+    looper.loop.call_later(parse_time(every) * 19.5, looper.stop)
+
+    looper.loop.run_until_complete(sensors.run(looper))
+
+    counts = []
+    while not looper.send_queue.empty():
+        counts.append(looper.send_queue.get_nowait()['value']['count'])
+    assert counts == list(range(20))
+
+
+@mock.patch('bobnet_sensors.sensors.mcp3008.spidev', mock.Mock())
+def test_registry_shares_locks_per_resource(mock_spi_device):
+    registry = DeviceRegistry()
+
+    first = registry.get('mcp3008', {'channels': [
+        {'channel': 0, 'label': 'a'}
+    ]})
+    second = registry.get('mcp3008', {'channels': [
+        {'channel': 1, 'label': 'b'}
+    ]})
+    other = registry.get('mcp3008', {
+        'channels': [{'channel': 1, 'label': 'b'}],
+        'bus': {'type': 'spidev', 'port': 1},
+    })
+
+    assert first is not second
+    assert first.lock is second.lock
+    assert first.lock is not other.lock
+    assert first.reads is not second.reads
+
+
+def test_registry_does_not_share_devices_without_a_resource():
+    registry = DeviceRegistry()
+
+    first = registry.get('counter', {})
+    second = registry.get('counter', {})
+
+    assert isinstance(first, CounterDevice)
+    assert first is not second
+
+
+@mock.patch('bobnet_sensors.sensors.envirophat.envirophat', mock.Mock())
+def test_registry_shares_one_lock_for_envirophat():
+    registry = DeviceRegistry()
+
+    light = registry.get('envirophat', {'sensor': 'light.light'})
+    weather = registry.get('envirophat', {'sensor': 'weather.pressure'})
+
+    assert light is not weather
+    assert light.lock is weather.lock
+
+
+@mock.patch('bobnet_sensors.sensors.envirophat.envirophat', mock.Mock())
+def test_registry_shares_reads_of_the_same_config():
+    registry = DeviceRegistry()
+
+    first = registry.get('envirophat', {'sensor': 'light.light'})
+    second = registry.get('envirophat', {'sensor': 'light.light'})
+
+    assert first.device is not second.device
+    assert first.reads is second.reads
+
+
+def test_shared_device_coalesces_reads_of_other_sensors():
+    lock, reads = threading.Lock(), SharedReads()
+    first = SharedDevice(CounterDevice(), lock, reads, coalesce=10)
+    second = SharedDevice(CounterDevice(start=100), lock, reads, coalesce=10)
+
+    assert first.value == {'count': 0}
+    assert second.value == {'count': 0}
+    # neither gets the same read twice
+    assert second.value == {'count': 100}
+    assert first.value == {'count': 100}
+    assert first.value == {'count': 1}
+
+
+@mock.patch('bobnet_sensors.sensors.envirophat.envirophat', mock.Mock())
+def test_recorded_sensors_do_not_share_reads(tmpdir):
+    sensors = Sensors.from_config({
+        'sensors': {
+            'light1': {'device': 'envirophat', 'sensor': 'light.light'},
+            'light2': {'device': 'envirophat', 'sensor': 'light.light'},
+        },
+        'record': {'path': str(tmpdir.join('recording'))},
+    })
+
+    for sensor in sensors:
+        assert sensor.device.device.reads is None
+
+
+def test_shared_device_without_reads_always_reads():
+    device = SharedDevice(CounterDevice(), threading.Lock())
+
+    assert device.value == {'count': 0}
+    assert device.value == {'count': 1}
+
+
+def test_shared_device_delegates_to_device(looper):
+    inner = mock.Mock()
+    inner.run_command = AsyncMock(return_value={'raw': 1})
+    device = SharedDevice(inner, threading.Lock())
+
+    device.update_config({'leds': 'on'})
+    result = looper.loop.run_until_complete(device.run_command(looper))
+
+    inner.update_config.assert_called_once_with({'leds': 'on'})
+    assert result == {'raw': 1}
+    assert not hasattr(SharedDevice(CounterDevice(), None), 'run_command')
+
+
+class SlowDevice(BaseDevice):
+    def __init__(self, delay):
+        self.delay = delay
+
+    @property
+    def value(self):
+        time.sleep(self.delay)
+        return {'slow': 1}
+
+
+class BrokenDevice(BaseDevice):
+    @property
+    def value(self):
+        raise IOError('bus error')
+
+
+def test_create_sensor_with_timeout():
+    sensor = Sensor.create('name', {'device': 'counter', 'timeout': '2s'})
+
+    assert sensor.timeout == 2
+
+
+def test_update_config_timeout():
+    sensor = Sensor('sensor1', '10s', mock.Mock())
+
+    ok, error = sensor.update_config({'timeout': '1s'})
+
+    assert ok
+    assert sensor.timeout == 1
+
+
+def test_sensor_read(looper):
+    sensor = Sensor('name', '10s', CounterDevice())
+
+    value = looper.loop.run_until_complete(sensor.read(looper))
+
+    assert value == {'sensor': 'name', 'value': {'count': 0}}
+
+
+def test_sensor_read_times_out(looper):
+    sensor = Sensor('name', '10s', SlowDevice(0.05), timeout='0.01s')
+
+    value = looper.loop.run_until_complete(sensor.read(looper))
+
+    assert value == LogMessage.error('Timed out reading name after 0.01s')
+
+
+def test_sensor_read_records_latency(looper):
+    sensor = Sensor('name', '10s', CounterDevice())
+
+    looper.loop.run_until_complete(sensor.read(looper))
+
+    latency = looper.metrics['bobnet_read_seconds']
+    assert latency.snapshot()['name']['count'] == 1
+
+
+def test_sensor_read_counts_timeouts(looper):
+    sensor = Sensor('name', '10s', SlowDevice(0.05), timeout='0.01s')
+
+    looper.loop.run_until_complete(sensor.read(looper))
+
+    errors = looper.metrics['bobnet_read_errors_total']
+    assert errors.snapshot() == {'name,timeout': 1}
+    assert 'bobnet_read_seconds' not in looper.metrics
+
+
+def test_sensor_read_skipped_while_previous_read_running(looper):
+    sensor = Sensor('name', '10s', SlowDevice(0.05), timeout='0.01s')
+
+    looper.loop.run_until_complete(sensor.read(looper))
+    value = looper.loop.run_until_complete(sensor.read(looper))
+
+    assert value == LogMessage.error(
+        'Skipped reading name, previous read still running'
+    )
+
+
+def test_sensor_read_error(looper):
+    sensor = Sensor('name', '10s', BrokenDevice())
+
+    value = looper.loop.run_until_complete(sensor.read(looper))
+
+    assert value == LogMessage.error('Error reading name: bus error')
+
+
+def test_slow_device_does_not_delay_other_sensors(looper):
+    slow = Sensor('slow', '0.01s', SlowDevice(0.1))
+    fast = Sensor('fast', '0.01s', CounterDevice())
+    sensors = Sensors({'slow': slow, 'fast': fast})
+
+    async def stop_later(looper):
+        await asyncio.sleep(0.2)
+        looper.stop()
+
+    looper.loop.run_until_complete(
         asyncio.gather(
-            sensor.run(looper),
-            do_task(looper),
+            sensors.run(looper),
+            stop_later(looper),
             loop=looper.loop
         )
     )
 
-    assert results == [
-        None, {'sensor': 'name', 'value': mock.ANY}
+    assert fast.device.value['count'] >= 8
+
+
+def test_a_day_of_sampling_in_virtual_time(virtual_looper):
+    looper = virtual_looper
+    sensors = Sensors.from_config({'sensors': {
+        'count': {'device': 'counter', 'every': '30s', 'history': {}},
+    }})
+    sensor = list(sensors)[0]
+    day = 24 * 60 * 60
+    looper.loop.call_later(day, looper.stop)
+    start = time.monotonic()
+
+    looper.loop.run_until_complete(sensors.run(looper))
+
+    assert time.monotonic() - start < 30
+    readings = []
+    while not looper.send_queue.empty():
+        readings.append(looper.send_queue.get_nowait())
+    assert len(readings) == pytest.approx(day / 30, abs=1)
+    assert readings[-1]['value']['count'] == len(readings) - 1
+    timestamps, _ = sensor.history.window()
+    assert timestamps[0] == VIRTUAL_START * 1000
+    assert timestamps[-1] / 1000 == pytest.approx(VIRTUAL_START + day, abs=30)
+
+
+@pytest.mark.parametrize('every', ['0s', '0.0m'])
+def test_create_sensor_fails_with_zero_every(every):
+    with pytest.raises(ValueError):
+        Sensor('name', every, CounterDevice())
+
+
+def test_update_config_fails_with_zero_every():
+    sensor = Sensor('sensor1', '10s', mock.Mock())
+
+    ok, error = sensor.update_config({'every': '0s'})
+
+    assert not ok
+    assert sensor.every == 10
+
+
+def drain(queue):
+    items = []
+    while queue.qsize():
+        items.append(queue.get_nowait())
+    return items
+
+
+@pytest.fixture
+def clock_looper():
+    looper = mock.Mock()
+    looper.stopping = False
+    looper.loop.time.return_value = 0
+    return looper
+
+
+def create_scheduler(looper, sensors):
+    scheduler = Scheduler()
+    scheduler._looper = looper
+    scheduler._sample = mock.Mock()
+    for sensor in sensors:
+        scheduler.add(sensor, 0)
+    return scheduler
+
+
+def tick_at(scheduler, looper, now):
+    looper.loop.time.return_value = now
+    scheduler._tick()
+    return looper.loop.call_at.call_args[0][0]
+
+
+def test_scheduler_reads_at_absolute_deadlines(clock_looper):
+    sensor = Sensor('name', '10s', CounterDevice())
+    scheduler = create_scheduler(clock_looper, [sensor])
+
+    next_deadlines = [
+        tick_at(scheduler, clock_looper, now)
+        for now in [0, 10.3, 20.9, 30.1]
     ]
+
+    assert next_deadlines == [10, 20, 30, 40]
+    assert scheduler._sample.call_args_list == [mock.call(sensor, 0)] * 4
+
+
+def test_scheduler_reports_deadlines_missed_while_reading(clock_looper):
+    sensor = Sensor('name', '10s', CounterDevice())
+    scheduler = create_scheduler(clock_looper, [sensor])
+    task = clock_looper.loop.create_task.return_value
+
+    tick_at(scheduler, clock_looper, 0)
+    task.done.return_value = False
+    tick_at(scheduler, clock_looper, 10)
+    tick_at(scheduler, clock_looper, 20)
+    task.done.return_value = True
+    tick_at(scheduler, clock_looper, 30)
+
+    assert scheduler._sample.call_args_list == [
+        mock.call(sensor, 0),
+        mock.call(sensor, 2),
+    ]
+
+
+def test_scheduler_skips_deadlines_while_late(clock_looper):
+    sensor = Sensor('name', '10s', CounterDevice())
+    scheduler = create_scheduler(clock_looper, [sensor])
+
+    tick_at(scheduler, clock_looper, 0)
+    next_deadline = tick_at(scheduler, clock_looper, 35)
+    tick_at(scheduler, clock_looper, 40)
+
+    # the late deadline is read once on catching up and the deadlines
+    # skipped are reported with the next reading
+    assert next_deadline == 40
+    assert scheduler._sample.call_args_list == [
+        mock.call(sensor, 0),
+        mock.call(sensor, 0),
+        mock.call(sensor, 2),
+    ]
+
+
+def test_scheduler_wakes_once_per_due_tick(clock_looper):
+    sensors = [
+        Sensor(f'sensor{i}', '10s', CounterDevice()) for i in range(2000)
+    ]
+    scheduler = create_scheduler(clock_looper, sensors)
+    clock_looper.loop.call_at.reset_mock()
+
+    tick_at(scheduler, clock_looper, 0)
+    tick_at(scheduler, clock_looper, 10)
+
+    assert scheduler._sample.call_count == 4000
+    assert clock_looper.loop.call_at.call_count == 2
+
+
+def test_scheduler_applies_new_every_on_next_deadline(clock_looper):
+    sensor = Sensor('name', '10s', CounterDevice())
+    scheduler = create_scheduler(clock_looper, [sensor])
+
+    tick_at(scheduler, clock_looper, 0)
+    sensor.update_config({'every': '5s'})
+    next_deadlines = [
+        tick_at(scheduler, clock_looper, now) for now in [10, 15]
+    ]
+
+    assert next_deadlines == [15, 20]
+
+
+def test_scheduler_reschedules_immediately(clock_looper):
+    sensor = Sensor('name', '1h', CounterDevice())
+    scheduler = create_scheduler(clock_looper, [sensor])
+
+    tick_at(scheduler, clock_looper, 0)
+    sensor.update_config({'every': '10s'})
+    clock_looper.loop.time.return_value = 5
+    scheduler.reschedule(sensor)
+    armed = clock_looper.loop.call_at.call_args[0][0]
+    next_deadline = tick_at(scheduler, clock_looper, 5)
+
+    assert (armed, next_deadline) == (5, 15)
+    assert scheduler._sample.call_count == 2
+
+
+def test_apply_config_message_reschedules_on_every_change(looper):
+    sensor = Sensor('name', '1h', CounterDevice())
+    sensors = Sensors({'name': sensor})
+    sensors._scheduler = mock.Mock()
+
+    list(sensors.apply_config_message(
+        looper, ConfigMessage('name', {'every': '10s'})
+    ))
+
+    sensors._scheduler.reschedule.assert_called_once_with(sensor)
+
+
+@pytest.mark.parametrize('every', ['1h', '60m', '3600s'])
+def test_apply_config_message_keeps_schedule_if_every_unchanged(
+    looper, every
+):
+    sensor = Sensor('name', '1h', CounterDevice())
+    sensors = Sensors({'name': sensor})
+    sensors._scheduler = mock.Mock()
+
+    list(sensors.apply_config_message(
+        looper, ConfigMessage('name', {'every': every, 'timeout': '5s'})
+    ))
+
+    assert not sensors._scheduler.reschedule.called
+    assert sensor.timeout == 5
+
+
+def test_scheduler_sample_reports_missed_deadlines(looper):
+    sensor = Sensor('name', '10s', CounterDevice())
+    scheduler = Scheduler()
+    scheduler._looper = looper
+
+    looper.loop.run_until_complete(scheduler._sample(sensor, 2))
+
+    assert drain(looper.send_queue) == [
+        LogMessage.error('Missed 2 deadlines for name'),
+        {'sensor': 'name', 'value': {'count': 0}},
+    ]
+    assert looper.metrics['bobnet_missed_deadlines_total'].snapshot() == \
+        {'name': 2}
+
+
+def test_scheduler_run_until_stop(looper):
+    sensor = Sensor('name', '0.01s', CounterDevice())
+
+    async def stop_later(looper):
+        await asyncio.sleep(0.05)
+        looper.stop()
+
+    looper.loop.run_until_complete(
+        asyncio.gather(
+            Scheduler().run([sensor], looper),
+            stop_later(looper),
+            loop=looper.loop
+        )
+    )
+
+    assert drain(looper.send_queue)[0] == {
+        'sensor': 'name', 'value': {'count': 0}
+    }
+    lateness = looper.metrics['bobnet_schedule_lateness_seconds']
+    assert lateness.snapshot()['name']['count'] >= 1
+
+
+def test_sensors_record_reads(looper, tmpdir):
+    path = str(tmpdir.join('recording'))
+    sensors = Sensors.from_config({
+        'sensors': {'count': {'device': 'counter'}},
+        'record': {'path': path},
+    })
+    sensor = list(sensors)[0]
+
+    looper.loop.run_until_complete(sensor.read(looper))
+    looper.loop.run_until_complete(sensor.read(looper))
+
+    assert [
+        (sensor, value) for _, sensor, value in read_recording(path)
+    ] == [('count', {'count': 0}), ('count', {'count': 1})]